@@ -1,2 +1,9 @@
-from ._OCC import load_step_file, align_shapes
-from ._cq import align_shapes as cq_align_shapes
\ No newline at end of file
+try:
+    from ._OCC import load_step_file, align_shapes
+except ImportError: # pythonocc-core is optional, the cadquery helpers only need OCP
+    pass
+try:
+    from ._cq import align_shapes as cq_align_shapes, mass_properties, step_mass_property_cache
+except ImportError: # cadquery is optional too, the batched numpy API below only needs numpy
+    pass
+from ._batch import MassPropertyCache, batch_alignment_transforms
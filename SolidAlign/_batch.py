@@ -0,0 +1,143 @@
+import hashlib
+import json
+import os
+try:
+    import fcntl
+except ImportError: # Windows, the saves of concurrent processes are not merged
+    fcntl = None
+import numpy as np
+from typing import Callable, List, Optional, Tuple
+
+# sign flips of the source principal axes tried when aligning, the first one is the identity
+AXIS_FLIPS = np.array([[1, 1, 1]] + [1 - 2 * np.array([i>0, (i+1)%2, i%3<=1]) for i in range(3)], dtype=np.float64)
+
+def file_hash(filename : str) -> str:
+    """sha256 of the file content."""
+    h = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+class MassPropertyCache:
+    """Cache (volume, center of mass, matrix of inertia) per shape file, keyed by the file content hash.
+
+    compute_fn maps a file path to the mass properties, e.g. `lambda p: mass_properties(cq.importers.importStep(p))`.
+    If cache_path is given the cache is loaded from and saved to that JSON file, so it is shared across runs.
+    save merges the entries with those saved meanwhile by other processes, under a file lock.
+    """
+
+    def __init__(self, compute_fn : Callable[[str], Tuple[float, np.ndarray, np.ndarray]], cache_path : Optional[str] = None):
+        self.compute_fn = compute_fn
+        self.cache_path = cache_path
+        self.cache = {}
+        if cache_path is not None and os.path.isfile(cache_path):
+            with open(cache_path, "r") as f:
+                self.cache = json.load(f)
+
+    def get(self, filename : str) -> Tuple[float, np.ndarray, np.ndarray]:
+        key = file_hash(filename)
+        if key not in self.cache:
+            volume, center, inertia = self.compute_fn(filename)
+            self.cache[key] = [float(volume), np.asarray(center).tolist(), np.asarray(inertia).tolist()]
+        volume, center, inertia = self.cache[key]
+        return volume, np.array(center), np.array(inertia)
+
+    def get_batch(self, filenames : List[str]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Return stacked volumes [N], centers [N, 3] and inertia matrices [N, 3, 3]."""
+        props = [self.get(filename) for filename in filenames]
+        volumes = np.array([p[0] for p in props], dtype=np.float64)
+        centers = np.stack([p[1] for p in props], axis=0).reshape(-1, 3)
+        inertias = np.stack([p[2] for p in props], axis=0).reshape(-1, 3, 3)
+        return volumes, centers, inertias
+
+    def save(self):
+        if self.cache_path is None:
+            return
+        with open(f"{self.cache_path}.lock", "a") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                # read-merge-replace, so the entries of the other workers are kept
+                if os.path.isfile(self.cache_path):
+                    with open(self.cache_path, "r") as f:
+                        self.cache = {**json.load(f), **self.cache}
+                tmp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+                with open(tmp_path, "w") as f:
+                    json.dump(self.cache, f)
+                os.replace(tmp_path, self.cache_path)
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+def principal_frames(volumes : np.ndarray, inertias : np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Principal axes [N, 3, 3] and scales [N] (radius of gyration) of N shapes with a single batched eigh."""
+    eigvals, eigvecs = np.linalg.eigh(inertias)
+    # eigh may return a left-handed frame, the rotations built from two frames would then be reflections
+    eigvecs[..., :, 2] *= np.sign(np.linalg.det(eigvecs))[..., None]
+    scales = np.sqrt(np.abs(eigvals).sum(axis=-1) / volumes)
+    return eigvecs, scales
+
+def candidate_rotations(axes_source : np.ndarray, axes_target : np.ndarray) -> np.ndarray:
+    """Rotations [N, 4, 3, 3] mapping the source principal axes onto the target ones, for each sign flip in AXIS_FLIPS."""
+    flipped = axes_source[:, None, :, :] * AXIS_FLIPS[None, :, None, :] # [N, 4, 3, 3], flip columns
+    return np.einsum("nij,nkmj->nkim", axes_target, flipped)
+
+def voxelize_mesh(vertices : np.ndarray, triangles : np.ndarray, bmin : np.ndarray, bmax : np.ndarray, resolution : int = 64, chunk_size : int = 1024) -> np.ndarray:
+    """Occupancy of the cell centers of a resolution^3 grid spanning [bmin, bmax], by parity of vertical ray hits."""
+    cell = (bmax - bmin) / resolution
+    # tiny offset so the rays do not run exactly along mesh edges
+    xs = bmin[0] + (np.arange(resolution) + 0.5 + 1e-3 * np.sqrt(2)) * cell[0]
+    ys = bmin[1] + (np.arange(resolution) + 0.5 + 1e-3 * np.sqrt(3)) * cell[1]
+    zs = bmin[2] + (np.arange(resolution) + 0.5) * cell[2]
+    px, py = np.meshgrid(xs, ys, indexing='ij')
+    px, py = px.reshape(-1, 1), py.reshape(-1, 1) # [C, 1]
+
+    a, b, c = vertices[triangles[:, 0]], vertices[triangles[:, 1]], vertices[triangles[:, 2]]
+    e0, e1 = b - a, c - a
+    det = e0[:, 0] * e1[:, 1] - e0[:, 1] * e1[:, 0]
+    keep = np.abs(det) > 1e-12 # vertical triangles are never hit by vertical rays
+    a, e0, e1, det = a[keep], e0[keep], e1[keep], det[keep]
+
+    # hits[j] counts the ray hits between zs[j - 1] and zs[j], the last bin collects hits above the grid
+    hits = np.zeros((px.shape[0], resolution + 1), dtype=np.int64)
+    for start in range(0, len(det), chunk_size):
+        s = slice(start, start + chunk_size)
+        dx, dy = px - a[None, s, 0], py - a[None, s, 1] # [C, chunk]
+        u = (dx * e1[None, s, 1] - dy * e1[None, s, 0]) / det[None, s]
+        v = (dy * e0[None, s, 0] - dx * e0[None, s, 1]) / det[None, s]
+        col, tri = np.nonzero((u >= 0) & (v >= 0) & (u + v <= 1))
+        z = a[s][tri, 2] + u[col, tri] * e0[s][tri, 2] + v[col, tri] * e1[s][tri, 2]
+        k = np.clip(np.ceil((z - zs[0]) / cell[2]), 0, resolution).astype(np.int64)
+        np.add.at(hits, (col, k), 1)
+
+    inside = np.cumsum(hits[:, :resolution], axis=1) % 2 == 1
+    return inside.reshape(resolution, resolution, resolution)
+
+def batch_alignment_transforms(volumes_source : np.ndarray, centers_source : np.ndarray, inertias_source : np.ndarray,
+                               volumes_target : np.ndarray, centers_target : np.ndarray, inertias_target : np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Candidate alignment transforms for N source shapes at once.
+
+    Target arrays may hold a single shape (broadcast to all sources) or N shapes.
+
+    Returns:
+        transforms [N, 4, 4, 4]: homogeneous transforms mapping each source onto its target frame, one per candidate rotation.
+        rotations [N, 4, 3, 3]: the candidate rotations in the normalized (centered, unit scale) frame.
+    """
+    volumes_source, centers_source, inertias_source = np.atleast_1d(volumes_source), centers_source.reshape(-1, 3), inertias_source.reshape(-1, 3, 3)
+    volumes_target, centers_target, inertias_target = np.atleast_1d(volumes_target), centers_target.reshape(-1, 3), inertias_target.reshape(-1, 3, 3)
+    N = len(volumes_source)
+
+    # one eigh call for every source and target
+    axes, scales = principal_frames(np.concatenate([volumes_source, volumes_target]), np.concatenate([inertias_source, inertias_target]))
+    axes_source, axes_target = axes[:N], np.broadcast_to(axes[N:], (N, 3, 3))
+    s_source, s_target = scales[:N], np.broadcast_to(scales[N:], (N,))
+    centers_target = np.broadcast_to(centers_target, (N, 3))
+
+    rotations = candidate_rotations(axes_source, axes_target)
+    linear = (s_target / s_source)[:, None, None, None] * rotations # [N, 4, 3, 3]
+    transforms = np.zeros((N, 4, 4, 4))
+    transforms[..., :3, :3] = linear
+    transforms[..., :3, 3] = centers_target[:, None, :] - np.einsum("nkij,nj->nki", linear, centers_source)
+    transforms[..., 3, 3] = 1
+    return transforms, rotations
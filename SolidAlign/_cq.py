@@ -1,38 +1,89 @@
 import cadquery as cq
 import numpy as np
-from typing import Tuple, Union
+from typing import Optional, Tuple, Union
+from OCP.GProp import GProp_GProps
+from cadquery.occ_impl.shapes import shape_properties_LUT, shapetype
 
-def align_shapes(source : cq.Workplane, target : cq.Workplane) -> Tuple[cq.Workplane, float]:
-    """Align source to target using the center of mass and the principal axes of inertia. also return normalized IOU"""
-    c_source = cq.Shape.centerOfMass(source.val())
-    c_target = cq.Shape.centerOfMass(target.val())
+from ._batch import MassPropertyCache, candidate_rotations, principal_frames, voxelize_mesh
 
-    I_source = np.array(cq.Shape.matrixOfInertia(source.val()))
-    I_target = np.array(cq.Shape.matrixOfInertia(target.val()))
+def mass_properties(shape : Union[cq.Workplane, cq.Shape]) -> Tuple[float, np.ndarray, np.ndarray]:
+    """Volume, center of mass and matrix of inertia of a shape from a single GProp traversal."""
+    if isinstance(shape, cq.Workplane):
+        shape = shape.val()
+    props = GProp_GProps()
+    shape_properties_LUT[shapetype(shape.wrapped)](shape.wrapped, props)
+    center = props.CentreOfMass()
+    inertia = props.MatrixOfInertia()
+    center = np.array([center.X(), center.Y(), center.Z()])
+    inertia = np.array([[inertia.Value(i, j) for j in range(1, 4)] for i in range(1, 4)])
+    return props.Mass(), center, inertia
 
-    v_source = cq.Shape.computeMass(source.val())
-    v_target = cq.Shape.computeMass(target.val())
+def step_mass_property_cache(cache_path : Optional[str] = None) -> MassPropertyCache:
+    """Mass property cache for STEP files, keyed by file hash."""
+    return MassPropertyCache(lambda filename: mass_properties(cq.importers.importStep(filename)), cache_path)
 
-    I_p_source, I_v_source = np.linalg.eigh(I_source)
-    I_p_target, I_v_target = np.linalg.eigh(I_target)
+def tessellate_shape(shape : cq.Shape, tolerance : float = 1e-2) -> Tuple[np.ndarray, np.ndarray]:
+    """Tessellate a shape and return vertices [N, 3] and triangles [M, 3] as numpy arrays."""
+    vertices, triangles = shape.tessellate(tolerance)
+    vertices = np.array([v.toTuple() for v in vertices], dtype=np.float64).reshape(-1, 3)
+    triangles = np.array(triangles, dtype=np.int64).reshape(-1, 3)
+    return vertices, triangles
 
-    s_source = np.sqrt(np.abs(I_p_source).sum()/v_source)
-    s_target = np.sqrt(np.abs(I_p_target).sum()/v_target)
+def rank_rotations(source : cq.Shape, target : cq.Shape, Rs : np.ndarray, resolution : int = 64, tolerance : float = 1e-2) -> np.ndarray:
+    """Score candidate rotations of source with a voxel occupancy IoU against target, return indices from best to worst."""
+    v_source, t_source = tessellate_shape(source, tolerance)
+    v_target, t_target = tessellate_shape(target, tolerance)
+    v_rotated = [v_source @ R.T for R in Rs]
+
+    # one grid shared by all candidates
+    all_vertices = np.concatenate([v_target] + v_rotated, axis=0)
+    bmin, bmax = all_vertices.min(axis=0), all_vertices.max(axis=0)
+    pad = 1e-3 * (bmax - bmin).max()
+    bmin, bmax = bmin - pad, bmax + pad
+
+    occ_target = voxelize_mesh(v_target, t_target, bmin, bmax, resolution)
+    ious = np.zeros(len(Rs))
+    for i, v in enumerate(v_rotated):
+        occ_source = voxelize_mesh(v, t_source, bmin, bmax, resolution)
+        union = np.logical_or(occ_source, occ_target).sum()
+        ious[i] = np.logical_and(occ_source, occ_target).sum() / union if union > 0 else 0.0
+    return np.argsort(-ious, kind='stable')
+
+def align_shapes(source : cq.Workplane, target : cq.Workplane, num_exact : int = 1, resolution : int = 64, tolerance : float = 1e-2,
+                 source_props : Optional[Tuple] = None, target_props : Optional[Tuple] = None) -> Tuple[cq.Workplane, float]:
+    """Align source to target using the center of mass and the principal axes of inertia. also return normalized IOU
+
+    The candidate rotations are ranked with a voxel IoU on the tessellations, and the exact B-rep IoU is only
+    computed for the best num_exact of them (set num_exact=4 for the exhaustive search).
+    source_props / target_props are precomputed (volume, center, inertia), e.g. from a MassPropertyCache."""
+    v_source, c_source, I_source = source_props if source_props is not None else mass_properties(source)
+    v_target, c_target, I_target = target_props if target_props is not None else mass_properties(target)
+
+    # one batched eigh for both shapes
+    (I_v_source, I_v_target), (s_source, s_target) = principal_frames(np.array([v_source, v_target]), np.stack([I_source, I_target]))
+
+    c_source = cq.Vector(*c_source)
+    c_target = cq.Vector(*c_target)
 
     normalized_source = source.translate(-c_source).val().scale(1/s_source)
     normalized_target = target.translate(-c_target).val().scale(1/s_target)
 
-    Rs = np.zeros((4,3,3))
-    Rs[0] = I_v_target @ I_v_source.T
+    # all possible 2 out of 3 permutations
+    Rs = candidate_rotations(I_v_source[None], I_v_target[None])[0]
 
-    for i in range(3):
-        # all possible 2 out of 3 permutations
-        alignment = 1 - 2 * np.array([i>0, (i+1)%2, i%3<=1])
-        Rs[i+1] = I_v_target @ (alignment[None,:] * I_v_source).T
+    # phase 1: rank the candidates cheaply, phase 2: exact booleans only for the best num_exact of them
+    try:
+        order = rank_rotations(normalized_source, normalized_target, Rs, resolution, tolerance)
+    except Exception: # tessellation failed, fall back to exact booleans for every candidate
+        order = np.arange(4)
+        num_exact = 4
 
     best_IOU = 0.0
     best_T = None
-    for i in range(4):
+    num_evaluated = 0
+    for i in order:
+        if num_evaluated >= num_exact:
+            break
         T = np.zeros([4,4])
         T[:3,:3] = Rs[i]
         T[-1,-1] = 1
@@ -44,7 +95,8 @@ def align_shapes(source : cq.Workplane, target : cq.Workplane) -> Tuple[cq.Workp
             union = aligned_source.fuse(normalized_target)
             
             IOU = intersect.Volume() / union.Volume()
-        except: #handle cases where IOU is undefined
+            num_evaluated += 1
+        except: #handle cases where IOU is undefined, try the next candidate
             IOU = 0.0
         
         if IOU > best_IOU:
@@ -24,6 +24,9 @@
 import trimesh
 from meshiki import Mesh
 
+from data.samples import box_normalize_parts, sample_training_data
+from data.shards import ShardWriter
+
 parser = argparse.ArgumentParser()
 parser.add_argument("test_path", type=str, help="path to the mesh file or folder")
 parser.add_argument("--verbose", action="store_true", help="print verbose output")
@@ -34,6 +37,12 @@
 parser.add_argument("--no_dilate", action="store_true", help="do not dilate the mesh")
 parser.add_argument("--dilate_size", type=float, default=2 / 512, help="dilate size")
 parser.add_argument("--workspace", type=str, default="output", help="path to the output folder")
+parser.add_argument("--export_samples", action="store_true", help="sample vae/flow training data from the two parts")
+parser.add_argument("--shard_dir", type=str, default=None, help="path to the shard folder, default to workspace/shards")
+parser.add_argument("--shard_size", type=int, default=64, help="number of assets per shard")
+parser.add_argument("--num_fps_point", type=int, default=2048, help="number of fps points to store per part")
+parser.add_argument("--num_fps_salient_point", type=int, default=2048, help="number of fps salient points per part")
+parser.add_argument("--no_obj", action="store_true", help="do not export the obj files")
 opt = parser.parse_args()
 
 
@@ -475,6 +484,23 @@ def dfs(node, parent, start_node, path):
     return meshes, graph_new
 
 
+def export_samples(name, mesh_color0, mesh_color1):
+    # sample training data while the parts are still in memory, skipping the obj round-trip
+    if len(mesh_color0.faces) == 0 or len(mesh_color1.faces) == 0:
+        print(f"[WARN] skip sampling {name} because one of the parts is empty")
+        return
+
+    parts = box_normalize_parts([mesh_color0.copy(), mesh_color1.copy()])
+    sample = {}
+    for i, part in enumerate(parts):
+        part_sample = sample_training_data(
+            part, num_fps_point=opt.num_fps_point, num_fps_salient_point=opt.num_fps_salient_point
+        )
+        for k, v in part_sample.items():
+            sample[f"{k}_part{i}"] = v
+    shard_writer.add(name, sample)
+
+
 def run(path):
     print(f"[INFO] processing {path}")
 
@@ -624,6 +650,12 @@ def run(path):
     mesh_color1 = trimesh.util.concatenate(mesh_color1)
     name = os.path.splitext(os.path.basename(path))[0]
 
+    if opt.export_samples:
+        export_samples(name, mesh_color0, mesh_color1)
+
+    if opt.no_obj:
+        return
+
     # export separately
     mesh_color0.export(f"{opt.workspace}/{name}_color0.obj")
     mesh_color1.export(f"{opt.workspace}/{name}_color1.obj")
@@ -636,9 +668,16 @@ def run(path):
 
 os.makedirs(opt.workspace, exist_ok=True)
 
+if opt.export_samples:
+    shard_writer = ShardWriter(opt.shard_dir or os.path.join(opt.workspace, "shards"), shard_size=opt.shard_size)
+
 if os.path.isdir(opt.test_path):
     file_paths = glob.glob(os.path.join(opt.test_path, "*"))
     for path in tqdm.tqdm(file_paths):
         run(path)
 else:
     run(opt.test_path)
+
+if opt.export_samples:
+    shard_writer.close()
+
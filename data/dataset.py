@@ -0,0 +1,230 @@
+"""
+-----------------------------------------------------------------------------
+Copyright (c) 2024, NVIDIA CORPORATION. All rights reserved.
+
+NVIDIA CORPORATION and its licensors retain all intellectual property
+and proprietary rights in and to this software, related documentation
+and any modifications thereto. Any use, reproduction, disclosure or
+distribution of this software and related documentation without an express
+license agreement from NVIDIA CORPORATION is strictly prohibited.
+-----------------------------------------------------------------------------
+"""
+
+import json
+import os
+from typing import Callable, Literal, Optional
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset, Sampler
+
+from data.shards import SHARD_META, list_shards
+
+
+class ShardDataset(Dataset):
+    """Read precomputed samples (see `data.shards.ShardWriter`) from memory-mapped shards.
+
+    Arrays are opened lazily with `mmap_mode="c"`, so each dataloader worker maps the files itself,
+    and every returned tensor is a zero-copy `torch.from_numpy` view into the page cache.
+
+    Args:
+        root (str): shard folder.
+        mode (Literal["vae", "flow"], optional): "flow" returns both parts with the `_part0` / `_part1` suffix,
+            as consumed by `flow.model.Model.training_step`. "vae" returns each part as a separate sample
+            with the suffix stripped, as consumed by `vae.model.Model.training_step`.
+        keys (list, optional): only load these keys (without the part suffix). Defaults to all keys.
+        transform (Callable, optional): called on each sample dict, e.g. to attach condition images.
+    """
+
+    def __init__(
+        self,
+        root: str,
+        mode: Literal["vae", "flow"] = "vae",
+        keys: Optional[list] = None,
+        transform: Optional[Callable] = None,
+    ):
+        self.root = root
+        self.mode = mode
+        self.transform = transform
+
+        self.shards = list_shards(root)
+        if len(self.shards) == 0:
+            raise FileNotFoundError(f"No complete shard found in {root}")
+
+        self.metas = []
+        for shard in self.shards:
+            with open(os.path.join(shard, SHARD_META), "r") as f:
+                self.metas.append(json.load(f))
+
+        self.shard_keys = list(self.metas[0]["keys"].keys())
+        self.num_parts = len({k.rsplit("_part", 1)[1] for k in self.shard_keys if "_part" in k}) or 1
+        if keys is not None:
+            self.shard_keys = [k for k in self.shard_keys if k.rsplit("_part", 1)[0] in keys]
+
+        # global sample index -> (shard index, local index, part index)
+        self.shard_offsets = np.cumsum([0] + [meta["num_samples"] for meta in self.metas])
+        self.samples_per_asset = self.num_parts if mode == "vae" else 1
+
+        self._arrays = None  # opened lazily in each worker
+
+    def __len__(self):
+        return int(self.shard_offsets[-1]) * self.samples_per_asset
+
+    def shard_ranges(self):
+        """Return the [start, end) range of sample indices belonging to each shard."""
+        return [
+            (int(start) * self.samples_per_asset, int(end) * self.samples_per_asset)
+            for start, end in zip(self.shard_offsets[:-1], self.shard_offsets[1:])
+        ]
+
+    def _open(self):
+        self._arrays = []
+        for shard in self.shards:
+            arrays = {k: np.load(os.path.join(shard, k + ".npy"), mmap_mode="c") for k in self.shard_keys}
+            self._arrays.append(arrays)
+
+    def get_name(self, index: int):
+        asset_index = index // self.samples_per_asset
+        shard_index = int(np.searchsorted(self.shard_offsets, asset_index, side="right")) - 1
+        return self.metas[shard_index]["names"][asset_index - self.shard_offsets[shard_index]]
+
+    def __getitem__(self, index):
+        if self._arrays is None:
+            self._open()
+
+        asset_index, part_index = divmod(index, self.samples_per_asset)
+        shard_index = int(np.searchsorted(self.shard_offsets, asset_index, side="right")) - 1
+        local_index = asset_index - self.shard_offsets[shard_index]
+        arrays = self._arrays[shard_index]
+
+        sample = {}
+        if self.mode == "vae" and self.num_parts > 1:
+            suffix = f"_part{part_index}"
+            for k in self.shard_keys:
+                if k.endswith(suffix):
+                    sample[k[: -len(suffix)]] = torch.from_numpy(arrays[k][local_index])
+        else:
+            for k in self.shard_keys:
+                sample[k] = torch.from_numpy(arrays[k][local_index])
+
+        if self.transform is not None:
+            sample = self.transform(sample)
+
+        return sample
+
+
+class ShardSampler(Sampler):
+    """Deterministic shard-aware sampler, split evenly across distributed ranks.
+
+    Each epoch shuffles the shard order and the samples inside each shard with `seed + epoch`,
+    so consecutive reads stay within a few memory-mapped files. The permutation is identical
+    on every rank, each rank takes an interleaved slice and the tail is dropped so all ranks
+    see the same number of samples. Call `set_epoch` before each epoch.
+    """
+
+    def __init__(self, dataset: ShardDataset, rank: int = 0, world_size: int = 1, shuffle: bool = True, seed: int = 0):
+        self.dataset = dataset
+        self.rank = rank
+        self.world_size = world_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.num_samples = len(dataset) // world_size
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def __iter__(self):
+        ranges = self.dataset.shard_ranges()
+        if self.shuffle:
+            rng = np.random.default_rng(self.seed + self.epoch)
+            indices = np.concatenate(
+                [ranges[i][0] + rng.permutation(ranges[i][1] - ranges[i][0]) for i in rng.permutation(len(ranges))]
+            )
+        else:
+            indices = np.arange(len(self.dataset))
+
+        indices = indices[: self.num_samples * self.world_size]
+        return iter(indices[self.rank :: self.world_size].tolist())
+
+    def __len__(self):
+        return self.num_samples
+
+
+class CutoffCollate:
+    """Collate samples and apply one random FPS cutoff to the whole batch.
+
+    Same cutoff as `vae.model.Model.training_step` (a prefix of FPS points are still FPS points), moved to the
+    loader so only the needed indices are stacked and transferred. Keys ending with a `_part*` suffix are handled too.
+    When a cutoff is configured the collate owns it: the batch carries `fps_cutoff_applied` and `training_step`
+    skips its own cutoff, so every batch is cut once with the `cutoff_fps_prob` distribution.
+
+    Args:
+        cutoff_fps_point (tuple): candidates of number of fps points, e.g. `ModelConfig.cutoff_fps_point`.
+        cutoff_fps_salient_point (tuple): candidates of number of fps salient points.
+        cutoff_fps_prob (tuple): probability of each candidate, sums to 1.
+    """
+
+    def __init__(self, cutoff_fps_point=None, cutoff_fps_salient_point=None, cutoff_fps_prob=None):
+        self.cutoff_fps_point = cutoff_fps_point
+        self.cutoff_fps_salient_point = cutoff_fps_salient_point
+        self.cutoff_fps_prob = cutoff_fps_prob
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config.cutoff_fps_point, config.cutoff_fps_salient_point, config.cutoff_fps_prob)
+
+    def __call__(self, batch: list):
+        cutoff = {}
+        if self.cutoff_fps_point is not None:
+            cutoff_index = np.random.choice(len(self.cutoff_fps_prob), p=self.cutoff_fps_prob)
+            cutoff["fps_indices"] = self.cutoff_fps_point[cutoff_index]
+            cutoff["fps_indices_dorases"] = self.cutoff_fps_salient_point[cutoff_index]
+
+        output = {}
+        for k in batch[0].keys():
+            values = [sample[k] for sample in batch]
+            n = cutoff.get(k.rsplit("_part", 1)[0])
+            if n is not None:
+                values = [v[:n] for v in values]
+            output[k] = torch.stack(values, dim=0)
+        if cutoff:
+            output["fps_cutoff_applied"] = torch.tensor(True)
+        return output
+
+
+def create_data_loader(
+    root: str,
+    mode: Literal["vae", "flow"] = "vae",
+    config=None,
+    batch_size: int = 8,
+    num_workers: int = 8,
+    prefetch_factor: int = 4,
+    rank: int = 0,
+    world_size: int = 1,
+    seed: int = 0,
+    transform: Optional[Callable] = None,
+):
+    """Create a prefetching dataloader over memory-mapped shards.
+
+    Args:
+        config (optional): a `vae.configs.schema.ModelConfig`, if given the random fps cutoff is applied per batch.
+
+    Returns:
+        tuple: the DataLoader and its ShardSampler (call `sampler.set_epoch(epoch)` every epoch).
+    """
+    dataset = ShardDataset(root, mode=mode, transform=transform)
+    sampler = ShardSampler(dataset, rank=rank, world_size=world_size, seed=seed)
+    collate_fn = CutoffCollate.from_config(config) if config is not None else CutoffCollate()
+    data_loader = DataLoader(
+        dataset,
+        batch_size=batch_size,
+        sampler=sampler,
+        num_workers=num_workers,
+        collate_fn=collate_fn,
+        pin_memory=True,
+        drop_last=True,
+        prefetch_factor=prefetch_factor if num_workers > 0 else None,
+        persistent_workers=num_workers > 0,
+    )
+    return data_loader, sampler
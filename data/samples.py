@@ -0,0 +1,148 @@
+"""
+-----------------------------------------------------------------------------
+Copyright (c) 2024, NVIDIA CORPORATION. All rights reserved.
+
+NVIDIA CORPORATION and its licensors retain all intellectual property
+and proprietary rights in and to this software, related documentation
+and any modifications thereto. Any use, reproduction, disclosure or
+distribution of this software and related documentation without an express
+license agreement from NVIDIA CORPORATION is strictly prohibited.
+-----------------------------------------------------------------------------
+"""
+
+import fpsample
+import meshiki
+import numpy as np
+import trimesh
+
+
+def box_normalize_parts(meshes: list, bound: float = 0.95):
+    """Box normalize a list of meshes into [-bound, bound] with a shared transform.
+
+    Same as `vae.utils.box_normalize`, but the bounding box is computed over all parts,
+    so the parts of one asset stay aligned with each other.
+
+    Args:
+        meshes (list): list of trimesh.Trimesh, will be inplace modified.
+        bound (float, optional): half size of the normalized box. Defaults to 0.95.
+    """
+    vertices = np.concatenate([mesh.vertices for mesh in meshes], axis=0)
+    bmin = vertices.min(axis=0)
+    bmax = vertices.max(axis=0)
+    bcenter = (bmax + bmin) / 2
+    scale = 2 * bound / (bmax - bmin).max()
+    for mesh in meshes:
+        mesh.vertices = (mesh.vertices - bcenter) * scale
+    return meshes
+
+
+def sample_surface_points(
+    vertices: np.ndarray,
+    faces: np.ndarray,
+    num_uniform_point: int = 200000,
+    num_point: int = 32768,
+    num_salient_point: int = 16384,
+    num_fps_point: int = 1024,
+    num_fps_salient_point: int = 1024,
+):
+    """Sample the VAE encoder inputs from a normalized mesh.
+
+    Args:
+        vertices (np.ndarray): [N, 3], assumed to be normalized into [-1, 1]
+        faces (np.ndarray): [M, 3]
+        num_uniform_point (int, optional): number of dense uniform surface samples before FPS.
+        num_point (int, optional): number of points kept after FPS on the dense samples.
+        num_salient_point (int, optional): number of salient (sharp edge) points.
+        num_fps_point (int, optional): number of FPS indices into the uniform points.
+        num_fps_salient_point (int, optional): number of FPS indices into the salient points.
+
+    Returns:
+        dict: numpy arrays of `pointcloud` [num_point, 3], `fps_indices` [num_fps_point],
+            `pointcloud_dorases` [num_salient_point, 3] and `fps_indices_dorases` [num_fps_salient_point].
+    """
+    mesh = meshiki.Mesh(vertices.astype(np.float32), faces.astype(np.int32))
+
+    uniform_surface_points = mesh.uniform_point_sample(num_uniform_point)
+    uniform_surface_points = meshiki.fps(uniform_surface_points, num_point)
+    salient_surface_points = mesh.salient_point_sample(num_salient_point, thresh_bihedral=15)
+
+    # meshes without sharp edges may return fewer (or no) salient points, pad to a fixed size so samples can be stacked
+    if len(salient_surface_points) == 0:
+        salient_surface_points = uniform_surface_points
+    if len(salient_surface_points) != num_salient_point:
+        indices = np.random.choice(
+            len(salient_surface_points), num_salient_point, replace=len(salient_surface_points) < num_salient_point
+        )
+        salient_surface_points = salient_surface_points[indices]
+
+    sample = {}
+    sample["pointcloud"] = uniform_surface_points.astype(np.float32)
+    sample["fps_indices"] = fpsample.bucket_fps_kdline_sampling(
+        uniform_surface_points, num_fps_point, h=5, start_idx=0
+    ).astype(np.int64)
+    sample["pointcloud_dorases"] = salient_surface_points.astype(np.float32)
+    sample["fps_indices_dorases"] = fpsample.bucket_fps_kdline_sampling(
+        salient_surface_points, num_fps_salient_point, h=5, start_idx=0
+    ).astype(np.int64)
+
+    return sample
+
+
+def sample_query_points(
+    mesh: trimesh.Trimesh,
+    num_uniform_query: int = 8192,
+    num_near_query: int = 24576,
+    near_std: float = 0.01,
+    tsdf_trunc: float = 1 / 128,
+):
+    """Sample the VAE decoder supervision from a normalized watertight mesh.
+
+    Args:
+        mesh (trimesh.Trimesh): mesh normalized into [-1, 1].
+        num_uniform_query (int, optional): number of query points uniformly sampled in [-1, 1]^3.
+        num_near_query (int, optional): number of query points perturbed from the surface.
+        near_std (float, optional): std of the gaussian perturbation for near-surface points.
+        tsdf_trunc (float, optional): truncation distance, the sdf is divided by it and clipped.
+
+    Returns:
+        dict: numpy arrays of `query_points` [Q, 3] and `query_gt` [Q], TSDF in [-1, 1] (inner is positive).
+    """
+    uniform_points = np.random.uniform(-1, 1, size=(num_uniform_query, 3))
+    near_points, _ = trimesh.sample.sample_surface(mesh, num_near_query)
+    near_points = near_points + np.random.normal(scale=near_std, size=near_points.shape)
+    query_points = np.concatenate([uniform_points, near_points], axis=0).clip(-1, 1)
+
+    # trimesh sdf is positive inside
+    sdf = trimesh.proximity.signed_distance(mesh, query_points)
+    query_gt = np.clip(sdf / tsdf_trunc, -1, 1)
+
+    sample = {}
+    sample["query_points"] = query_points.astype(np.float32)
+    sample["query_gt"] = query_gt.astype(np.float32)
+
+    return sample
+
+
+def sample_training_data(
+    mesh: trimesh.Trimesh,
+    num_fps_point: int = 2048,
+    num_fps_salient_point: int = 2048,
+    num_uniform_query: int = 8192,
+    num_near_query: int = 24576,
+):
+    """Sample all tensors consumed by `vae.model.Model.training_step` from a normalized mesh.
+
+    The FPS indices default to the largest `cutoff_fps_point` in the VAE config, training slices a prefix of them.
+
+    Returns:
+        dict: numpy arrays of `pointcloud`, `fps_indices`, `pointcloud_dorases`, `fps_indices_dorases`,
+            `query_points` and `query_gt`.
+    """
+    sample = sample_surface_points(
+        np.asarray(mesh.vertices),
+        np.asarray(mesh.faces),
+        num_fps_point=num_fps_point,
+        num_fps_salient_point=num_fps_salient_point,
+    )
+    sample.update(sample_query_points(mesh, num_uniform_query=num_uniform_query, num_near_query=num_near_query))
+    return sample
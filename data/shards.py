@@ -0,0 +1,103 @@
+"""
+-----------------------------------------------------------------------------
+Copyright (c) 2024, NVIDIA CORPORATION. All rights reserved.
+
+NVIDIA CORPORATION and its licensors retain all intellectual property
+and proprietary rights in and to this software, related documentation
+and any modifications thereto. Any use, reproduction, disclosure or
+distribution of this software and related documentation without an express
+license agreement from NVIDIA CORPORATION is strictly prohibited.
+-----------------------------------------------------------------------------
+"""
+
+import json
+import os
+import shutil
+
+import numpy as np
+
+# Shard layout (one directory per N assets, every array is a plain .npy so it can be memory-mapped):
+#   {root}/shard_00000/{key}.npy   stacked [N, ...] array for each sample key
+#   {root}/shard_00000/meta.json   {"names": [...], "num_samples": N, "keys": {key: {"shape": [...], "dtype": str}}}
+# A shard is written into a hidden temporary directory and renamed in place once complete.
+
+SHARD_META = "meta.json"
+
+
+class ShardWriter:
+    """Accumulate per-asset samples in memory and flush them as fixed-size shards.
+
+    Example:
+    ```python
+    with ShardWriter('output/shards', shard_size=64) as writer:
+        writer.add(name, {'pointcloud': ..., 'fps_indices': ...})
+    ```
+    """
+
+    def __init__(self, root: str, shard_size: int = 64):
+        self.root = root
+        self.shard_size = shard_size
+        os.makedirs(root, exist_ok=True)
+
+        # continue numbering after existing shards, so repeated runs append instead of overwriting
+        shards = list_shards(root)
+        self.shard_index = int(os.path.basename(shards[-1])[len("shard_") :]) + 1 if len(shards) > 0 else 0
+        self.names = []
+        self.buffers = {}
+
+    def add(self, name: str, sample: dict):
+        if len(self.names) > 0 and set(sample.keys()) != set(self.buffers.keys()):
+            raise ValueError(f"Sample {name} has keys {sorted(sample.keys())}, expected {sorted(self.buffers.keys())}")
+        self.names.append(name)
+        for k, v in sample.items():
+            self.buffers.setdefault(k, []).append(np.asarray(v))
+        if len(self.names) >= self.shard_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.names) == 0:
+            return
+
+        shard_name = f"shard_{self.shard_index:05d}"
+        tmp_dir = os.path.join(self.root, "." + shard_name + ".tmp")
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+
+        keys = {}
+        for k, v in self.buffers.items():
+            arr = np.stack(v, axis=0)
+            np.save(os.path.join(tmp_dir, k + ".npy"), arr)
+            keys[k] = {"shape": list(arr.shape[1:]), "dtype": str(arr.dtype)}
+
+        with open(os.path.join(tmp_dir, SHARD_META), "w") as f:
+            json.dump({"names": self.names, "num_samples": len(self.names), "keys": keys}, f)
+
+        shard_dir = os.path.join(self.root, shard_name)
+        os.rename(tmp_dir, shard_dir)
+
+        print(f"[INFO] write {shard_dir} with {len(self.names)} samples")
+        self.shard_index += 1
+        self.names = []
+        self.buffers = {}
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
+
+def list_shards(root: str):
+    """List complete shard directories under root, sorted by name."""
+    if not os.path.isdir(root):
+        return []
+    shards = []
+    for name in sorted(os.listdir(root)):
+        path = os.path.join(root, name)
+        if name.startswith("shard_") and os.path.isfile(os.path.join(path, SHARD_META)):
+            shards.append(path)
+    return shards
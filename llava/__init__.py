@@ -1 +1,7 @@
-from .model import LlavaLlamaForCausalLM
+def __getattr__(name):
+    # the model (torch, transformers) is only imported when used, so the CAD scripts can import the
+    # lightweight helpers of llava.eval (e.g. llava.eval.jsonl_io) without it
+    if name == "LlavaLlamaForCausalLM":
+        from .model import LlavaLlamaForCausalLM
+        return LlavaLlamaForCausalLM
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
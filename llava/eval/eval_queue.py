@@ -0,0 +1,199 @@
+"""
+Work-stealing queue for multi-process evaluation, shared through a directory and a file lock.
+
+Instead of a fixed contiguous chunk per GPU, every worker claims the next batch of questions when it is
+ready for more, so workers that draw short programs simply take more of them. Questions are handed out
+longest prompt first, so a claimed batch holds prompts of similar length. Completed question_ids are
+checkpointed in the queue directory, and a new queue over the same directory skips them.
+
+A claim is only a cursor move, nothing is returned to the queue when a worker dies: the positions it claimed
+but did not complete (its batch in progress and those prefetched by its DataLoader, see QueueBatchSampler)
+stay out of the queue until it is rebuilt by `init`, which queues every question that is not completed again.
+
+Queue directory layout:
+    order.json       question file and positions still to hand out, in hand out order
+    cursor           number of positions handed out so far
+    completed.jsonl  one completed question_id per line
+    lock             flock'ed around every read-modify-write
+
+Also usable from the command line:
+    python -m llava.eval.eval_queue init QUEUE_DIR questions.jsonl
+    python -m llava.eval.eval_queue merge QUEUE_DIR merge.jsonl worker_0.jsonl worker_1.jsonl
+"""
+
+import fcntl
+import json
+import os
+import sys
+from collections import deque
+from contextlib import contextmanager
+
+from llava.eval.jsonl_io import JsonlIndex, iter_jsonl, dumps, loads
+
+class WorkQueue:
+    """
+    Example:
+        WorkQueue.create("./queue", "./inference/cadquery_test_data_subset100.jsonl")   # once, by the launcher
+        queue = WorkQueue("./queue")                                                     # in every worker
+        while positions := queue.claim(8):
+            ...  # answer the questions at these positions of the question file
+            queue.complete(question_ids)
+    """
+
+    def __init__(self, queue_dir):
+        self.queue_dir = queue_dir
+        with open(os.path.join(queue_dir, "order.json"), "r", encoding="utf-8") as f:
+            state = json.load(f)
+        self.question_file = state["question_file"]
+        self.order = state["order"]
+
+    @classmethod
+    def create(cls, queue_dir, question_file, key="question_id", reset=False):
+        """
+        (Re)build the queue of the questions of question_file that are not completed yet.
+
+        Positions are sorted by decreasing prompt length, so batches are length bucketed and the longest
+        (most memory hungry) prompts run first. With reset=True the completed checkpoint is discarded.
+        """
+        os.makedirs(queue_dir, exist_ok=True)
+        queue = cls.__new__(cls)
+        queue.queue_dir = queue_dir
+        with queue._locked():
+            if reset and os.path.exists(queue._path("completed.jsonl")):
+                os.remove(queue._path("completed.jsonl"))
+            completed = queue.completed()
+            stranded = queue._stranded(completed, key)
+            lengths = []
+            for position, data in enumerate(iter_jsonl(question_file, [key, "text"])):
+                if data[key] not in completed:
+                    lengths.append((-len(data["text"] or ""), position))
+            order = [position for _, position in sorted(lengths)]
+
+            _write_atomic(queue._path("order.json"), json.dumps({"question_file": question_file, "order": order}))
+            _write_atomic(queue._path("cursor"), "0")
+        print(f"{len(order)} questions queued in {queue_dir}, {len(completed)} already completed, "
+              f"{stranded} claimed by a previous run but never completed")
+        return cls(queue_dir)
+
+    def _stranded(self, completed, key):
+        """Number of positions handed out by the previous queue of this directory that were never completed."""
+        if not os.path.exists(self._path("order.json")):
+            return 0
+        with open(self._path("order.json"), "r", encoding="utf-8") as f:
+            state = json.load(f)
+        keys = JsonlIndex(state["question_file"], key=key).keys
+        return sum(position >= len(keys) or keys[position] not in completed for position in state["order"][:self._cursor()])
+
+    def _path(self, name):
+        return os.path.join(self.queue_dir, name)
+
+    @contextmanager
+    def _locked(self):
+        with open(self._path("lock"), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _cursor(self):
+        with open(self._path("cursor"), "r", encoding="utf-8") as f:
+            return int(f.read() or 0)
+
+    def claim(self, n):
+        """Hand out the next n positions (fewer at the end of the queue, an empty list once it is drained)."""
+        with self._locked():
+            cursor = self._cursor()
+            positions = self.order[cursor:cursor + n]
+            _write_atomic(self._path("cursor"), str(cursor + len(positions)))
+        return positions
+
+    def complete(self, question_ids):
+        """Checkpoint question_ids, their answers must already be on disk."""
+        with self._locked():
+            with open(self._path("completed.jsonl"), "a", encoding="utf-8") as f:
+                for question_id in question_ids:
+                    f.write(dumps(question_id) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def completed(self):
+        """Set of the completed question_ids."""
+        if not os.path.exists(self._path("completed.jsonl")):
+            return set()
+        with open(self._path("completed.jsonl"), "rb") as f:
+            return {loads(line) for line in f if line.strip()}
+
+    def num_remaining(self):
+        return len(self.order) - self._cursor()
+
+class QueueBatchSampler:
+    """
+    Batch sampler claiming batches from a WorkQueue as the DataLoader asks for them.
+
+    The claimed batches are also kept in `claimed`, in the order the DataLoader will return them.
+    A DataLoader with worker processes asks for `prefetch_factor * num_workers` batches ahead of the one being
+    answered, and they are claimed at that time: keep both small (model_vqa_loader uses one worker prefetching
+    one batch), every prefetched batch is held back from the other workers and lost with this one if it crashes.
+    """
+
+    def __init__(self, queue, batch_size):
+        self.queue = queue
+        self.batch_size = batch_size
+        self.claimed = deque()
+
+    def __iter__(self):
+        while True:
+            positions = self.queue.claim(self.batch_size)
+            if len(positions) == 0:
+                return
+            self.claimed.append(positions)
+            yield positions
+
+    def claimed_batches(self):
+        """Iterator over the claimed batches, to zip with the DataLoader."""
+        while True:
+            yield self.claimed.popleft()
+
+def merge_answers(question_file, answer_files, output_path, key="question_id"):
+    """
+    Merge the answer files of the workers in question file order, whatever worker answered what.
+
+    When a question was answered more than once (a worker restarted mid-batch), the last answer read wins.
+    Returns the number of questions without an answer.
+    """
+    answers = {}
+    for answer_file in answer_files:
+        with open(answer_file, "rb") as f:
+            for line in f:
+                if line.strip():
+                    answers[loads(line)[key]] = line.rstrip(b"\n")
+
+    num_missing = 0
+    tmp_path = f"{output_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as out:
+        for question_id in JsonlIndex(question_file, key=key).keys:
+            line = answers.get(question_id)
+            if line is None:
+                num_missing += 1
+                continue
+            out.write(line + b"\n")
+    os.replace(tmp_path, output_path)
+    return num_missing
+
+def _write_atomic(path, text):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 4 and sys.argv[1] == "init":
+        WorkQueue.create(sys.argv[2], sys.argv[3], reset="--reset" in sys.argv[4:])
+    elif len(sys.argv) >= 4 and sys.argv[1] == "merge":
+        num_missing = merge_answers(WorkQueue(sys.argv[2]).question_file, sys.argv[4:], sys.argv[3])
+        if num_missing > 0:
+            print(f"{num_missing} questions have no answer, run the evaluation again to resume")
+    else:
+        print(__doc__)
+        sys.exit(1)
@@ -0,0 +1,183 @@
+"""
+Streaming JSONL helpers shared by the CAD scripts and the eval loaders.
+
+Files are read line by line and only the requested keys of each record are kept, so a merge.jsonl with
+multi-kB code strings never has to be held in memory as a list of dicts. orjson is used when installed.
+An on-disk offset index gives random access to a record by question_id without reading the whole file.
+
+Also usable from the command line:
+    python -m llava.eval.jsonl_io merge merge.jsonl 2_0.jsonl 2_1.jsonl
+    python -m llava.eval.jsonl_io index questions.jsonl
+"""
+
+import json
+import os
+import shutil
+import sys
+
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    orjson = None
+    loads = json.loads
+
+def dumps(obj):
+    """Serialize one record as a JSONL line (without the newline), with orjson when available."""
+    if orjson is not None:
+        return orjson.dumps(obj).decode("utf-8")
+    return json.dumps(obj)
+
+def iter_jsonl(file_path, keys=None):
+    """
+    Lazily iterate over the records of a JSONL file.
+
+    Args:
+        file_path (str): path to the JSONL file.
+        keys (list, optional): only keep these keys of each record (missing keys are None).
+
+    Yields:
+        dict: one record per non-empty line.
+    """
+    with open(file_path, "rb") as file:
+        for line in file:
+            if not line.strip():
+                continue
+            data = loads(line)
+            if keys is not None:
+                data = {key: data.get(key, None) for key in keys}
+            yield data
+
+def read_columns(file_path, *keys):
+    """Read only the given keys of every record, returned as a tuple of lists (one per key)."""
+    columns = tuple([] for _ in keys)
+    for data in iter_jsonl(file_path, keys):
+        for column, key in zip(columns, keys):
+            column.append(data[key])
+    return columns
+
+class JsonlIndex:
+    """
+    Random access to the records of a JSONL file through the byte offset of every line.
+
+    The offsets are cached next to the file in `{file_path}.idx` and rebuilt whenever the file changes
+    (size or modification time). Records are only decoded when accessed.
+
+    Example:
+        index = JsonlIndex("./inference/cadquery_test_data_subset100.jsonl")
+        record = index.get(111911)   # by question_id
+        record = index[0]            # by position in the file
+    """
+
+    def __init__(self, file_path, key="question_id"):
+        self.file_path = file_path
+        self.key = key
+        self.offsets, self.keys = self._load_or_build()
+        self.positions = {k: i for i, k in enumerate(self.keys)}
+        self._file = None
+        self._pid = None
+
+    def _index_path(self):
+        return f"{self.file_path}.idx"
+
+    def _load_or_build(self):
+        stat = os.stat(self.file_path)
+        try:
+            with open(self._index_path(), "r", encoding="utf-8") as f:
+                index = json.load(f)
+            if index["size"] == stat.st_size and index["mtime"] == stat.st_mtime and index["key"] == self.key:
+                return index["offsets"], index["keys"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+        offsets, keys = [], []
+        offset = 0
+        with open(self.file_path, "rb") as file:
+            for line in file:
+                if line.strip():
+                    offsets.append(offset)
+                    keys.append(loads(line).get(self.key, None))
+                offset += len(line)
+
+        tmp_path = f"{self._index_path()}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"size": stat.st_size, "mtime": stat.st_mtime, "key": self.key, "offsets": offsets, "keys": keys}, f)
+            os.replace(tmp_path, self._index_path())
+        except OSError: # read-only location, the index is simply rebuilt next time
+            pass
+        return offsets, keys
+
+    def _handle(self):
+        # one handle per process, so the index can be shared with dataloader workers
+        if self._file is None or self._pid != os.getpid():
+            self._file = open(self.file_path, "rb")
+            self._pid = os.getpid()
+        return self._file
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __contains__(self, key):
+        return key in self.positions
+
+    def __getitem__(self, position):
+        file = self._handle()
+        file.seek(self.offsets[position])
+        return loads(file.readline())
+
+    def __iter__(self):
+        return iter_jsonl(self.file_path)
+
+    def get(self, key, default=None):
+        """Return the record whose key (question_id by default) equals key."""
+        position = self.positions.get(key)
+        return self[position] if position is not None else default
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_file"] = None
+        return state
+
+def resume_jsonl(file_path, key="question_id"):
+    """
+    Prepare a JSONL file written by an interrupted run to be appended to.
+
+    A last line cut short by the interruption is truncated away. Returns the set of the key values
+    of the complete records (empty if the file does not exist).
+    """
+    if not os.path.exists(file_path):
+        return set()
+    with open(file_path, "rb+") as file:
+        file.seek(0, os.SEEK_END)
+        size = file.tell()
+        if size > 0:
+            file.seek(-1, os.SEEK_END)
+            if file.read(1) != b"\n":
+                file.seek(0)
+                end = file.read().rfind(b"\n") + 1
+                file.truncate(end)
+                print(f"Dropped a partially written record at the end of {file_path}")
+    return {data[key] for data in iter_jsonl(file_path, [key])}
+
+def merge_jsonl(output_path, input_paths):
+    """Concatenate JSONL files by streaming their bytes, making sure every file ends with a newline."""
+    tmp_path = f"{output_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as out:
+        for input_path in input_paths:
+            with open(input_path, "rb") as f:
+                shutil.copyfileobj(f, out, 1 << 20)
+                if f.tell() > 0:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b"\n":
+                        out.write(b"\n")
+    os.replace(tmp_path, output_path)
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 3 and sys.argv[1] == "merge":
+        merge_jsonl(sys.argv[2], sys.argv[3:])
+    elif len(sys.argv) == 3 and sys.argv[1] == "index":
+        print(f"{len(JsonlIndex(sys.argv[2]))} records indexed in {sys.argv[2]}.idx")
+    else:
+        print(__doc__)
+        sys.exit(1)
@@ -4,16 +4,23 @@
 import json
 from tqdm import tqdm
 import shortuuid
+import time
 
 from llava.constants import IMAGE_TOKEN_INDEX, DEFAULT_IMAGE_TOKEN, DEFAULT_IM_START_TOKEN, DEFAULT_IM_END_TOKEN
 from llava.conversation import conv_templates, SeparatorStyle
 from llava.model.builder import load_pretrained_model
 from llava.utils import disable_torch_init
 from llava.mm_utils import tokenizer_image_token, process_images, get_model_name_from_path
+from llava.model.speculative import build_drafter, speculative_generate
+from llava.model.cadquery_grammar import load_cadquery_automaton, CadQueryLogitsProcessor
+from transformers import LogitsProcessorList
 from torch.utils.data import Dataset, DataLoader
+from llava.eval.jsonl_io import JsonlIndex, resume_jsonl
+from llava.eval.eval_queue import WorkQueue, QueueBatchSampler, merge_answers
 
 from PIL import Image
 import math
+from functools import partial
 
 
 def split_list(lst, n):
@@ -29,8 +36,9 @@ def get_chunk(lst, n, k):
 
 # Custom dataset class
 class CustomDataset(Dataset):
-    def __init__(self, questions, image_folder, tokenizer, image_processor, model_config, conv_mode):
+    def __init__(self, questions, positions, image_folder, tokenizer, image_processor, model_config, conv_mode):
         self.questions = questions
+        self.positions = positions
         self.image_folder = image_folder
         self.tokenizer = tokenizer
         self.image_processor = image_processor
@@ -38,7 +46,7 @@ def __init__(self, questions, image_folder, tokenizer, image_processor, model_co
         self.conv_mode = conv_mode
 
     def __getitem__(self, index):
-        line = self.questions[index]
+        line = self.questions[self.positions[index]]
         image_file = line["image"]
         qs = line["text"]
         if self.model_config.mm_use_im_start_end:
@@ -59,21 +67,58 @@ def __getitem__(self, index):
         return input_ids, image_tensor, image.size
 
     def __len__(self):
-        return len(self.questions)
+        return len(self.positions)
 
 
-def collate_fn(batch):
+def collate_fn(batch, pad_token_id=0):
     input_ids, image_tensors, image_sizes = zip(*batch)
-    input_ids = torch.stack(input_ids, dim=0)
-    image_tensors = torch.stack(image_tensors, dim=0)
-    return input_ids, image_tensors, image_sizes
+    # left padding, so every prompt ends at the last position and generation starts right after it
+    max_len = max(x.shape[0] for x in input_ids)
+    padded_input_ids = torch.full((len(input_ids), max_len), pad_token_id, dtype=input_ids[0].dtype)
+    attention_mask = torch.zeros((len(input_ids), max_len), dtype=torch.long)
+    for i, x in enumerate(input_ids):
+        padded_input_ids[i, max_len - x.shape[0]:] = x
+        attention_mask[i, max_len - x.shape[0]:] = 1
+    if all(x.shape == image_tensors[0].shape for x in image_tensors):
+        image_tensors = torch.stack(image_tensors, dim=0)
+    else:
+        image_tensors = list(image_tensors)  # anyres images with different numbers of patches
+    return padded_input_ids, attention_mask, image_tensors, image_sizes
+
+
+def length_sorted(questions, positions):
+    """Positions sorted by decreasing prompt length, so batches hold prompts of similar length (longest first, to fail fast on OOM)."""
+    return sorted(positions, key=lambda position: -len(questions[position]["text"]))
+
+
+def write_progress(answers_file, **progress):
+    """Progress sidecar of an answers file, replaced atomically so it can be polled by other tools."""
+    progress_file = f"{answers_file}.progress.json"
+    tmp_file = f"{progress_file}.{os.getpid()}.tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(dict(progress, updated=time.time()), f)
+    os.replace(tmp_file, progress_file)
+
+
+def speculative_summary(totals):
+    """Acceptance rate and tokens per main model pass over the whole run (empty without speculative decoding)."""
+    if totals["num_passes"] == 0:
+        return {}
+    return {"acceptance_rate": totals["num_accepted"] / max(totals["num_drafted"], 1),
+            "tokens_per_pass": totals["num_new_tokens"] / totals["num_passes"]}
 
 
 # DataLoader
-def create_data_loader(questions, image_folder, tokenizer, image_processor, model_config, conv_mode, batch_size=1, num_workers=4):
-    assert batch_size == 1, "batch_size must be 1"
-    dataset = CustomDataset(questions, image_folder, tokenizer, image_processor, model_config, conv_mode)
-    data_loader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers, shuffle=False, collate_fn=collate_fn)
+def create_data_loader(questions, positions, image_folder, tokenizer, image_processor, model_config, conv_mode, batch_size=1, num_workers=4, batch_sampler=None):
+    dataset = CustomDataset(questions, positions, image_folder, tokenizer, image_processor, model_config, conv_mode)
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    collate = partial(collate_fn, pad_token_id=pad_token_id)
+    if batch_sampler is not None:
+        # every batch the DataLoader prefetches is claimed from the queue, hold at most one besides the one being generated
+        data_loader = DataLoader(dataset, batch_sampler=batch_sampler, num_workers=min(num_workers, 1), collate_fn=collate,
+                                 prefetch_factor=1 if num_workers > 0 else None)
+    else:
+        data_loader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers, shuffle=False, collate_fn=collate)
     return data_loader
 
 
@@ -82,50 +127,136 @@ def eval_model(args):
     disable_torch_init()
     model_path = os.path.expanduser(args.model_path)
     model_name = get_model_name_from_path(model_path)
-    tokenizer, model, image_processor, context_len = load_pretrained_model(model_path, args.model_base, model_name)
+    tokenizer, model, image_processor, context_len = load_pretrained_model(model_path, args.model_base, model_name, image_feature_cache_mb=args.image_cache_mb,
+                                                                           prefix_cache_size=args.prefix_cache_size)
 
-    questions = [json.loads(q) for q in open(os.path.expanduser(args.question_file), "r")]
-    questions = get_chunk(questions, args.num_chunks, args.chunk_idx)
+    # questions are read lazily through a byte offset index instead of being loaded as a list of dicts
+    questions = JsonlIndex(os.path.expanduser(args.question_file))
     answers_file = os.path.expanduser(args.answers_file)
     os.makedirs(os.path.dirname(answers_file), exist_ok=True)
-    ans_file = open(answers_file, "w")
 
     if 'plain' in model_name and 'finetune' not in model_name.lower() and 'mmtag' not in args.conv_mode:
         args.conv_mode = args.conv_mode + '_mmtag'
         print(f'It seems that this is a plain model, but it is not using a mmtag prompt, auto switching to {args.conv_mode}.')
 
-    data_loader = create_data_loader(questions, args.image_folder, tokenizer, image_processor, model.config, args.conv_mode)
-
-    for (input_ids, image_tensor, image_sizes), line in tqdm(zip(data_loader, questions), total=len(questions)):
-        idx = line["question_id"]
-        cur_prompt = line["text"]
-
-        input_ids = input_ids.to(device='cuda', non_blocking=True)
-
-        with torch.inference_mode():
-            output_ids = model.generate(
-                input_ids,
-                images=image_tensor.to(dtype=torch.float16, device='cuda', non_blocking=True),
-                image_sizes=image_sizes,
-                do_sample=True if args.temperature > 0 else False,
-                temperature=args.temperature,
-                top_p=args.top_p,
-                num_beams=args.num_beams,
-                max_new_tokens=args.max_new_tokens,
-                use_cache=True)
-
-        outputs = tokenizer.batch_decode(output_ids, skip_special_tokens=True)[0].strip()
-
-        ans_id = shortuuid.uuid()
-        ans_file.write(json.dumps({"question_id": idx,
-                                   "prompt": cur_prompt,
-                                   "text": outputs,
-                                   "answer_id": ans_id,
-                                   "model_id": model_name,
-                                   "metadata": {}}) + "\n")
-        # ans_file.flush()
+    batch_size = args.batch_size
+    # the multimodal embeddings are re-padded on this side, the prompts must end where generation starts
+    model.config.tokenizer_padding_side = 'left'
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    drafter = build_drafter(args.speculative, args.draft_model_path, args.num_draft_tokens, args.prompt_lookup_ngram)
+    if args.grammar == "cadquery" and drafter is not None:
+        raise ValueError("--grammar cadquery applies to model.generate, it cannot be combined with --speculative")
+    automaton = load_cadquery_automaton(tokenizer) if args.grammar == "cadquery" else None
+    spec_totals = {"num_drafted": 0, "num_accepted": 0, "num_new_tokens": 0, "num_passes": 0}
+
+    queue = None
+    if args.work_queue is not None:
+        # batches are claimed from the queue shared by all the workers as this one gets through them,
+        # answers are written as they come and put back in question order by llava.eval.eval_queue merge
+        queue = WorkQueue(os.path.expanduser(args.work_queue))
+        batch_sampler = QueueBatchSampler(queue, batch_size)
+        positions = None
+        batches = batch_sampler.claimed_batches()
+        data_loader = create_data_loader(questions, range(len(questions)), args.image_folder, tokenizer, image_processor, model.config, args.conv_mode,
+                                         batch_sampler=batch_sampler)
+        resume_jsonl(answers_file)  # the queue already skips the completed questions
+        ans_file = open(answers_file, "a", buffering=1)
+    else:
+        # batches are built from prompts of similar length, the answers are put back in question order at the end
+        positions = get_chunk(list(range(len(questions))), args.num_chunks, args.chunk_idx)
+        if args.resume:
+            completed = resume_jsonl(answers_file)
+            positions = [position for position in positions if questions.keys[position] not in completed]
+            print(f"Resuming {answers_file}: {len(completed)} answers kept, {len(positions)} questions left")
+        order = length_sorted(questions, positions) if batch_size > 1 else positions
+        batches = [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+        data_loader = create_data_loader(questions, order, args.image_folder, tokenizer, image_processor, model.config, args.conv_mode, batch_size=batch_size)
+        # line buffered, every answer reaches the OS as soon as it is written
+        ans_file = open(answers_file, "a" if args.resume else "w", buffering=1)
+
+    num_answered = 0
+    start_time = last_sync = time.time()
+    with tqdm(total=len(positions) if positions is not None else None) as progress:
+        for (input_ids, attention_mask, image_tensor, image_sizes), batch_positions in zip(data_loader, batches):
+            input_ids = input_ids.to(device='cuda', non_blocking=True)
+            attention_mask = attention_mask.to(device='cuda', non_blocking=True)
+            if isinstance(image_tensor, list):
+                images = [x.to(dtype=torch.float16, device='cuda', non_blocking=True) for x in image_tensor]
+            else:
+                images = image_tensor.to(dtype=torch.float16, device='cuda', non_blocking=True)
+
+            spec_stats = [None] * len(batch_positions)
+            if drafter is not None:
+                # speculative decoding runs one prompt at a time, the left padding is dropped
+                output_ids = []
+                for i in range(input_ids.shape[0]):
+                    with torch.inference_mode():
+                        ids, spec_stats[i] = speculative_generate(
+                            model,
+                            input_ids[i:i + 1, attention_mask[i].bool()],
+                            drafter,
+                            images=[images[i]] if isinstance(images, list) else images[i:i + 1],
+                            image_sizes=[image_sizes[i]],
+                            max_new_tokens=args.max_new_tokens,
+                            temperature=args.temperature,
+                            top_p=args.top_p,
+                            eos_token_id=tokenizer.eos_token_id)
+                    output_ids.append(ids[0].tolist())
+                    for key in ("num_drafted", "num_accepted", "num_new_tokens"):
+                        spec_totals[key] += spec_stats[i][key]
+                    spec_totals["num_passes"] += spec_stats[i]["num_rounds"] + 1
+            else:
+                with torch.inference_mode():
+                    output_ids = model.generate(
+                        input_ids,
+                        attention_mask=attention_mask,
+                        images=images,
+                        image_sizes=image_sizes,
+                        do_sample=True if args.temperature > 0 else False,
+                        temperature=args.temperature,
+                        top_p=args.top_p,
+                        num_beams=args.num_beams,
+                        max_new_tokens=args.max_new_tokens,
+                        pad_token_id=pad_token_id,  # finished sequences are padded until the whole batch stops
+                        logits_processor=LogitsProcessorList([CadQueryLogitsProcessor(automaton, args.num_beams)]) if automaton is not None else None,
+                        use_cache=True)
+
+            outputs = tokenizer.batch_decode(output_ids, skip_special_tokens=True)
+
+            # answers are written as soon as they are generated, so an interrupted run keeps them
+            question_ids = []
+            for position, output, stats in zip(batch_positions, outputs, spec_stats):
+                line = questions[position]
+                question_ids.append(line["question_id"])
+                ans_id = shortuuid.uuid()
+                ans_file.write(json.dumps({"question_id": line["question_id"],
+                                           "prompt": line["text"],
+                                           "text": output.strip(),
+                                           "answer_id": ans_id,
+                                           "model_id": model_name,
+                                           "metadata": {} if stats is None else {"speculative": stats}}) + "\n")
+            num_answered += len(batch_positions)
+            if queue is not None:
+                # the answers must be on disk before the questions are checkpointed as completed
+                os.fsync(ans_file.fileno())
+                queue.complete(question_ids)
+            if time.time() - last_sync >= args.fsync_interval:
+                os.fsync(ans_file.fileno())
+                last_sync = time.time()
+                write_progress(answers_file, answered=num_answered, total=len(positions) if positions is not None else None,
+                               seconds_per_question=(last_sync - start_time) / num_answered, **speculative_summary(spec_totals))
+            progress.update(len(batch_positions))
+    os.fsync(ans_file.fileno())
     ans_file.close()
 
+    if queue is None and batch_size > 1:
+        # length bucketing answered out of order, rewrite the answers in question file order
+        merge_answers(questions.file_path, [answers_file], answers_file)
+    write_progress(answers_file, answered=num_answered, total=len(positions) if positions is not None else None, done=True,
+                   **speculative_summary(spec_totals))
+    if drafter is not None:
+        print(f"Speculative decoding: {speculative_summary(spec_totals)}")
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--model-path", type=str, default="facebook/opt-350m")
@@ -140,6 +271,17 @@ def eval_model(args):
     parser.add_argument("--top_p", type=float, default=None)
     parser.add_argument("--num_beams", type=int, default=1)
     parser.add_argument("--max_new_tokens", type=int, default=128)
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--resume", action="store_true", help="keep the answers already in --answers-file and skip their questions")
+    parser.add_argument("--fsync-interval", type=float, default=30, help="seconds between two fsync of the answers file and progress updates")
+    parser.add_argument("--speculative", type=str, default="none", choices=["none", "prompt_lookup", "draft_model"])
+    parser.add_argument("--draft-model-path", type=str, default=None, help="small causal LM sharing the tokenizer, for --speculative draft_model")
+    parser.add_argument("--num-draft-tokens", type=int, default=None)
+    parser.add_argument("--prompt-lookup-ngram", type=int, default=3)
+    parser.add_argument("--image-cache-mb", type=int, default=0, help="keep the features of encoded images, for question files asking several questions per image")
+    parser.add_argument("--prefix-cache-size", type=int, default=4, help="prompt prefixes (text before the image) whose KV cache is kept, 0 to disable")
+    parser.add_argument("--grammar", type=str, default="none", choices=["none", "cadquery"], help="constrain the answers to the GenCAD-Code CadQuery statements")
+    parser.add_argument("--work-queue", type=str, default=None, help="queue directory created by python -m llava.eval.eval_queue init, replaces --num-chunks/--chunk-idx")
     args = parser.parse_args()
 
     eval_model(args)
@@ -23,7 +23,7 @@
 from llava.constants import DEFAULT_IMAGE_PATCH_TOKEN, DEFAULT_IM_START_TOKEN, DEFAULT_IM_END_TOKEN
 
 
-def load_pretrained_model(model_path, model_base, model_name, load_8bit=False, load_4bit=False, device_map="auto", device="cuda", use_flash_attn=False, **kwargs):
+def load_pretrained_model(model_path, model_base, model_name, load_8bit=False, load_4bit=False, device_map="auto", device="cuda", use_flash_attn=False, image_feature_cache_mb=0, prefix_cache_size=0, **kwargs):
     kwargs = {"device_map": device_map, **kwargs}
 
     if device != "cuda":
@@ -158,6 +158,10 @@ def load_from_hf(repo_id, filename, subfolder=None):
         if device_map != 'auto':
             vision_tower.to(device=device_map, dtype=torch.float16)
         image_processor = vision_tower.image_processor
+        if image_feature_cache_mb > 0:
+            model.enable_image_feature_cache(image_feature_cache_mb)
+        if prefix_cache_size > 0 and isinstance(model, (LlavaLlamaForCausalLM, LlavaMistralForCausalLM)):
+            model.enable_prefix_cache(prefix_cache_size)
 
     if hasattr(model.config, "max_sequence_length"):
         context_len = model.config.max_sequence_length
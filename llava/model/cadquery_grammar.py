@@ -0,0 +1,361 @@
+"""
+Grammar-constrained decoding of GenCAD-Code CadQuery scripts.
+
+The scripts of the dataset follow a fixed statement layout:
+
+    import cadquery as cq
+    # Generating a workplane for sketch 0
+    wp_sketch0 = cq.Workplane(cq.Plane(cq.Vector(x, y, z), cq.Vector(x, y, z), cq.Vector(x, y, z)))
+    loop0=wp_sketch0.moveTo(x, y).lineTo(x, y).threePointArc((x, y), (x, y)).close()
+    loop1=wp_sketch0.moveTo(x, y).circle(r)
+    solid0=wp_sketch0.add(loop0).add(loop1).extrude(d)
+    solid=solid0
+    ... more sketches, each followed by solid=solid.union(solidN) / solid=solid.cut(solidN)
+
+This layout is a regular language. It is compiled once into a character DFA, then into a token automaton
+(for every DFA state, the tokens that keep the text in the language and the state they lead to) by walking
+the trie of the vocabulary. The token automaton is stored as .npz under ~/.cache/llava/grammar, keyed by the
+grammar and the vocabulary. CadQueryLogitsProcessor masks every token the automaton does not allow, so the
+output always parses and always assigns `solid`, and EOS is only allowed at the end of a complete statement.
+
+Example:
+    automaton = load_cadquery_automaton(tokenizer)
+    model.generate(..., num_beams=num_beams, logits_processor=LogitsProcessorList([CadQueryLogitsProcessor(automaton, num_beams)]))
+"""
+
+import hashlib
+import os
+
+import numpy as np
+import torch
+from transformers import LogitsProcessor
+
+# Bump when the compilation changes, so stale automata are not loaded from the cache
+GRAMMAR_VERSION = 1
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "llava", "grammar")
+
+
+# Regular expressions as nested tuples, compiled by _compile_nfa
+def _lit(text):
+    return ("seq", tuple(("set", frozenset(c)) for c in text))
+
+
+def _set(chars):
+    return ("set", frozenset(chars))
+
+
+def _seq(*parts):
+    return ("seq", parts)
+
+
+def _alt(*parts):
+    return ("alt", parts)
+
+
+def _star(part):
+    return ("star", part)
+
+
+def _plus(part):
+    return _seq(part, _star(part))
+
+
+def _opt(part):
+    return _alt(part, ("seq", ()))
+
+
+def cadquery_grammar():
+    """Regular expression of the GenCAD-Code CadQuery scripts."""
+    digits = _plus(_set("0123456789"))
+    num = _seq(_opt(_lit("-")), digits, _opt(_seq(_lit("."), digits)), _opt(_seq(_lit("e"), _opt(_lit("-")), digits)))
+    point = _seq(num, _lit(", "), num)
+    vector = _seq(_lit("cq.Vector("), num, _lit(", "), num, _lit(", "), num, _lit(")"))
+
+    comment = _seq(_lit("# Generating a workplane for sketch "), digits, _lit("\n"))
+    workplane = _seq(_lit("wp_sketch"), digits, _lit(" = cq.Workplane(cq.Plane("),
+                     vector, _lit(", "), vector, _lit(", "), vector, _lit("))\n"))
+
+    segment = _alt(_seq(_lit(".lineTo("), point, _lit(")")),
+                   _seq(_lit(".threePointArc(("), point, _lit("), ("), point, _lit("))")))
+    loop = _seq(_lit("loop"), digits, _lit("=wp_sketch"), digits, _opt(_seq(_lit(".moveTo("), point, _lit(")"))),
+                _alt(_seq(_lit(".circle("), num, _lit(")")), _seq(_plus(segment), _lit(".close()"))), _lit("\n"))
+    extrude = _seq(_lit("solid"), digits, _lit("=wp_sketch"), digits, _plus(_seq(_lit(".add(loop"), digits, _lit(")"))),
+                   _lit(".extrude("), num, _opt(_lit(", both=True")), _lit(")\n"))
+
+    operand = _alt(_seq(_lit("solid"), digits), _lit("solid_temp"))
+    combine = _seq(_alt(_lit("solid"), _lit("solid_temp")), _lit("="),
+                   _alt(_seq(_lit("solid"), digits),
+                        _seq(_alt(_lit("solid"), _lit("solid_temp")), _lit("."),
+                             _alt(_lit("union"), _lit("cut"), _lit("intersect")), _lit("("), operand, _lit(")"))),
+                   _lit("\n"))
+
+    sketch = _seq(_opt(comment), workplane, _plus(loop), extrude)
+    # the first sketch assigns solid, the later ones are combined with it
+    return _seq(_opt(_lit(" ")), _lit("import cadquery as cq\n"),
+                sketch, _lit("solid=solid"), digits, _lit("\n"),
+                _star(_seq(sketch, _plus(combine))))
+
+
+def _compile_nfa(regex):
+    """Thompson construction, return (edges, start, accept) with edges[state] = [(chars or None, target)]."""
+    edges = []
+
+    def new_state():
+        edges.append([])
+        return len(edges) - 1
+
+    def build(node):
+        kind, arg = node
+        start, end = new_state(), new_state()
+        if kind == "set":
+            edges[start].append((arg, end))
+        elif kind == "seq":
+            current = start
+            for part in arg:
+                s, e = build(part)
+                edges[current].append((None, s))
+                current = e
+            edges[current].append((None, end))
+        elif kind == "alt":
+            for part in arg:
+                s, e = build(part)
+                edges[start].append((None, s))
+                edges[e].append((None, end))
+        elif kind == "star":
+            s, e = build(arg)
+            edges[start].append((None, s))
+            edges[start].append((None, end))
+            edges[e].append((None, s))
+            edges[e].append((None, end))
+        else:
+            raise ValueError(f"Unknown regular expression node: {kind}")
+        return start, end
+
+    start, accept = build(regex)
+    return edges, start, accept
+
+
+def compile_dfa(regex):
+    """
+    Subset construction of a regular expression, without the states that cannot reach the end of the text.
+
+    Returns (transitions, accepting): transitions[state] = {char: state}, state 0 is the initial state.
+    """
+    edges, start, accept = _compile_nfa(regex)
+
+    def closure(states):
+        stack, seen = list(states), set(states)
+        while stack:
+            for chars, target in edges[stack.pop()]:
+                if chars is None and target not in seen:
+                    seen.add(target)
+                    stack.append(target)
+        return frozenset(seen)
+
+    initial = closure([start])
+    index = {initial: 0}
+    subsets, transitions = [initial], [{}]
+    i = 0
+    while i < len(subsets):
+        moves = {}
+        for state in subsets[i]:
+            for chars, target in edges[state]:
+                if chars is not None:
+                    for c in chars:
+                        moves.setdefault(c, set()).add(target)
+        for c, targets in moves.items():
+            subset = closure(targets)
+            if subset not in index:
+                index[subset] = len(subsets)
+                subsets.append(subset)
+                transitions.append({})
+            transitions[i][c] = index[subset]
+        i += 1
+    accepting = [accept in subset for subset in subsets]
+
+    # keep the live states, so every allowed prefix can still be completed
+    live = {s for s, a in enumerate(accepting) if a}
+    changed = True
+    while changed:
+        changed = False
+        for s, moves in enumerate(transitions):
+            if s not in live and any(t in live for t in moves.values()):
+                live.add(s)
+                changed = True
+    remap = {s: i for i, s in enumerate(sorted(live))}
+    transitions = [{c: remap[t] for c, t in transitions[s].items() if t in remap} for s in sorted(live)]
+    accepting = [accepting[s] for s in sorted(live)]
+    return transitions, accepting
+
+
+def token_strings(tokenizer):
+    """Text of every token id when it is not the first of the output (None for the special and non ASCII tokens)."""
+    special_ids = set(tokenizer.all_special_ids)
+    strings = []
+    for token_id, token in enumerate(tokenizer.convert_ids_to_tokens(list(range(len(tokenizer))))):
+        if token_id in special_ids or token is None:
+            strings.append(None)
+        elif len(token) == 6 and token.startswith("<0x") and token.endswith(">"):
+            # sentencepiece byte fallback, "<0x0A>" is the newline of the Llama tokenizer
+            byte = int(token[3:5], 16)
+            strings.append(chr(byte) if byte < 128 else None)
+        elif "▁" in token:
+            strings.append(token.replace("▁", " "))
+        else:
+            strings.append(tokenizer.convert_tokens_to_string([token]))
+    return strings
+
+
+class TokenAutomaton:
+    """
+    Token-level automaton of a character DFA, in CSR layout.
+
+    The allowed tokens of state s are tokens[offsets[s]:offsets[s + 1]], leading to targets[...]
+    (-1 for the end of sequence tokens, only allowed in the accepting states).
+    """
+
+    def __init__(self, offsets, tokens, targets):
+        self.offsets = offsets
+        self.tokens = tokens
+        self.targets = targets
+        self.num_states = len(offsets) - 1
+        self._next = [None] * self.num_states
+        self._masks = {}
+
+    @classmethod
+    def build(cls, transitions, accepting, strings, eos_token_ids):
+        # trie of the vocabulary, node = (children, token ids ending at the node)
+        root = ({}, [])
+        for token_id, text in enumerate(strings):
+            if not text:
+                continue
+            node = root
+            for c in text:
+                node = node[0].setdefault(c, ({}, []))
+            node[1].append(token_id)
+
+        offsets, tokens, targets = [0], [], []
+        for state in range(len(transitions)):
+            allowed = {}
+            stack = [(root, state)]
+            while stack:
+                node, s = stack.pop()
+                for c, child in node[0].items():
+                    t = transitions[s].get(c)
+                    if t is None:
+                        continue
+                    for token_id in child[1]:
+                        allowed[token_id] = t
+                    stack.append((child, t))
+            if accepting[state]:
+                for token_id in eos_token_ids:
+                    allowed[token_id] = -1
+            for token_id in sorted(allowed):
+                tokens.append(token_id)
+                targets.append(allowed[token_id])
+            offsets.append(len(tokens))
+        return cls(np.array(offsets, dtype=np.int64), np.array(tokens, dtype=np.int64), np.array(targets, dtype=np.int64))
+
+    def save(self, path):
+        tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_path, offsets=self.offsets, tokens=self.tokens, targets=self.targets)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data["offsets"], data["tokens"], data["targets"])
+
+    def next_state(self, state, token_id):
+        """State after token_id, None when the token is not allowed."""
+        if self._next[state] is None:
+            lo, hi = self.offsets[state], self.offsets[state + 1]
+            self._next[state] = dict(zip(self.tokens[lo:hi].tolist(), self.targets[lo:hi].tolist()))
+        return self._next[state].get(token_id)
+
+    def mask(self, state, vocab_size, device):
+        """Boolean mask [vocab_size] of the tokens the state does not allow."""
+        key = (state, vocab_size, device)
+        if key not in self._masks:
+            mask = torch.ones(vocab_size, dtype=torch.bool, device=device)
+            allowed = torch.from_numpy(self.tokens[self.offsets[state]:self.offsets[state + 1]]).to(device)
+            mask[allowed[allowed < vocab_size]] = False
+            self._masks[key] = mask
+        return self._masks[key]
+
+
+def load_cadquery_automaton(tokenizer, cache_dir=DEFAULT_CACHE_DIR):
+    """Token automaton of the CadQuery grammar for tokenizer, compiled on first use and cached in cache_dir."""
+    regex = cadquery_grammar()
+    strings = token_strings(tokenizer)
+    eos_token_ids = [tokenizer.eos_token_id]
+    key = hashlib.sha1(
+        f"v{GRAMMAR_VERSION}\n{regex!r}\n{eos_token_ids}\n".encode("utf-8")
+        + "\0".join(s if s is not None else "\1" for s in strings).encode("utf-8")
+    ).hexdigest()
+    path = os.path.join(cache_dir, f"cadquery_{key}.npz")
+    if os.path.isfile(path):
+        try:
+            return TokenAutomaton.load(path)
+        except (OSError, ValueError, KeyError):
+            pass
+
+    transitions, accepting = compile_dfa(regex)
+    automaton = TokenAutomaton.build(transitions, accepting, strings, eos_token_ids)
+    os.makedirs(cache_dir, exist_ok=True)
+    automaton.save(path)
+    return automaton
+
+
+class CadQueryLogitsProcessor(LogitsProcessor):
+    """
+    Mask the tokens that would take the output out of the grammar of a TokenAutomaton.
+
+    The DFA state of every row is kept between steps and only advanced over the token generated since the
+    previous step. Pass the num_beams of generate: beam search reorders the rows, so with num_beams > 1 each
+    row takes the state of the previous row holding the same tokens. The states are reset when the batch size
+    changes or the input does not grow by one token (a new generate call), but use a new processor for every
+    generate call anyway. Rows that already emitted EOS are left as they are.
+    """
+
+    def __init__(self, automaton, num_beams=1):
+        self.automaton = automaton
+        self.num_beams = num_beams
+        self.prompt_length = None
+        self.row_states = None
+        self.seen_ids = None
+
+    def _reset(self, input_ids):
+        # with LLaVA, generate gets inputs_embeds and the input_ids only hold the new tokens
+        self.prompt_length = input_ids.shape[1]
+        self.row_states = [0] * input_ids.shape[0]
+
+    def _parents(self, input_ids):
+        """Row of the previous step every row continues."""
+        if self.num_beams == 1:
+            return range(input_ids.shape[0])
+        # [rows, previous rows], compared on the device
+        matches = (input_ids[:, None, self.prompt_length:-1] == self.seen_ids[None, :, self.prompt_length:]).all(dim=-1)
+        parents = matches.int().argmax(dim=1)
+        return [parent if found else -1 for parent, found in zip(parents.tolist(), matches.any(dim=1).tolist())]
+
+    def __call__(self, input_ids, scores):
+        if self.seen_ids is None or input_ids.shape[0] != self.seen_ids.shape[0] or input_ids.shape[1] != self.seen_ids.shape[1] + 1:
+            self._reset(input_ids)
+        else:
+            states = []
+            for parent, token in zip(self._parents(input_ids), input_ids[:, -1].tolist()):
+                state = self.row_states[parent] if parent >= 0 else -1
+                if state >= 0:
+                    state = self.automaton.next_state(state, token)
+                    if state is None:
+                        state = -1  # the token was forced past the processor, stop constraining the row
+                states.append(state)
+            self.row_states = states
+        self.seen_ids = input_ids
+
+        for row, state in enumerate(self.row_states):
+            if state >= 0:
+                scores[row].masked_fill_(self.automaton.mask(state, scores.shape[-1], scores.device), float("-inf"))
+        return scores
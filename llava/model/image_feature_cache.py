@@ -0,0 +1,68 @@
+"""
+LRU cache of the projected image features (vision tower + mm_projector outputs).
+
+Multi-sample decoding, regenerate in the web demo and every turn of a cli.py session run
+prepare_inputs_labels_for_multimodal on the same image again. Features are keyed by a hash of the
+preprocessed pixels (which already reflect the resize / pad / anyres crop of the image) and the
+preprocessing mode, and kept on the model device until the memory budget is exceeded.
+
+The cache is only used without autograd, so training always runs the vision tower and the projector.
+
+Example:
+    model.enable_image_feature_cache(max_memory_mb=512)
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+import torch
+
+
+class ImageFeatureCache:
+
+    def __init__(self, max_memory_mb=512):
+        self.max_bytes = int(max_memory_mb * 1024 ** 2)
+        self.entries = OrderedDict()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()  # the model worker generates from several threads
+
+    @staticmethod
+    def key(image, mode=""):
+        """Hash of a preprocessed image [C, H, W] (any dtype) and the preprocessing mode."""
+        h = hashlib.sha1(f"{mode}|{tuple(image.shape)}|{image.dtype}|".encode("utf-8"))
+        # hashed as raw bytes, numpy has no bfloat16
+        h.update(image.detach().reshape(-1).contiguous().view(torch.uint8).cpu().numpy().tobytes())
+        return h.hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            features = self.entries.get(key)
+            if features is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return features
+
+    def put(self, key, features):
+        size = features.numel() * features.element_size()
+        with self.lock:
+            if key in self.entries or size > self.max_bytes:
+                return
+            self.entries[key] = features
+            self.num_bytes += size
+            # least recently used first
+            while self.num_bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.num_bytes -= evicted.numel() * evicted.element_size()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.num_bytes = 0
+
+    def stats(self):
+        return {"entries": len(self.entries), "memory_mb": self.num_bytes / 1024 ** 2, "hits": self.hits, "misses": self.misses}
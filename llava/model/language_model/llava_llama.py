@@ -69,6 +69,7 @@ def forward(
         image_sizes: Optional[List[List[int]]] = None,
         return_dict: Optional[bool] = None,
         cache_position: Optional[bool] = None,  # Add this parameter for compatibility
+        prompt_prefix: Optional[Tuple[str, int]] = None,
     ) -> Union[Tuple, CausalLMOutputWithPast]:
 
         if inputs_embeds is None:
@@ -89,6 +90,17 @@ def forward(
                 image_sizes
             )
 
+        if prompt_prefix is not None and inputs_embeds is not None and labels is None:
+            # prefill from the cached KV of the text before the image, the logits only cover the other positions
+            prefix = self.fill_prompt_prefix(super().forward, prompt_prefix, inputs_embeds, attention_mask, past_key_values)
+            if prefix is not None:
+                past_key_values, length = prefix
+                inputs_embeds = inputs_embeds[:, length:]
+                if position_ids is not None:
+                    position_ids = position_ids[:, length:]
+                if cache_position is not None:
+                    cache_position = cache_position[length:]
+
         return super().forward(
             input_ids=input_ids,
             attention_mask=attention_mask,
@@ -116,7 +128,9 @@ def generate(
         if "inputs_embeds" in kwargs:
             raise NotImplementedError("`inputs_embeds` is not supported")
 
-
+        prompt_prefix = self.prompt_prefix(inputs, attention_mask) if images is not None else None
+        if prompt_prefix is not None:
+            kwargs["prompt_prefix"] = prompt_prefix
 
         if images is not None:
             (
@@ -149,9 +163,13 @@ def prepare_inputs_for_generation(self, input_ids, past_key_values=None,
                                       inputs_embeds=None, **kwargs):
         images = kwargs.pop("images", None)
         image_sizes = kwargs.pop("image_sizes", None)
+        prompt_prefix = kwargs.pop("prompt_prefix", None)
         inputs = super().prepare_inputs_for_generation(
             input_ids, past_key_values=past_key_values, inputs_embeds=inputs_embeds, **kwargs
         )
+        if prompt_prefix is not None and inputs.get('inputs_embeds') is not None:
+            # prefill step only
+            inputs['prompt_prefix'] = prompt_prefix
         if images is not None:
             inputs['images'] = images
         if image_sizes is not None:
@@ -20,6 +20,8 @@
 
 from .multimodal_encoder.builder import build_vision_tower
 from .multimodal_projector.builder import build_vision_projector
+from .image_feature_cache import ImageFeatureCache
+from .prefix_cache import PrefixKVCache
 
 from llava.constants import IGNORE_INDEX, IMAGE_TOKEN_INDEX, DEFAULT_IMAGE_PATCH_TOKEN, DEFAULT_IM_START_TOKEN, DEFAULT_IM_END_TOKEN
 
@@ -137,10 +139,89 @@ def get_model(self):
     def get_vision_tower(self):
         return self.get_model().get_vision_tower()
 
+    def enable_image_feature_cache(self, max_memory_mb=512):
+        """Reuse the projected features of images seen before (inference only), within max_memory_mb of device memory."""
+        self.image_feature_cache = ImageFeatureCache(max_memory_mb) if max_memory_mb > 0 else None
+        return self.image_feature_cache
+
     def encode_images(self, images):
-        image_features = self.get_model().get_vision_tower()(images)
-        image_features = self.get_model().mm_projector(image_features)
-        return image_features
+        cache = getattr(self, 'image_feature_cache', None)
+        if cache is None or torch.is_grad_enabled():
+            image_features = self.get_model().get_vision_tower()(images)
+            image_features = self.get_model().mm_projector(image_features)
+            return image_features
+
+        # only the images missing from the cache go through the vision tower, each distinct one once
+        mode = f"{getattr(self.config, 'image_aspect_ratio', 'square')}|{getattr(self.config, 'mm_vision_select_layer', '')}|{getattr(self.config, 'mm_vision_select_feature', 'patch')}"
+        keys = [cache.key(image, mode) for image in images]
+        features = {key: cache.get(key) for key in dict.fromkeys(keys)}
+        missing = [key for key, feature in features.items() if feature is None]
+        if len(missing) > 0:
+            new_images = torch.stack([images[keys.index(key)] for key in missing])
+            new_features = self.get_model().mm_projector(self.get_model().get_vision_tower()(new_images))
+            for key, feature in zip(missing, new_features):
+                features[key] = feature.clone()  # a view would keep the whole batch alive in the cache
+                cache.put(key, features[key])
+        return torch.stack([features[key] for key in keys])
+
+    def enable_prefix_cache(self, max_entries=16):
+        """Reuse the KV cache of the prompt text before the image across generate calls (see prefix_cache.py)."""
+        self.prefix_cache = PrefixKVCache(max_entries) if max_entries > 0 else None
+        return self.prefix_cache
+
+    def prompt_prefix(self, input_ids, attention_mask=None):
+        """
+        (key, length) of the tokens before the first image, when all rows share them without padding, else None.
+        """
+        cache = getattr(self, 'prefix_cache', None)
+        if cache is None or input_ids is None or input_ids.ndim != 2:
+            return None
+        if attention_mask is not None and not attention_mask.bool().all():
+            return None
+        image_positions = (input_ids[0] == IMAGE_TOKEN_INDEX).nonzero()
+        if len(image_positions) == 0 or image_positions[0].item() == 0:
+            return None
+        length = image_positions[0].item()
+        if not (input_ids[:, :length] == input_ids[:1, :length]).all():
+            return None
+        return cache.key(input_ids[0, :length]), length
+
+    def fill_prompt_prefix(self, forward, prompt_prefix, inputs_embeds, attention_mask, past_key_values):
+        """
+        Put the cached KV of the prompt prefix in past_key_values before a prefill (computing it with forward on a miss).
+
+        Returns (past_key_values, prefix length), or None when the prefix cannot be used for this call.
+        """
+        key, length = prompt_prefix
+        if past_key_values is None:
+            past_length = 0
+        elif hasattr(past_key_values, 'get_seq_length'):
+            past_length = past_key_values.get_seq_length()
+        else:
+            past_length = past_key_values[0][0].shape[-2]
+        # only the prefill, and only when splicing the images did not pad the rows
+        if past_length != 0 or inputs_embeds.shape[1] <= length:
+            return None
+        if attention_mask is not None and not attention_mask.bool().all():
+            return None
+
+        prefix = self.prefix_cache.get(key)
+        if prefix is None:
+            out = forward(inputs_embeds=inputs_embeds[:1, :length], use_cache=True, return_dict=True)
+            prefix = out.past_key_values
+            if hasattr(prefix, 'to_legacy_cache'):
+                prefix = prefix.to_legacy_cache()
+            prefix = tuple((k.detach(), v.detach()) for k, v in prefix)
+            self.prefix_cache.put(key, prefix)
+
+        batch_size = inputs_embeds.shape[0]
+        prefix = [tuple(x.expand(batch_size, -1, -1, -1) for x in layer) for layer in prefix]
+        if past_key_values is not None and hasattr(past_key_values, 'update'):
+            # the empty Cache object created by generate
+            for layer_idx, (k, v) in enumerate(prefix):
+                past_key_values.update(k, v, layer_idx)
+            return past_key_values, length
+        return tuple(prefix), length
 
     def prepare_inputs_labels_for_multimodal(
         self, input_ids, position_ids, attention_mask, past_key_values, labels,
@@ -0,0 +1,56 @@
+"""
+KV cache of the prompt text before the image.
+
+The CAD prompts are the same system prompt and "USER:" turn start followed by the image, so the keys and
+values of every token before the first IMAGE_TOKEN_INDEX are the same for all of them. They are computed
+once, keyed by a hash of the prefix token ids, and the prefill of generate only runs the image tokens and
+the text after them (which attend to the image, so they cannot be shared).
+
+Example:
+    model.enable_prefix_cache(max_entries=16)
+    model.generate(input_ids, images=..., ...)  # the prefix is looked up / stored automatically
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class PrefixKVCache:
+    """LRU of legacy KV caches (a (key, value) pair [1, heads, length, head_dim] per layer) of prompt prefixes."""
+
+    def __init__(self, max_entries=16):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()  # the model worker generates from several threads
+
+    @staticmethod
+    def key(prefix_ids):
+        """Hash of the prefix token ids [length]."""
+        return hashlib.sha1(prefix_ids.detach().cpu().long().numpy().tobytes()).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            past_key_values = self.entries.get(key)
+            if past_key_values is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return past_key_values
+
+    def put(self, key, past_key_values):
+        with self.lock:
+            self.entries[key] = past_key_values
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses}
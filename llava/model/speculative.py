@@ -0,0 +1,253 @@
+"""
+Speculative decoding for the LLaVA models.
+
+A cheap drafter proposes the next few tokens and the main model checks all of them in a single forward
+pass, so every pass yields between 1 and num_draft_tokens + 1 tokens. CadQuery programs repeat the same
+`cq.Workplane(cq.Plane(...))` / `.moveTo(...).lineTo(...)` chains over and over, so most drafts are accepted.
+
+Two drafters are available:
+    PromptLookupDrafter: copies what followed the last occurrence of the current n-gram in the prompt
+        and the generated tokens (no extra model).
+    DraftModelDrafter: a small causal LM sharing the tokenizer of the main model (text only, the images
+        are not shown to it).
+
+With greedy decoding the output is exactly the one of model.generate. With sampling the draft tokens go
+through the usual accept / resample rule, which preserves the distribution of the main model.
+Batch size 1 only.
+"""
+
+import torch
+import torch.nn.functional as F
+
+from llava.constants import IMAGE_TOKEN_INDEX
+
+
+def _crop_cache(past_key_values, length):
+    """Keep the first length positions of a KV cache (legacy tuples or transformers Cache)."""
+    if hasattr(past_key_values, "crop"):
+        past_key_values.crop(length)
+        return past_key_values
+    return tuple(tuple(x[..., :length, :] for x in layer) for layer in past_key_values)
+
+
+def _probs(logits, temperature, top_p):
+    """Sampling distribution of the logits [N, V] after temperature and nucleus filtering."""
+    probs = torch.softmax(logits.float() / temperature, dim=-1)
+    if top_p is not None and top_p < 1.0:
+        sorted_probs, sorted_idx = torch.sort(probs, dim=-1, descending=True)
+        # keep the smallest set of tokens whose mass reaches top_p (always at least the first one)
+        remove = sorted_probs.cumsum(dim=-1) - sorted_probs >= top_p
+        sorted_probs = sorted_probs.masked_fill(remove, 0.0)
+        probs = torch.zeros_like(probs).scatter(-1, sorted_idx, sorted_probs)
+        probs = probs / probs.sum(dim=-1, keepdim=True)
+    return probs
+
+
+class PromptLookupDrafter:
+    """Draft the tokens that followed the most recent earlier occurrence of the last n-gram (n from ngram_size down to 1)."""
+
+    def __init__(self, num_draft_tokens=10, ngram_size=3):
+        self.num_draft_tokens = num_draft_tokens
+        self.ngram_size = ngram_size
+
+    def reset(self, prompt_ids):
+        pass
+
+    def draft(self, tokens, temperature=0, top_p=None):
+        """Return the draft tokens and their draft distributions (None, the lookup is deterministic)."""
+        seq = torch.tensor(tokens)
+        for n in range(min(self.ngram_size, len(tokens) - 1), 0, -1):
+            windows = seq.unfold(0, n, 1)[:-1]  # every earlier n-gram, the last one is the query itself
+            matches = (windows == seq[-n:]).all(dim=1).nonzero().flatten()
+            if len(matches) > 0:
+                start = matches[-1].item() + n
+                return tokens[start:start + self.num_draft_tokens], None
+        return [], None
+
+    def rollback(self, length):
+        pass
+
+
+class DraftModelDrafter:
+    """Draft num_draft_tokens tokens with a small causal LM, which keeps its own KV cache across rounds."""
+
+    def __init__(self, draft_model, num_draft_tokens=5):
+        self.draft_model = draft_model
+        self.num_draft_tokens = num_draft_tokens
+        self.past_key_values = None
+        self.cache_length = 0
+
+    def reset(self, prompt_ids):
+        self.past_key_values = None
+        self.cache_length = 0
+
+    @torch.no_grad()
+    def draft(self, tokens, temperature=0, top_p=None):
+        device = self.draft_model.device
+        new_tokens = tokens[self.cache_length:]
+        draft_ids, draft_probs = [], []
+        for _ in range(self.num_draft_tokens):
+            out = self.draft_model(
+                input_ids=torch.tensor([new_tokens], device=device),
+                past_key_values=self.past_key_values,
+                use_cache=True,
+            )
+            self.past_key_values = out.past_key_values
+            self.cache_length += len(new_tokens)
+            logits = out.logits[0, -1:]
+            if temperature > 0:
+                probs = _probs(logits, temperature, top_p)
+                token = torch.multinomial(probs, 1).item()
+                draft_probs.append(probs[0])
+            else:
+                token = logits.argmax(dim=-1).item()
+            draft_ids.append(token)
+            new_tokens = [token]
+        # the last draft token is not in the cache yet, it is fed with the next round if accepted
+        return draft_ids, (torch.stack(draft_probs) if temperature > 0 else None)
+
+    def rollback(self, length):
+        """Forget the cached positions from length on (the rejected draft tokens)."""
+        if self.past_key_values is not None and self.cache_length > length:
+            self.past_key_values = _crop_cache(self.past_key_values, length)
+            self.cache_length = length
+
+
+@torch.no_grad()
+def speculative_generate(
+    model,
+    input_ids,
+    drafter,
+    images=None,
+    image_sizes=None,
+    max_new_tokens=128,
+    temperature=0,
+    top_p=None,
+    eos_token_id=None,
+    streamer=None,
+):
+    """
+    Generate with speculative decoding, for a single prompt.
+
+    Args:
+        model: LLaVA model (LlavaLlamaForCausalLM, ...), the images are spliced in as in model.generate.
+        input_ids (torch.Tensor): [1, L] prompt, with IMAGE_TOKEN_INDEX placeholders.
+        drafter: PromptLookupDrafter or DraftModelDrafter.
+        streamer: optional transformers streamer, fed like model.generate does.
+
+    Returns:
+        (output_ids [1, N] of the new tokens, stats dict with the acceptance metrics)
+    """
+    assert input_ids.shape[0] == 1, "speculative decoding supports batch size 1 only"
+    device = input_ids.device
+    if eos_token_id is None:
+        eos_token_id = model.generation_config.eos_token_id
+    eos_token_ids = set(eos_token_id if isinstance(eos_token_id, (list, tuple)) else [eos_token_id])
+
+    if images is not None:
+        _, _, _, _, inputs_embeds, _ = model.prepare_inputs_labels_for_multimodal(
+            input_ids, None, None, None, None, images, image_sizes=image_sizes
+        )
+    else:
+        inputs_embeds = model.get_model().embed_tokens(input_ids)
+    if streamer is not None:
+        streamer.put(input_ids.cpu())
+
+    # the drafters only see the text of the prompt
+    prompt_ids = input_ids[0][input_ids[0] != IMAGE_TOKEN_INDEX].tolist()
+    drafter.reset(prompt_ids)
+
+    # the text before the image is prefilled from the prefix KV cache when the model has one
+    prompt_prefix = model.prompt_prefix(input_ids) if images is not None and hasattr(model, "prompt_prefix") else None
+    out = model(inputs_embeds=inputs_embeds, use_cache=True, **({"prompt_prefix": prompt_prefix} if prompt_prefix is not None else {}))
+    past_key_values = out.past_key_values
+    cache_length = inputs_embeds.shape[1]
+    logits = out.logits[0, -1:]
+
+    def choose(logits):
+        if temperature > 0:
+            return torch.multinomial(_probs(logits, temperature, top_p), 1).item()
+        return logits.argmax(dim=-1).item()
+
+    generated = [choose(logits)]
+    stats = {"num_rounds": 0, "num_drafted": 0, "num_accepted": 0}
+    if streamer is not None:
+        streamer.put(torch.tensor([generated[-1]]))
+
+    while len(generated) < max_new_tokens and generated[-1] not in eos_token_ids:
+        draft_ids, draft_probs = drafter.draft(prompt_ids + generated, temperature, top_p)
+        draft_ids = draft_ids[:max_new_tokens - len(generated)]
+
+        # one pass of the main model over the last token and the drafts
+        out = model(
+            input_ids=torch.tensor([[generated[-1]] + draft_ids], device=device),
+            past_key_values=past_key_values,
+            use_cache=True,
+        )
+        logits = out.logits[0]  # logits[i] is the distribution after draft i (0: after the last token)
+
+        num_accepted = 0
+        if temperature > 0:
+            probs = _probs(logits, temperature, top_p)
+            next_token = None
+            for i, token in enumerate(draft_ids):
+                p = probs[i]
+                q = draft_probs[i, :p.shape[0]] if draft_probs is not None else F.one_hot(torch.tensor(token, device=p.device), p.shape[0]).float()
+                if torch.rand(()).item() < min(1.0, (p[token] / q[token].clamp_min(1e-10)).item()):
+                    num_accepted += 1
+                    continue
+                # rejected: resample from the part of p the draft did not cover
+                residual = (p - q).clamp_min(0)
+                next_token = torch.multinomial(residual / residual.sum(), 1).item() if residual.sum() > 0 else choose(logits[i:i + 1])
+                break
+            if next_token is None:
+                next_token = torch.multinomial(probs[num_accepted], 1).item()
+        else:
+            targets = logits.argmax(dim=-1).tolist()
+            while num_accepted < len(draft_ids) and draft_ids[num_accepted] == targets[num_accepted]:
+                num_accepted += 1
+            next_token = targets[num_accepted]
+
+        # keep the cache of the last token and the accepted drafts
+        cache_length += 1 + num_accepted
+        past_key_values = _crop_cache(out.past_key_values, cache_length)
+        new_tokens = draft_ids[:num_accepted] + [next_token]
+        drafter.rollback(len(prompt_ids) + len(generated) + num_accepted)
+
+        # stop at the first end of sequence token
+        for j, token in enumerate(new_tokens):
+            if token in eos_token_ids:
+                new_tokens = new_tokens[:j + 1]
+                break
+        new_tokens = new_tokens[:max_new_tokens - len(generated)]
+        generated.extend(new_tokens)
+        if streamer is not None:
+            streamer.put(torch.tensor(new_tokens))
+
+        stats["num_rounds"] += 1
+        stats["num_drafted"] += len(draft_ids)
+        stats["num_accepted"] += num_accepted
+
+    if streamer is not None:
+        streamer.end()
+
+    stats["num_new_tokens"] = len(generated)
+    stats["acceptance_rate"] = stats["num_accepted"] / stats["num_drafted"] if stats["num_drafted"] > 0 else 0.0
+    # tokens per forward pass of the main model, the prefill included
+    stats["tokens_per_pass"] = len(generated) / (stats["num_rounds"] + 1)
+    return torch.tensor([generated], device=device), stats
+
+
+def build_drafter(speculative, draft_model_path=None, num_draft_tokens=None, ngram_size=3, device="cuda"):
+    """Drafter for the --speculative option of the eval and serve scripts ("prompt_lookup" or "draft_model"), None for "none"."""
+    if speculative in (None, "none"):
+        return None
+    if speculative == "prompt_lookup":
+        return PromptLookupDrafter(num_draft_tokens or 10, ngram_size)
+    if speculative == "draft_model":
+        from transformers import AutoModelForCausalLM
+        if draft_model_path is None:
+            raise ValueError("--draft-model-path is required with --speculative draft_model")
+        draft_model = AutoModelForCausalLM.from_pretrained(draft_model_path, torch_dtype=torch.float16, low_cpu_mem_usage=True)
+        return DraftModelDrafter(draft_model.to(device).eval(), num_draft_tokens or 5)
+    raise ValueError(f"Unknown speculative decoding mode: {speculative}")
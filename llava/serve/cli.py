@@ -6,6 +6,7 @@
 from llava.model.builder import load_pretrained_model
 from llava.utils import disable_torch_init
 from llava.mm_utils import process_images, tokenizer_image_token, get_model_name_from_path
+from llava.model.speculative import build_drafter, speculative_generate
 
 from PIL import Image
 
@@ -29,7 +30,8 @@ def main(args):
     disable_torch_init()
 
     model_name = get_model_name_from_path(args.model_path)
-    tokenizer, model, image_processor, context_len = load_pretrained_model(args.model_path, args.model_base, model_name, args.load_8bit, args.load_4bit, device=args.device)
+    tokenizer, model, image_processor, context_len = load_pretrained_model(args.model_path, args.model_base, model_name, args.load_8bit, args.load_4bit, device=args.device, image_feature_cache_mb=args.image_cache_mb, prefix_cache_size=args.prefix_cache_size)
+    drafter = build_drafter(args.speculative, args.draft_model_path, args.num_draft_tokens, device=args.device)
 
     if "llama-2" in model_name.lower():
         conv_mode = "llava_llama_2"
@@ -93,21 +95,35 @@ def main(args):
         streamer = TextStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
 
         with torch.inference_mode():
-            output_ids = model.generate(
-                input_ids,
-                images=image_tensor,
-                image_sizes=[image_size],
-                do_sample=True if args.temperature > 0 else False,
-                temperature=args.temperature,
-                max_new_tokens=args.max_new_tokens,
-                streamer=streamer,
-                use_cache=True)
+            if drafter is not None:
+                output_ids, spec_stats = speculative_generate(
+                    model,
+                    input_ids,
+                    drafter,
+                    images=image_tensor,
+                    image_sizes=[image_size],
+                    temperature=args.temperature,
+                    max_new_tokens=args.max_new_tokens,
+                    eos_token_id=tokenizer.eos_token_id,
+                    streamer=streamer)
+            else:
+                output_ids = model.generate(
+                    input_ids,
+                    images=image_tensor,
+                    image_sizes=[image_size],
+                    do_sample=True if args.temperature > 0 else False,
+                    temperature=args.temperature,
+                    max_new_tokens=args.max_new_tokens,
+                    streamer=streamer,
+                    use_cache=True)
 
         outputs = tokenizer.decode(output_ids[0]).strip()
         conv.messages[-1][-1] = outputs
 
         if args.debug:
             print("\n", {"prompt": prompt, "outputs": outputs}, "\n")
+            if drafter is not None:
+                print(spec_stats, "\n")
 
 
 if __name__ == "__main__":
@@ -122,5 +138,10 @@ def main(args):
     parser.add_argument("--load-8bit", action="store_true")
     parser.add_argument("--load-4bit", action="store_true")
     parser.add_argument("--debug", action="store_true")
+    parser.add_argument("--speculative", type=str, default="none", choices=["none", "prompt_lookup", "draft_model"])
+    parser.add_argument("--draft-model-path", type=str, default=None)
+    parser.add_argument("--num-draft-tokens", type=int, default=None)
+    parser.add_argument("--prefix-cache-size", type=int, default=4, help="prompt prefixes (text before the image) whose KV cache is kept, 0 to disable")
+    parser.add_argument("--image-cache-mb", type=int, default=512, help="device memory for the features of the images already encoded, 0 to disable")
     args = parser.parse_args()
     main(args)
@@ -3,6 +3,7 @@
 """
 import argparse
 import asyncio
+import copy
 import json
 import time
 import threading
@@ -20,8 +21,10 @@
     pretty_print_semaphore)
 from llava.model.builder import load_pretrained_model
 from llava.mm_utils import process_images, load_image_from_base64, tokenizer_image_token
+from llava.model.speculative import build_drafter, speculative_generate
+from llava.model.cadquery_grammar import load_cadquery_automaton, CadQueryLogitsProcessor
 from llava.constants import IMAGE_TOKEN_INDEX, DEFAULT_IMAGE_TOKEN, DEFAULT_IM_START_TOKEN, DEFAULT_IM_END_TOKEN
-from transformers import TextIteratorStreamer
+from transformers import TextIteratorStreamer, LogitsProcessorList
 from threading import Thread
 
 
@@ -45,7 +48,9 @@ class ModelWorker:
     def __init__(self, controller_addr, worker_addr,
                  worker_id, no_register,
                  model_path, model_base, model_name,
-                 load_8bit, load_4bit, device, use_flash_attn=False):
+                 load_8bit, load_4bit, device, use_flash_attn=False,
+                 speculative="none", draft_model_path=None, num_draft_tokens=None, grammar="none",
+                 image_cache_mb=0, prefix_cache_size=0):
         self.controller_addr = controller_addr
         self.worker_addr = worker_addr
         self.worker_id = worker_id
@@ -63,8 +68,11 @@ def __init__(self, controller_addr, worker_addr,
         self.device = device
         logger.info(f"Loading the model {self.model_name} on worker {worker_id} ...")
         self.tokenizer, self.model, self.image_processor, self.context_len = load_pretrained_model(
-            model_path, model_base, self.model_name, load_8bit, load_4bit, device=self.device, use_flash_attn=use_flash_attn)
+            model_path, model_base, self.model_name, load_8bit, load_4bit, device=self.device, use_flash_attn=use_flash_attn,
+            image_feature_cache_mb=image_cache_mb, prefix_cache_size=prefix_cache_size)
         self.is_multimodal = 'llava' in self.model_name.lower()
+        self.drafter = build_drafter(speculative, draft_model_path, num_draft_tokens, device=self.device)
+        self.automaton = load_cadquery_automaton(self.tokenizer) if grammar == "cadquery" else None
 
         if not no_register:
             self.register_to_controller()
@@ -173,16 +181,33 @@ def generate_stream(self, params):
             yield json.dumps({"text": ori_prompt + "Exceeds max token length. Please start a new conversation, thanks.", "error_code": 0}).encode() + b"\0"
             return
 
-        thread = Thread(target=model.generate, kwargs=dict(
-            inputs=input_ids,
-            do_sample=do_sample,
-            temperature=temperature,
-            top_p=top_p,
-            max_new_tokens=max_new_tokens,
-            streamer=streamer,
-            use_cache=True,
-            **image_args
-        ))
+        # a request can opt out of the CadQuery grammar with "grammar": "none"
+        use_grammar = self.automaton is not None and params.get("grammar", "cadquery") == "cadquery"
+        if self.drafter is not None and not use_grammar:
+            # every request gets its own drafter state, the draft model itself is shared
+            thread = Thread(target=speculative_generate, kwargs=dict(
+                model=model,
+                input_ids=input_ids,
+                drafter=copy.copy(self.drafter),
+                temperature=temperature if do_sample else 0,
+                top_p=top_p,
+                max_new_tokens=max_new_tokens,
+                eos_token_id=tokenizer.eos_token_id,
+                streamer=streamer,
+                **image_args
+            ))
+        else:
+            thread = Thread(target=model.generate, kwargs=dict(
+                inputs=input_ids,
+                do_sample=do_sample,
+                temperature=temperature,
+                top_p=top_p,
+                max_new_tokens=max_new_tokens,
+                streamer=streamer,
+                use_cache=True,
+                logits_processor=LogitsProcessorList([CadQueryLogitsProcessor(self.automaton)]) if use_grammar else None,
+                **image_args
+            ))
         thread.start()
 
         generated_text = ori_prompt
@@ -268,6 +293,12 @@ async def get_status(request: Request):
     parser.add_argument("--load-8bit", action="store_true")
     parser.add_argument("--load-4bit", action="store_true")
     parser.add_argument("--use-flash-attn", action="store_true")
+    parser.add_argument("--speculative", type=str, default="none", choices=["none", "prompt_lookup", "draft_model"])
+    parser.add_argument("--draft-model-path", type=str, default=None)
+    parser.add_argument("--num-draft-tokens", type=int, default=None)
+    parser.add_argument("--grammar", type=str, default="none", choices=["none", "cadquery"])
+    parser.add_argument("--prefix-cache-size", type=int, default=16, help="prompt prefixes (system prompt and turns before the image) whose KV cache is kept, 0 to disable")
+    parser.add_argument("--image-cache-mb", type=int, default=512, help="device memory for the features of the images already encoded (regenerate, multi-turn), 0 to disable")
     args = parser.parse_args()
     logger.info(f"args: {args}")
 
@@ -284,5 +315,11 @@ async def get_status(request: Request):
                          args.load_8bit,
                          args.load_4bit,
                          args.device,
-                         use_flash_attn=args.use_flash_attn)
+                         use_flash_attn=args.use_flash_attn,
+                         speculative=args.speculative,
+                         draft_model_path=args.draft_model_path,
+                         num_draft_tokens=args.num_draft_tokens,
+                         grammar=args.grammar,
+                         image_cache_mb=args.image_cache_mb,
+                         prefix_cache_size=args.prefix_cache_size)
     uvicorn.run(app, host=args.host, port=args.port, log_level="info")
@@ -1,6 +1,7 @@
 import os
 import json
-import glob
+import hashlib
+import argparse
 from pathlib import Path
 import sys
 import re
@@ -8,6 +9,55 @@
 # Add the current directory to the path so we can import render_settings
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
+# Extensions picked up from test100_images, matched in a single pass over the directory tree
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tiff', '.tif')
+
+PROMPT = "Generate the CADQuery code needed to create the CAD for the provided image.\nJust the code, no other words."
+
+def scan_images(root):
+    """
+    Recursively list the images under root with os.scandir, whose directory entries already carry the stat.
+
+    Returns:
+        dict: {path: (size, mtime_ns)} sorted by path, keeping the first file of paths that only differ by case.
+    """
+    found = []
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif os.path.splitext(entry.name)[1] in IMAGE_EXTENSIONS:
+                    stat = entry.stat()
+                    found.append((entry.path, (stat.st_size, stat.st_mtime_ns)))
+    found.sort()
+
+    # Remove duplicates (case-insensitive), on the whole path since part folders reuse the view names
+    images = {}
+    seen_names = set()
+    for path, stat in found:
+        name = path.lower()
+        if name not in seen_names:
+            seen_names.add(name)
+            images[path] = stat
+    return images
+
+def file_hash(path):
+    """sha1 of the file content."""
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def print_paths(paths, limit=20):
+    """Print the first paths only, large render directories would flood the output."""
+    for path in paths[:limit]:
+        print(f"  - {path}")
+    if len(paths) > limit:
+        print(f"  ... and {len(paths) - limit} more")
+
 def group_images_by_part_folder(image_files):
     """
     Group images by part folder (e.g., part_000/isometric.png, part_000/front.png -> same part)
@@ -44,158 +94,183 @@ def group_images_by_part_filename(image_files):
     
     return part_groups
 
-def auto_generate_custom_dataset(cleanup_after=False, multi_view=False):
+def group_images(image_files):
+    """
+    Group the images by part for multi-view entries, parts and views sorted by name so the grouping
+    is the same on every run.
+
+    Returns:
+        (grouping, {part_id: image paths}), grouping is "folder" (PartPacker format) or "filename" (old format).
+    """
+    # First try to group by folder structure (new PartPacker format)
+    part_groups = group_images_by_part_folder(image_files)
+    grouping = "folder"
+    if not part_groups:
+        # Fallback to filename grouping (old format)
+        part_groups = group_images_by_part_filename(image_files)
+        grouping = "filename"
+    return grouping, {part_id: sorted(part_groups[part_id]) for part_id in sorted(part_groups)}
+
+def make_entry(question_id, images, multi_view):
+    if multi_view:
+        return {"question_id": question_id, "images": images, "text": PROMPT, "category": "multi_view", "ground_truth": ""}
+    return {"question_id": question_id, "image": images, "text": PROMPT, "category": "default", "ground_truth": ""}
+
+def load_manifest_index(index_path, multi_view):
+    """Index written by the previous run, or None if there is none or it was built in the other mode."""
+    try:
+        with open(index_path, 'r', encoding='utf-8') as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if index.get("multi_view") != multi_view:
+        return None
+    return index
+
+def save_manifest_index(index_path, index):
+    tmp_path = f"{index_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(index, f)
+    os.replace(tmp_path, index_path)
+
+def auto_generate_custom_dataset(cleanup_after=False, multi_view=False, incremental=False):
     """
     Automatically generates custom_test_images.jsonl from all images in test100_images folder.
     Creates one entry per image with the same prompt template.
     
+    A file index (path, size, mtime, content hash) is kept next to the JSONL in
+    custom_test_images.jsonl.index.json. With incremental=True only the new or changed images (or parts,
+    in multi-view mode) get entries, under new question IDs, and the question IDs of the other entries are
+    kept. The entries of changed images and of images that disappeared are dropped from the JSONL, a part
+    that lost some of its views gets a new entry.
+    
     Args:
         cleanup_after (bool): If True, deletes images after processing. If False, keeps images for pipeline.
         multi_view (bool): If True, groups images by part and creates multi-view entries.
+        incremental (bool): If True, updates the existing JSONL instead of regenerating it.
     """
     
-
-    
     # Define paths
     test_images_dir = "./inference/test100_images"
     output_file = "./inference/custom_test_images.jsonl"
+    index_path = f"{output_file}.index.json"
     
     # Check if test_images directory exists
     if not os.path.exists(test_images_dir):
         print(f"Error: Directory {test_images_dir} does not exist!")
         return
     
-    # Clear existing JSONL file first
-    if os.path.exists(output_file):
-        print(f"Clearing existing {output_file}...")
-        os.remove(output_file)
-    
-    # Get all image files (common image extensions)
-    image_extensions = ['*.png', '*.jpg', '*.jpeg', '*.bmp', '*.tiff', '*.tif']
-    image_files = []
-    
-    for ext in image_extensions:
-        image_files.extend(glob.glob(os.path.join(test_images_dir, "**", ext), recursive=True))
-    
-    # Remove duplicates (case-insensitive)
-    unique_files = []
-    seen_names = set()
-    for img_file in image_files:
-        img_name = os.path.basename(img_file).lower()
-        if img_name not in seen_names:
-            seen_names.add(img_name)
-            unique_files.append(img_file)
-    
-    image_files = unique_files
+    images = scan_images(test_images_dir)
+    image_files = list(images)
     
     if not image_files:
         print(f"No image files found in {test_images_dir}")
         return
     
-    # Sort files for consistent ordering
-    image_files.sort()
+    print(f"Found {len(image_files)} image files")
     
-    print(f"Found {len(image_files)} image files:")
-    for img_file in image_files:
-        print(f"  - {img_file}")
+    # The index of the previous run is loaded in both modes, its content hashes are reused
+    index = load_manifest_index(index_path, multi_view)
+    if incremental and (index is None or not os.path.exists(output_file)):
+        print(f"No usable index for {output_file}, generating it from scratch")
+    if index is None:
+        index = {"multi_view": multi_view, "grouping": None, "files": {}, "entries": {}, "next_id": 1}
+    if not incremental or not os.path.exists(output_file):
+        index["entries"] = {}
     
-    # Generate JSONL entries
-    entries = []
+    # Content hashes are only computed for the files whose size or mtime changed
+    changed_files = set()
+    files = {}
+    for img_file, (size, mtime_ns) in images.items():
+        rel_path = os.path.relpath(img_file, test_images_dir)
+        previous = index["files"].get(rel_path)
+        if previous is not None and previous[:2] == [size, mtime_ns]:
+            files[rel_path] = previous
+            continue
+        content_hash = file_hash(img_file)
+        if previous is None or previous[2] != content_hash:
+            changed_files.add(rel_path)
+        files[rel_path] = [size, mtime_ns, content_hash]
+    removed_files = sorted(set(index["files"]) - set(files))
     
+    # entry key -> image files, a key is a part ID in multi-view mode and the relative path otherwise
     if multi_view:
-        # First try to group by folder structure (new PartPacker format)
-        part_groups = group_images_by_part_folder(image_files)
-        
-        if part_groups:
-            print(f"\nGrouped into {len(part_groups)} parts by folder structure:")
-            
-            for i, (part_id, part_images) in enumerate(part_groups.items(), start=1):
-                # Sort images within each part
-                part_images.sort()
-                
-                print(f"  {part_id}: {len(part_images)} views")
-                for img_file in part_images:
-                    print(f"    - {os.path.relpath(img_file, test_images_dir)}")
-                
-                # Create multi-view entry with relative paths
-                entry = {
-                    "question_id": f"custom_{i:03d}",  # custom_001, custom_002, etc.
-                    "images": [os.path.relpath(img_file, test_images_dir) for img_file in part_images],  # Relative paths
-                    "text": "Generate the CADQuery code needed to create the CAD for the provided image.\nJust the code, no other words.",
-                    "category": "multi_view",
-                    "ground_truth": ""
-                }
-                entries.append(entry)
-        else:
-            # Fallback to filename grouping (old format)
-            part_groups = group_images_by_part_filename(image_files)
-            print(f"\nGrouped into {len(part_groups)} parts by filename:")
-            
-            for i, (part_id, part_images) in enumerate(part_groups.items(), start=1):
-                # Sort images within each part
-                part_images.sort()
-                
-                print(f"  {part_id}: {len(part_images)} views")
-                for img_file in part_images:
-                    print(f"    - {os.path.basename(img_file)}")
-                
-                # Create multi-view entry
-                entry = {
-                    "question_id": f"custom_{i:03d}",  # custom_001, custom_002, etc.
-                    "images": [os.path.basename(img_file) for img_file in part_images],  # Just filenames
-                    "text": "Generate the CADQuery code needed to create the CAD for the provided image.\nJust the code, no other words.",
-                    "category": "multi_view",
-                    "ground_truth": ""
-                }
-                entries.append(entry)
+        grouping, groups = group_images(image_files)
+        print(f"\nGrouped into {len(groups)} parts by {grouping}")
+        if index["grouping"] not in (None, grouping):
+            print(f"Grouping changed from {index['grouping']} to {grouping}, regenerating {output_file}")
+            index["entries"] = {}
+        index["grouping"] = grouping
+        # Relative paths with the folder structure, just filenames with the old format
+        to_entry_path = (lambda f: os.path.relpath(f, test_images_dir)) if grouping == "folder" else os.path.basename
     else:
-        # Single view per entry (original behavior)
-        for i, img_file in enumerate(image_files, start=1):
-            # Get relative path from test_images_dir
-            img_relative_path = os.path.relpath(img_file, test_images_dir)
-            
-            # Create entry
-            entry = {
-                "question_id": f"custom_{i:03d}",  # custom_001, custom_002, etc.
-                "image": img_relative_path,  # Relative path
-                "text": "Generate the CADQuery code needed to create the CAD for the provided image.\nJust the code, no other words.",
-                "category": "default",
-                "ground_truth": ""
-            }
-            entries.append(entry)
+        groups = {os.path.relpath(f, test_images_dir): [f] for f in image_files}
+        to_entry_path = lambda f: os.path.relpath(f, test_images_dir)
+    # keys that lost some of their images, grouped the same way as the images that are still there
+    removed_paths = [os.path.join(test_images_dir, rel_path) for rel_path in removed_files]
+    if multi_view:
+        removed_keys = set((group_images_by_part_folder if grouping == "folder" else group_images_by_part_filename)(removed_paths))
+    else:
+        removed_keys = set(removed_files)
+    changed_keys = [
+        key for key, key_files in groups.items()
+        if key not in index["entries"] or key in removed_keys
+        or any(os.path.relpath(f, test_images_dir) in changed_files for f in key_files)
+    ]
+    # question IDs whose lines are dropped from the JSONL: replaced by a new entry, or without images left
+    superseded = {index["entries"][key] for key in changed_keys if key in index["entries"]}
+    for key in [key for key in index["entries"] if key not in groups]:
+        superseded.add(index["entries"].pop(key))
+    
+    # Generate JSONL entries, from scratch or only for the new / changed keys
+    rewrite = len(index["entries"]) == 0
+    if rewrite:
+        index["next_id"] = 1
+    keys = list(groups) if rewrite else changed_keys
+    entries = []
+    for key in keys:
+        question_id = f"custom_{index['next_id']:03d}"  # custom_001, custom_002, etc.
+        index["next_id"] += 1
+        index["entries"][key] = question_id
+        entry_paths = [to_entry_path(f) for f in groups[key]]
+        entries.append(make_entry(question_id, entry_paths if multi_view else entry_paths[0], multi_view))
+    index["files"] = files
     
     # Write to JSONL file
-    with open(output_file, 'w', encoding='utf-8') as f:
-        for entry in entries:
-            f.write(json.dumps(entry) + '\n')
+    if rewrite or superseded:
+        if rewrite and os.path.exists(output_file):
+            print(f"Clearing existing {output_file}...")
+        tmp_path = f"{output_file}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            if not rewrite:
+                # the kept lines are copied as they are
+                with open(output_file, 'r', encoding='utf-8') as previous:
+                    for line in previous:
+                        if line.strip() and json.loads(line)["question_id"] not in superseded:
+                            f.write(line)
+            for entry in entries:
+                f.write(json.dumps(entry) + '\n')
+        os.replace(tmp_path, output_file)
+    else:
+        with open(output_file, 'a', encoding='utf-8') as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + '\n')
+    save_manifest_index(index_path, index)
     
-    print(f"\nSuccessfully generated {output_file} with {len(entries)} entries:")
-    for entry in entries:
-        if multi_view:
-            print(f"  - {entry['question_id']}: {len(entry['images'])} views")
-        else:
-            print(f"  - {entry['question_id']}: {entry['image']}")
+    if rewrite:
+        print(f"\nSuccessfully generated {output_file} with {len(entries)} entries:")
+    else:
+        print(f"\nAppended {len(entries)} new or changed entries to {output_file}, dropped {len(superseded)} "
+              f"superseded entries ({len(index['entries'])} in the index):")
+    print_paths([f"{entry['question_id']}: {len(entry['images'])} views" if multi_view else f"{entry['question_id']}: {entry['image']}" for entry in entries])
+    if removed_files and not rewrite:
+        print(f"{len(removed_files)} indexed images no longer exist, their entries were dropped or regenerated:")
+        print_paths(removed_files)
     
     # Only clear the test100_images folder if cleanup_after is True
     if cleanup_after:
         print(f"\nClearing {test_images_dir} folder...")
-        for img_file in image_files:
-            try:
-                os.remove(img_file)
-                print(f"  - Deleted: {os.path.relpath(img_file, test_images_dir)}")
-            except Exception as e:
-                print(f"  - Error deleting {os.path.relpath(img_file, test_images_dir)}: {e}")
-        
-        # Also remove empty folders
-        for root, dirs, files in os.walk(test_images_dir, topdown=False):
-            for dir_name in dirs:
-                dir_path = os.path.join(root, dir_name)
-                try:
-                    if not os.listdir(dir_path):  # If folder is empty
-                        os.rmdir(dir_path)
-                        print(f"  - Removed empty folder: {os.path.relpath(dir_path, test_images_dir)}")
-                except Exception as e:
-                    print(f"  - Error removing folder {os.path.relpath(dir_path, test_images_dir)}: {e}")
+        remove_images(image_files, test_images_dir)
         
         print(f"\n✅ Process complete! {len(image_files)} images processed and folder cleared.")
         print(f"📁 New images can now be added to {test_images_dir} for the next generation cycle.")
@@ -203,6 +278,28 @@ def auto_generate_custom_dataset(cleanup_after=False, multi_view=False):
         print(f"\n✅ Process complete! {len(image_files)} images processed.")
         print(f"📁 Images kept in {test_images_dir} for CAD generation pipeline.")
 
+def remove_images(image_files, test_images_dir):
+    """Delete the images, then the folders left empty."""
+    num_errors = 0
+    for img_file in image_files:
+        try:
+            os.remove(img_file)
+        except Exception as e:
+            num_errors += 1
+            print(f"  - Error deleting {os.path.relpath(img_file, test_images_dir)}: {e}")
+    print(f"  - Deleted {len(image_files) - num_errors} images")
+    
+    # Also remove empty folders
+    for root, dirs, files in os.walk(test_images_dir, topdown=False):
+        for dir_name in dirs:
+            dir_path = os.path.join(root, dir_name)
+            try:
+                if not os.listdir(dir_path):  # If folder is empty
+                    os.rmdir(dir_path)
+                    print(f"  - Removed empty folder: {os.path.relpath(dir_path, test_images_dir)}")
+            except Exception as e:
+                print(f"  - Error removing folder {os.path.relpath(dir_path, test_images_dir)}: {e}")
+
 def cleanup_images():
     """
     Cleanup function to delete images after the entire pipeline is completed.
@@ -214,37 +311,23 @@ def cleanup_images():
         return
     
     # Get all image files recursively
-    image_extensions = ['*.png', '*.jpg', '*.jpeg', '*.bmp', '*.tiff', '*.tif']
-    image_files = []
-    
-    for ext in image_extensions:
-        image_files.extend(glob.glob(os.path.join(test_images_dir, "**", ext), recursive=True))
+    image_files = list(scan_images(test_images_dir))
     
     if not image_files:
         print(f"No image files found in {test_images_dir}")
         return
     
     print(f"Cleaning up {len(image_files)} images from {test_images_dir}...")
-    for img_file in image_files:
-        try:
-            os.remove(img_file)
-            print(f"  - Deleted: {os.path.relpath(img_file, test_images_dir)}")
-        except Exception as e:
-            print(f"  - Error deleting {os.path.relpath(img_file, test_images_dir)}: {e}")
-    
-    # Also remove empty folders
-    for root, dirs, files in os.walk(test_images_dir, topdown=False):
-        for dir_name in dirs:
-            dir_path = os.path.join(root, dir_name)
-            try:
-                if not os.listdir(dir_path):  # If folder is empty
-                    os.rmdir(dir_path)
-                    print(f"  - Removed empty folder: {os.path.relpath(dir_path, test_images_dir)}")
-            except Exception as e:
-                print(f"  - Error removing folder {os.path.relpath(dir_path, test_images_dir)}: {e}")
+    remove_images(image_files, test_images_dir)
     
     print(f"✅ Cleanup complete! {len(image_files)} images deleted.")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate custom_test_images.jsonl from the images in inference/test100_images.")
+    parser.add_argument("--multi_view", action="store_true", help="Group the images by part into multi-view entries.")
+    parser.add_argument("--incremental", action="store_true", help="Only append the new or changed images to the existing JSONL.")
+    parser.add_argument("--cleanup_after", action="store_true", help="Delete the images once the JSONL is written.")
+    args = parser.parse_args()
+    
     # Default behavior: don't cleanup (for pipeline use), single view
-    auto_generate_custom_dataset(cleanup_after=False, multi_view=False)
+    auto_generate_custom_dataset(cleanup_after=args.cleanup_after, multi_view=args.multi_view, incremental=args.incremental)
@@ -0,0 +1,215 @@
+import ast
+import copy
+import hashlib
+import json
+import os
+import shutil
+
+from tessellation_cache import mesh_path_for, copy_mesh
+
+# Bump when the export settings change, so stale geometry is not served from the cache
+CACHE_VERSION = 5
+
+# Only deterministic outcomes are cached, timeouts and crashes may depend on the machine load
+CACHED_STATUSES = ("ok", "error")
+
+# Errors that depend on the limits of the run (--memory_mb, --cpu_seconds) or on the environment of the
+# worker rather than on the script, whether raised by the script or by the export
+RESOURCE_ERRORS = ("MemoryError", "CpuLimitExceeded", "ModuleNotFoundError", "ImportError", "OSError")
+
+def is_cacheable(result):
+    """Whether a result only depends on the script, so it can be reused by other runs and models."""
+    if result["status"] not in CACHED_STATUSES or result["error_type"] in RESOURCE_ERRORS:
+        return False
+    output = result["output"]
+    return output is None or output.get("export_error_type") not in RESOURCE_ERRORS
+
+def code_hash(code):
+    """
+    Hash of a script that ignores formatting: whitespace, comments and quote style all parse to the same AST.
+
+    Falls back to the stripped source when the code does not parse.
+    """
+    try:
+        normalized = ast.dump(ast.parse(code), annotate_fields=True, include_attributes=False)
+    except (SyntaxError, ValueError):
+        normalized = "\n".join(line.strip() for line in code.strip().splitlines())
+    return hashlib.sha256(f"v{CACHE_VERSION}\n{normalized}".encode("utf-8")).hexdigest()
+
+class CadCache:
+    """
+    Content-addressed cache of executed CAD scripts, keyed by code_hash.
+
+    Each entry stores the executor result (validity, errors) and the exported STL / STEP / point cloud files:
+        {root}/{key[:2]}/{key}/result.json
+        {root}/{key[:2]}/{key}/model.stl, model.step, model.mesh (tessellation), pc_{seed}.ply
+    Entries are written to a temporary directory and renamed in place, so concurrent runs can share a cache.
+    The cache is bounded by max_size_gb, least recently used entries are evicted first: every evict_every
+    writes, so an interrupted run cannot grow it without bound, and when evict is called at the end of a run.
+
+    Example:
+        cache = CadCache("./inference/cad_cache")
+        result = cache.restore(key, stl_path, step_path, pc_paths)
+        if result is None:
+            ... # execute, then
+            cache.put(key, result, stl_path, step_path, pc_paths)
+        cache.evict()
+    """
+
+    def __init__(self, root, max_size_gb=20, evict_every=256):
+        self.root = root
+        self.max_size = int(max_size_gb * 1024 ** 3)
+        self.evict_every = evict_every
+        self.num_puts = 0
+        os.makedirs(root, exist_ok=True)
+
+    def _entry_dir(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def restore(self, key, stl_path, step_path, pc_paths):
+        """Copy the cached files of key to the requested paths and return its result, or None on a miss."""
+        entry_dir = self._entry_dir(key)
+        result_path = os.path.join(entry_dir, "result.json")
+        try:
+            with open(result_path, "r", encoding="utf-8") as f:
+                result = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        output = result["output"]
+        if output is not None and output["valid_stl"]:
+            # every requested point cloud rep must be there, otherwise re-execute to sample the missing ones
+            if len(pc_paths) > 0 and not all(os.path.isfile(os.path.join(entry_dir, f"pc_{seed}.ply")) for _, seed in pc_paths):
+                return None
+            try:
+                shutil.copyfile(os.path.join(entry_dir, "model.stl"), stl_path)
+                shutil.copyfile(os.path.join(entry_dir, "model.step"), step_path)
+                if os.path.isdir(os.path.join(entry_dir, "model.mesh")):
+                    copy_mesh(os.path.join(entry_dir, "model.mesh"), mesh_path_for(stl_path))
+                for point_cloud_path, seed in pc_paths:
+                    shutil.copyfile(os.path.join(entry_dir, f"pc_{seed}.ply"), point_cloud_path)
+            except OSError: # evicted by a concurrent run
+                return None
+            output["valid_pc"] = len(pc_paths) > 0
+
+        os.utime(result_path) # mark as recently used
+        result["cached"] = True
+        result["seconds"] = 0.0
+        return result
+
+    def put(self, key, result, stl_path, step_path, pc_paths):
+        """Store the result of key together with the files it exported, unless it depends on the run (see is_cacheable)."""
+        if not is_cacheable(result):
+            return
+        entry_dir = self._entry_dir(key)
+        tmp_dir = f"{entry_dir}.{os.getpid()}.tmp"
+        os.makedirs(tmp_dir, exist_ok=True)
+        try:
+            output = result["output"]
+            if output is not None and output["valid_stl"]:
+                shutil.copyfile(stl_path, os.path.join(tmp_dir, "model.stl"))
+                shutil.copyfile(step_path, os.path.join(tmp_dir, "model.step"))
+                if os.path.isdir(mesh_path_for(stl_path)):
+                    shutil.copytree(mesh_path_for(stl_path), os.path.join(tmp_dir, "model.mesh"), dirs_exist_ok=True)
+                for point_cloud_path, seed in pc_paths:
+                    if os.path.isfile(point_cloud_path):
+                        shutil.copyfile(point_cloud_path, os.path.join(tmp_dir, f"pc_{seed}.ply"))
+            with open(os.path.join(tmp_dir, "result.json"), "w", encoding="utf-8") as f:
+                json.dump({k: v for k, v in result.items() if k not in ("seconds", "cached")}, f)
+
+            if os.path.isdir(entry_dir): # replaces an entry that lacked some point cloud reps
+                shutil.rmtree(entry_dir, ignore_errors=True)
+            os.rename(tmp_dir, entry_dir)
+        except OSError as e:
+            print(f"Could not cache {key}: {e}")
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+        self.num_puts += 1
+        if self.num_puts % self.evict_every == 0:
+            self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits in max_size_gb."""
+        entries = []
+        total_size = 0
+        for prefix in os.scandir(self.root):
+            if not prefix.is_dir():
+                continue
+            for entry in os.scandir(prefix.path):
+                if not entry.is_dir() or entry.name.endswith(".tmp"):
+                    continue
+                files = list(os.scandir(entry.path))
+                # the tessellation is a directory of .npy files
+                size = sum(f.stat().st_size if f.is_file() else _dir_size(f.path) for f in files)
+                last_used = max((f.stat().st_mtime for f in files if f.name == "result.json"), default=0)
+                entries.append((last_used, size, entry.path))
+                total_size += size
+
+        num_evicted = 0
+        for last_used, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total_size -= size
+            num_evicted += 1
+        if num_evicted > 0:
+            print(f"Evicted {num_evicted} entries from the CAD cache, {total_size / 1024 ** 3:.2f} GB left")
+
+def _dir_size(path):
+    return sum(os.path.getsize(os.path.join(dirpath, name)) for dirpath, _, names in os.walk(path) for name in names)
+
+def execute_with_cache(executor, jobs, cache=None):
+    """
+    Run (key, code, (stl_path, step_path, pc_paths)) jobs through a CadExecutor, skipping the cached programs.
+
+    Identical programs within the run are executed once too. Yields (key, result) like CadExecutor.run,
+    results served from the cache have result["cached"] = True.
+    """
+    if cache is None:
+        yield from executor.run(jobs)
+        return
+
+    pending = {}
+    for job in jobs:
+        h = code_hash(job[1])
+        result = cache.restore(h, *job[2])
+        if result is not None:
+            yield job[0], result
+        else:
+            pending.setdefault(h, []).append(job)
+    if len(pending) < sum(len(group) for group in pending.values()):
+        print(f"{sum(len(group) for group in pending.values()) - len(pending)} duplicate programs will be executed once")
+
+    for h, result in executor.run((h, group[0][1], group[0][2]) for h, group in pending.items()):
+        group = pending[h]
+        cache.put(h, result, *group[0][2])
+        yield group[0][0], result
+        for job in group[1:]:
+            yield job[0], cache.restore(h, *job[2]) or copy_outputs(result, group[0][2], job[2])
+
+def copy_outputs(result, source_paths, target_paths):
+    """
+    Result of a duplicate program that could not be restored from the cache (e.g. the entry was not stored),
+    with the exported files of the executed copy copied to its own paths. Files that are missing are reported invalid.
+    """
+    result = copy.deepcopy(result)
+    output = result["output"]
+    if output is None or not output["valid_stl"]:
+        return result
+    (stl_path, step_path, pc_paths), (dup_stl_path, dup_step_path, dup_pc_paths) = source_paths, target_paths
+    try:
+        shutil.copyfile(stl_path, dup_stl_path)
+        shutil.copyfile(step_path, dup_step_path)
+        if os.path.isdir(mesh_path_for(stl_path)):
+            copy_mesh(mesh_path_for(stl_path), mesh_path_for(dup_stl_path))
+    except OSError:
+        output["valid_stl"] = False
+        output["valid_pc"] = False
+        return result
+    num_copied = 0
+    for (point_cloud_path, _), (dup_point_cloud_path, _) in zip(pc_paths, dup_pc_paths):
+        if os.path.isfile(point_cloud_path):
+            shutil.copyfile(point_cloud_path, dup_point_cloud_path)
+            num_copied += 1
+    output["valid_pc"] = output["valid_pc"] and num_copied > 0
+    return result
@@ -0,0 +1,135 @@
+import importlib
+import resource
+import signal
+import time
+
+from worker_pool import TimeoutPool
+
+# Per-job limits, set once per worker by _init_worker
+_limits = {"cpu_seconds": None}
+
+class CpuLimitExceeded(Exception):
+    pass
+
+def _raise_cpu_limit(signum, frame):
+    raise CpuLimitExceeded(f"exceeded {_limits['cpu_seconds']}s of CPU time")
+
+def _cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+def _init_worker(preload_modules, cpu_seconds, memory_mb):
+    """Worker initializer: import the heavy modules once and install the resource limits."""
+    for module in preload_modules:
+        try:
+            importlib.import_module(module)
+        except ImportError: # the jobs will raise the ModuleNotFoundError themselves, with a proper result
+            pass
+    _limits["cpu_seconds"] = cpu_seconds
+    if cpu_seconds is not None:
+        signal.signal(signal.SIGXCPU, _raise_cpu_limit)
+    if memory_mb is not None:
+        # address space rather than RSS (RLIMIT_RSS is not enforced by Linux), allocations beyond it raise MemoryError
+        _, hard = resource.getrlimit(resource.RLIMIT_AS)
+        resource.setrlimit(resource.RLIMIT_AS, (memory_mb * 1024 * 1024, hard))
+
+def _set_cpu_limit(seconds):
+    # only the soft limit is moved, an unprivileged process could never raise the hard limit again
+    _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    soft = resource.RLIM_INFINITY if seconds is None else int(_cpu_time() + seconds) + 1
+    if hard != resource.RLIM_INFINITY and soft != resource.RLIM_INFINITY:
+        soft = min(soft, hard)
+    resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+
+def execute_job(job):
+    """
+    Run one job inside a worker. job is a (key, code, handler, handler_args) tuple.
+
+    The code is executed in a fresh namespace, so no global state is carried over from the previous job.
+    If handler is given, handler(namespace, *handler_args) is called afterwards (still under the limits)
+    and its return value is stored under "output", e.g. to export the resulting solid.
+    """
+    _, code, handler, handler_args = job
+    result = {"status": "ok", "error_type": None, "error": None, "output": None}
+    start = time.time()
+    cpu_start = _cpu_time()
+    try:
+        _set_cpu_limit(_limits["cpu_seconds"])
+        namespace = {"__name__": "__main__"}
+        exec(compile(code, "<generated>", "exec"), namespace)
+        if handler is not None:
+            result["output"] = handler(namespace, *handler_args)
+    except (Exception, SystemExit) as e: # SystemExit from the generated code is a failure too, Ctrl-C still stops the run
+        result["status"] = "error"
+        result["error_type"] = type(e).__name__
+        result["error"] = str(e)
+    finally:
+        _set_cpu_limit(None)
+    result["exec_seconds"] = time.time() - start
+    result["cpu_seconds"] = _cpu_time() - cpu_start
+    result["max_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return result
+
+class CadExecutor:
+    """
+    Sandboxed executor for model generated CAD code.
+
+    Workers are forked once and import cadquery (or any preload_modules) up front, so every job skips
+    the multi-second import. Each job gets a wall clock timeout, a CPU time limit and a memory limit.
+    A worker that times out, segfaults (e.g. in OCP) or is killed is respawned automatically.
+    With num_workers=0 the jobs run one after the other in the calling process, without any limit.
+
+    Example:
+        with CadExecutor(num_workers=8, timeout=60) as executor:
+            for key, result in executor.run((id_, code) for id_, code in zip(ids, codes)):
+                ...
+
+    Every result is a dict with:
+        status: "ok", "error" (the code raised, including CpuLimitExceeded / MemoryError), "timeout" or "crash"
+        error_type, error: exception class name and message (None when ok)
+        output: return value of the handler (None when no handler or not ok)
+        seconds: wall time including the round trip to the worker
+        exec_seconds, cpu_seconds, max_rss_mb: measured inside the worker (missing on timeout / crash)
+    """
+
+    def __init__(self, num_workers, timeout=60, cpu_seconds=None, memory_mb=4096, handler=None, preload_modules=("cadquery",)):
+        self.handler = handler
+        self.pool = None
+        if num_workers > 0:
+            self.pool = TimeoutPool(
+                execute_job, num_workers, timeout=timeout,
+                initializer=_init_worker, initargs=(tuple(preload_modules), cpu_seconds, memory_mb),
+            )
+
+    def _run_inline(self, tasks):
+        # num_workers=0: run in the calling process without limits, e.g. to debug a script
+        for task in tasks:
+            start = time.time()
+            yield task, "ok", execute_job(task), time.time() - start
+
+    def run(self, jobs):
+        """Execute (key, code) or (key, code, handler_args) jobs, yield (key, result) in completion order."""
+        tasks = ((job[0], job[1], self.handler, tuple(job[2]) if len(job) > 2 else ()) for job in jobs)
+        outcomes = self.pool.imap_unordered(tasks) if self.pool is not None else self._run_inline(tasks)
+        for task, status, result, seconds in outcomes:
+            if status == "ok":
+                result["seconds"] = seconds
+            else:
+                # the worker itself failed, result is the message from the pool
+                result = {"status": status, "error_type": status, "error": result, "output": None, "seconds": seconds}
+            yield task[0], result
+
+    def execute(self, code, *handler_args):
+        """Execute a single piece of code and return its result."""
+        for _, result in self.run([(None, code, handler_args)]):
+            return result
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
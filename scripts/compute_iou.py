@@ -1,75 +1,67 @@
 import cadquery as cq
-import numpy as np
 import os
-import json
+import sys
 import argparse
-from typing import Tuple, Union
-import shutil
+import csv
+from functools import lru_cache
+from multiprocessing import cpu_count
 from tqdm import tqdm
 
-def cq_align_shapes(source : cq.Workplane, target : cq.Workplane) -> Tuple[cq.Workplane, float]:
-    """Align source to target using the center of mass and the principal axes of inertia. also return normalized IOU"""
-    c_source = cq.Shape.centerOfMass(source.val())
-    c_target = cq.Shape.centerOfMass(target.val())
-
-    I_source = np.array(cq.Shape.matrixOfInertia(source.val()))
-    I_target = np.array(cq.Shape.matrixOfInertia(target.val()))
-
-    v_source = cq.Shape.computeMass(source.val())
-    v_target = cq.Shape.computeMass(target.val())
-
-    I_p_source, I_v_source = np.linalg.eigh(I_source)
-    I_p_target, I_v_target = np.linalg.eigh(I_target)
-
-    s_source = np.sqrt(np.abs(I_p_source).sum()/v_source)
-    s_target = np.sqrt(np.abs(I_p_target).sum()/v_target)
-
-    normalized_source = source.translate(-c_source).val().scale(1/s_source)
-    normalized_target = target.translate(-c_target).val().scale(1/s_target)
-
-    Rs = np.zeros((4,3,3))
-    Rs[0] = I_v_target @ I_v_source.T
-
-    for i in range(3):
-        # all possible 2 out of 3 permutations
-        alignment = 1 - 2 * np.array([i>0, (i+1)%2, i%3<=1])
-        Rs[i+1] = I_v_target @ (alignment[None,:] * I_v_source).T
-
-    best_IOU = 0.0
-    best_T = None
-    for i in range(4):
-        T = np.zeros([4,4])
-        T[:3,:3] = Rs[i]
-        T[-1,-1] = 1
-        
-        aligned_source = normalized_source.transformGeometry(cq.Matrix(T.tolist()))
-        
-        try:
-            intersect = aligned_source.intersect(normalized_target)
-            union = aligned_source.fuse(normalized_target)
-            
-            IOU = intersect.Volume() / union.Volume()
-        except: #handle cases where IOU is undefined
-            IOU = 0.0
-        
-        if IOU > best_IOU:
-            best_IOU = IOU
-            best_T = T
-
-    if best_T is not None:
-        aligned_source = normalized_source.transformGeometry(cq.Matrix(best_T.tolist())).scale(s_target).translate(c_target)
-        return cq.Workplane(aligned_source), best_IOU, c_source, c_target
-    else:
-        aligned_source = None
-        return aligned_source, best_IOU, c_source, c_target
-
-def find_image_by_question_id(jsonl_path, target_question_id):
-    with open(jsonl_path, "r", encoding="utf-8") as file:
-        for line in file:
-            data = json.loads(line)  # Parse JSON line
-            if data.get("question_id") == target_question_id:
-                return data.get("image")[:-6]  # Return the "image" field
-    return None  # Return None if not found
+from worker_pool import TimeoutPool
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from SolidAlign import cq_align_shapes, mass_properties, MassPropertyCache
+from llava.eval.jsonl_io import iter_jsonl
+
+RESULT_FIELDS = ["question_id", "orig_id", "status", "iou", "error", "seconds"]
+
+def build_image_index(jsonl_path):
+    """Map every question_id in the test set to its original ID, in a single pass over the JSONL."""
+    return {data["question_id"]: data["image"][:-6] for data in iter_jsonl(jsonl_path, keys=["question_id", "image"])}
+
+@lru_cache(maxsize=32)
+def load_gt_shape(gt_step_path, brep_cache_dir):
+    """Import a ground truth STEP, caching it as a BRep file (much faster to load) across runs."""
+    brep_path = os.path.join(brep_cache_dir, os.path.splitext(os.path.basename(gt_step_path))[0] + ".brep")
+    if os.path.isfile(brep_path) and os.path.getmtime(brep_path) >= os.path.getmtime(gt_step_path):
+        return cq.Workplane(cq.Shape.importBrep(brep_path))
+
+    gt_step = cq.importers.importStep(gt_step_path)
+    tmp_path = f"{brep_path}.{os.getpid()}.tmp"
+    gt_step.val().exportBrep(tmp_path)
+    os.replace(tmp_path, brep_path)
+    return gt_step
+
+_gt_props_cache = None
+
+def gt_mass_properties(gt_step_path, brep_cache_dir):
+    """Mass properties of a ground truth shape, cached by file hash in {brep_cache_dir}/mass_properties.json across runs."""
+    global _gt_props_cache
+    if _gt_props_cache is None:
+        _gt_props_cache = MassPropertyCache(lambda path: mass_properties(load_gt_shape(path, brep_cache_dir)),
+                                            os.path.join(brep_cache_dir, "mass_properties.json"))
+    num_cached = len(_gt_props_cache.cache)
+    props = _gt_props_cache.get(gt_step_path)
+    if len(_gt_props_cache.cache) > num_cached:
+        _gt_props_cache.save() # merged with the entries saved by the other workers
+    return props
+
+def evaluate_pair(task):
+    """Align a model generated STEP to its ground truth and return the IoU, runs in a worker process."""
+    question_id, orig_id, model_step_path, gt_step_path, brep_cache_dir = task
+    gt_step = load_gt_shape(gt_step_path, brep_cache_dir)
+    model_generated_step = cq.importers.importStep(model_step_path)
+    _, IOU, _, _ = cq_align_shapes(model_generated_step, gt_step,
+                                   source_props=mass_properties(model_generated_step),
+                                   target_props=gt_mass_properties(gt_step_path, brep_cache_dir))
+    return IOU
+
+def read_results(csv_path):
+    """Read the rows already written to the results CSV, keyed by question_id."""
+    if not os.path.isfile(csv_path):
+        return {}
+    with open(csv_path, "r", encoding="utf-8", newline="") as f:
+        return {row["question_id"]: row for row in csv.DictReader(f)}
 
 def average_non_none(values):
     filtered_values = [v for v in values if v is not None]
@@ -78,33 +70,59 @@ def average_non_none(values):
 
 
 # Write a main function that is called inside __main__
-def main(model_path, test_set_name):
+def main(model_path, test_set_name, num_workers=None, timeout=300, overwrite=False):
     model_name = model_path.split("/")[-1]
     model_generated_steps_dir = f"./inference/inference_results/{model_name}/{test_set_name}/model_step/"
     ground_truth_generated_steps_dir = "./inference/test100_gt_steps/"
+    brep_cache_dir = "./inference/test100_gt_breps/"
     test_jsonl = f"./inference/{test_set_name}.jsonl"
-    all_ious = []
-    gt_steps = []
-    model_steps = []
-    model_steps_aligned = []
-    # Add tqdm to below
-    for g in tqdm(os.listdir(model_generated_steps_dir)):
-        print(f"Processing: {g}")
+    results_csv = f"./inference/inference_results/{model_name}/{test_set_name}/cad_iou_results.csv"
+    os.makedirs(brep_cache_dir, exist_ok=True)
+
+    image_index = build_image_index(test_jsonl)
+
+    # Resume from the rows already written by a previous (possibly crashed) run
+    if overwrite and os.path.isfile(results_csv):
+        os.remove(results_csv)
+    results = read_results(results_csv)
+    if results:
+        print(f"Resuming: {len(results)} pairs already evaluated in {results_csv}")
+
+    tasks = []
+    for g in sorted(os.listdir(model_generated_steps_dir)):
+        if not g.endswith(".step"):
+            continue
         question_id = g[:-5]
-        orig_id = find_image_by_question_id(test_jsonl, int(question_id))
+        if question_id in results:
+            continue
+        orig_id = image_index.get(int(question_id))
         if orig_id == None:
             raise ValueError("Can't find original ID in test set")
-        
-        gt_step = cq.importers.importStep(ground_truth_generated_steps_dir + orig_id + ".step")
-        model_generated_step = cq.importers.importStep(model_generated_steps_dir + g)
-        gt_steps.append(gt_step)
-        model_steps.append(model_generated_step)
-        try:
-            aligned_model_generated, IOU, _, _ = cq_align_shapes(model_generated_step, gt_step)
-            model_steps_aligned.append(aligned_model_generated)
-            all_ious.append(IOU)
-        except: #fix:only gemini seemed to have this problem, added try except statement for gemini
-            print("issue")
+        tasks.append((question_id, orig_id, model_generated_steps_dir + g, ground_truth_generated_steps_dir + orig_id + ".step", brep_cache_dir))
+
+    num_workers = num_workers or cpu_count()
+    write_header = not os.path.isfile(results_csv)
+    with open(results_csv, "a", encoding="utf-8", newline="") as f, TimeoutPool(evaluate_pair, num_workers, timeout=timeout) as pool:
+        writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS)
+        if write_header:
+            writer.writeheader()
+        for task, status, result, seconds in tqdm(pool.imap_unordered(tasks), total=len(tasks)):
+            row = {
+                "question_id": task[0],
+                "orig_id": task[1],
+                "status": status,
+                "iou": result if status == "ok" else "",
+                "error": result if status != "ok" else "",
+                "seconds": f"{seconds:.2f}",
+            }
+            if status != "ok":
+                print(f"{task[0]}: {status} {result}")
+            writer.writerow(row)
+            f.flush() # a crash loses at most the pairs in flight
+            results[task[0]] = row
+
+    all_ious = [float(row["iou"]) for row in results.values() if row["status"] == "ok"]
+    num_failed = {status: sum(row["status"] == status for row in results.values()) for status in ["error", "timeout", "crash"]}
 
     print(f"Model's average IoU score: {average_non_none(all_ious)}")
     
@@ -114,6 +132,7 @@ def main(model_path, test_set_name):
         f.write(f"Test set: {test_set_name}\n")
         f.write(f"Average IoU: {average_non_none(all_ious)}\n")
         f.write(f"Number of valid steps: {len(all_ious)}\n")
+        f.write(f"Number of failed steps: {num_failed['error']} errors, {num_failed['timeout']} timeouts, {num_failed['crash']} crashes\n")
     return
 
 if __name__ == "__main__":
@@ -121,6 +140,9 @@ def main(model_path, test_set_name):
     parser = argparse.ArgumentParser(description="Compute model's IoU score.")
     parser.add_argument("--model_path", type=str, required=True, help="Model to compute IoU for.")
     parser.add_argument("--test_set_name", type=str, required=True, help="Name of the test set.")
+    parser.add_argument("--num_workers", type=int, default=None, help="Number of worker processes, defaults to the CPU count.")
+    parser.add_argument("--timeout", type=float, default=300, help="Timeout in seconds for a single pair.")
+    parser.add_argument("--overwrite", action="store_true", help="Discard the results of a previous run instead of resuming.")
     args = parser.parse_args()
 
-    main(args.model_path, args.test_set_name)
\ No newline at end of file
+    main(args.model_path, args.test_set_name, args.num_workers, args.timeout, args.overwrite)
\ No newline at end of file
@@ -0,0 +1,168 @@
+import numpy as np
+import os
+import argparse
+import csv
+from multiprocessing import Pool, cpu_count
+from tqdm import tqdm
+from scipy.spatial import cKDTree as KDTree
+
+from utils_generate_model import SAMPLER_VERSION, read_jsonl, read_ply, sample_point_clouds
+from tessellation_cache import DEFAULT_TOLERANCE, DEFAULT_ANGULAR_TOLERANCE, TessellationCache
+
+DEFAULT_THRESHOLDS = (0.01, 0.02, 0.05)
+
+def normalize_point_cloud(points):
+    """Center the point cloud on its bounding box and scale the longest side to 1."""
+    bmin, bmax = points.min(axis=0), points.max(axis=0)
+    return (points - (bmin + bmax) / 2) / max((bmax - bmin).max(), 1e-12)
+
+def point_cloud_metrics(pred, gt, gt_tree=None, thresholds=DEFAULT_THRESHOLDS):
+    """
+    Chamfer distance, F-score and Hausdorff distance between two point clouds.
+
+    The Chamfer distance follows DeepCAD: mean squared nearest neighbor distance in both directions, summed.
+    F-score@t is the harmonic mean of the fraction of pred points within t of gt (precision)
+    and the fraction of gt points within t of pred (recall).
+
+    Args:
+        pred (np.ndarray): [N, 3] predicted points.
+        gt (np.ndarray): [M, 3] ground truth points.
+        gt_tree (cKDTree, optional): prebuilt tree on gt, to reuse it across reps.
+        thresholds (tuple): distance thresholds of the F-scores.
+
+    Returns:
+        dict: chamfer, hausdorff and fscore@t for every threshold.
+    """
+    gt_tree = gt_tree if gt_tree is not None else KDTree(gt)
+    pred_to_gt, _ = gt_tree.query(pred, workers=1)
+    gt_to_pred, _ = KDTree(pred).query(gt, workers=1)
+
+    metrics = {
+        "chamfer": float(np.mean(np.square(pred_to_gt)) + np.mean(np.square(gt_to_pred))),
+        "hausdorff": float(max(pred_to_gt.max(), gt_to_pred.max())),
+    }
+    for t in thresholds:
+        precision = np.mean(pred_to_gt < t)
+        recall = np.mean(gt_to_pred < t)
+        metrics[f"fscore@{t}"] = float(2 * precision * recall / (precision + recall)) if precision + recall > 0 else 0.0
+    return metrics
+
+def gt_point_cloud_dir(gt_pc_dir_base, rep, n_points, tolerance=DEFAULT_TOLERANCE, angular_tolerance=DEFAULT_ANGULAR_TOLERANCE):
+    """Directory of the cached GT point clouds of a rep, keyed by everything that changes the sampled points."""
+    return f"{gt_pc_dir_base}_{rep}/n{n_points}_s{SAMPLER_VERSION}_t{tolerance}_a{angular_tolerance}"
+
+def load_gt_point_clouds(orig_id, reps, gt_step_dir, gt_mesh_dir, gt_pc_dir_base, n_points, tolerance=DEFAULT_TOLERANCE, angular_tolerance=DEFAULT_ANGULAR_TOLERANCE):
+    """
+    Load the GT point clouds of the reps, sampling the missing ones from the cached GT tessellation the same way as the model outputs.
+
+    A cached point cloud is re-sampled when it is older than the GT STEP file, the sampling parameters are part of its path.
+    """
+    step_path = f"{gt_step_dir}/{orig_id}.step"
+    step_mtime = os.path.getmtime(step_path)
+    pc_paths = [f"{gt_point_cloud_dir(gt_pc_dir_base, rep, n_points, tolerance, angular_tolerance)}/{orig_id}.ply" for rep in reps]
+    missing = [(rep, pc_path) for rep, pc_path in zip(reps, pc_paths) if not os.path.isfile(pc_path) or os.path.getmtime(pc_path) < step_mtime]
+    if len(missing) > 0:
+        # cadquery is only imported when the GT STEP has not been tessellated yet
+        vertices, faces = TessellationCache(gt_mesh_dir, tolerance, angular_tolerance).get(step_path)
+        tmp_paths = [f"{pc_path}.{os.getpid()}.tmp" for _, pc_path in missing]
+        sample_point_clouds(vertices, faces, tmp_paths, n_points, [42+rep for rep, _ in missing])
+        for tmp_path, (_, pc_path) in zip(tmp_paths, missing):
+            os.replace(tmp_path, pc_path)
+    return [read_ply(pc_path) for pc_path in pc_paths]
+
+def evaluate_sample(task):
+    """Compute the metrics of every rep of one generated model, runs in a worker process."""
+    question_id, orig_id, pred_paths, gt_args, thresholds, normalize = task
+    rows = []
+    try:
+        gts = load_gt_point_clouds(orig_id, [rep for rep, _ in pred_paths], *gt_args)
+    except Exception as e:
+        return [{"question_id": question_id, "orig_id": orig_id, "rep": rep, "error": f"{type(e).__name__}: {e}"} for rep, _ in pred_paths]
+    for (rep, pred_path), gt in zip(pred_paths, gts):
+        row = {"question_id": question_id, "orig_id": orig_id, "rep": rep}
+        try:
+            pred = read_ply(pred_path)
+            if normalize:
+                pred, gt = normalize_point_cloud(pred), normalize_point_cloud(gt)
+            row.update(point_cloud_metrics(pred, gt, thresholds=thresholds))
+            row["error"] = ""
+        except Exception as e:
+            row["error"] = f"{type(e).__name__}: {e}"
+        rows.append(row)
+    return rows
+
+def main(model_path, test_set_name, pc_reps, num_workers=None, thresholds=DEFAULT_THRESHOLDS, normalize=False, n_points=2000):
+    model_name = model_path.split("/")[-1]
+    result_dir = f"./inference/inference_results/{model_name}/{test_set_name}"
+    pc_dir_base = f"{result_dir}/model_point_cloud"
+    gt_step_dir = "./inference/test100_gt_steps"
+    gt_mesh_dir = "./inference/test100_gt_mesh"
+    gt_pc_dir_base = "./inference/test100_gt_point_cloud"
+    test_jsonl = f"./inference/{test_set_name}.jsonl"
+    os.makedirs(gt_mesh_dir, exist_ok=True)
+    for i in range(pc_reps):
+        os.makedirs(gt_point_cloud_dir(gt_pc_dir_base, i, n_points), exist_ok=True)
+
+    test_question_ids, test_images = read_jsonl(test_jsonl, "question_id", "image")
+    image_index = {q: image[:-6] for q, image in zip(test_question_ids, test_images)}
+
+    # one task per generated model, covering all of its reps so the GT is looked up once
+    question_ids = sorted({f[:-4] for i in range(pc_reps) if os.path.isdir(f"{pc_dir_base}_{i}") for f in os.listdir(f"{pc_dir_base}_{i}") if f.endswith(".ply")})
+    gt_args = (gt_step_dir, gt_mesh_dir, gt_pc_dir_base, n_points)
+    tasks = []
+    for question_id in question_ids:
+        orig_id = image_index.get(int(question_id))
+        if orig_id == None:
+            raise ValueError("Can't find original ID in test set")
+        pred_paths = [(i, f"{pc_dir_base}_{i}/{question_id}.ply") for i in range(pc_reps) if os.path.isfile(f"{pc_dir_base}_{i}/{question_id}.ply")]
+        tasks.append((question_id, orig_id, pred_paths, gt_args, tuple(thresholds), normalize))
+
+    metric_names = ["chamfer", "hausdorff"] + [f"fscore@{t}" for t in thresholds]
+    num_workers = num_workers or cpu_count()
+    rows = []
+    with Pool(num_workers) as pool:
+        for sample_rows in tqdm(pool.imap_unordered(evaluate_sample, tasks, chunksize=4), total=len(tasks), desc="Computing point cloud metrics"):
+            rows.extend(sample_rows)
+    rows.sort(key=lambda row: (int(row["question_id"]), row["rep"]))
+
+    with open(f"{result_dir}/pc_metrics_results.csv", "w", encoding="utf-8", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=["question_id", "orig_id", "rep"] + metric_names + ["error"])
+        writer.writeheader()
+        writer.writerows(rows)
+
+    # average over the reps of each model first, so every model counts once
+    per_model = {}
+    for row in rows:
+        if row["error"] == "":
+            per_model.setdefault(row["question_id"], []).append([row[m] for m in metric_names])
+    per_model = np.array([np.mean(v, axis=0) for v in per_model.values()]).reshape(-1, len(metric_names))
+    num_failed = sum(row["error"] != "" for row in rows)
+    if num_failed > 0:
+        print(f"Number of failed point clouds: {num_failed}")
+
+    with open(f"{result_dir}/pc_metrics_results.txt", "w", encoding="utf-8") as f:
+        f.write(f"Model: {model_name}\n")
+        f.write(f"Test set: {test_set_name}\n")
+        for j, m in enumerate(metric_names):
+            mean_value = float(per_model[:, j].mean()) if len(per_model) > 0 else None
+            print(f"Model's average {m}: {mean_value}")
+            f.write(f"Average {m}: {mean_value}\n")
+        median_chamfer = float(np.median(per_model[:, 0])) if len(per_model) > 0 else None
+        f.write(f"Median chamfer: {median_chamfer}\n")
+        f.write(f"Number of models with point clouds: {len(per_model)}\n")
+        f.write(f"Number of failed point clouds: {num_failed}\n")
+    return
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Compute model's point cloud Chamfer distance, F-score and Hausdorff distance.")
+    parser.add_argument("--model_path", type=str, required=True, help="Model to compute the metrics for.")
+    parser.add_argument("--test_set_name", type=str, required=True, help="Name of the test set.")
+    parser.add_argument("--pc_reps", type=int, required=True, help="Number of reps of point cloud generation, as passed to generate_model_cad.py.")
+    parser.add_argument("--num_workers", type=int, default=None, help="Number of worker processes, defaults to the CPU count.")
+    parser.add_argument("--thresholds", type=float, nargs="+", default=list(DEFAULT_THRESHOLDS), help="Distance thresholds of the F-scores.")
+    parser.add_argument("--normalize", action="store_true", help="Normalize both point clouds to a unit bounding box before comparing.")
+    parser.add_argument("--n_points", type=int, default=2000, help="Number of points sampled for the ground truth point clouds.")
+    args = parser.parse_args()
+
+    main(args.model_path, args.test_set_name, args.pc_reps, args.num_workers, args.thresholds, args.normalize, args.n_points)
@@ -31,6 +31,7 @@ class MultiViewConfig:
     image_resolution: tuple = (800, 600)
     image_format: str = 'png'
     image_quality: int = 95
+    composite_workers: Optional[int] = None  # part directories assembled in parallel, defaults to the CPU count
     
     # PartPacker specific settings
     partpacker_output_dir: str = "./inference/test_partpacker_images"
@@ -41,6 +42,7 @@ class MultiViewConfig:
     renderer_style: str = 'technical'  # 'technical', 'blueprint', 'modern'
     renderer_background: str = 'white'
     renderer_line_width: int = 2
+    render_workers: Optional[int] = None  # parts rendered in parallel, defaults to the CPU count
     
     # Output directories
     output_dir: str = "./inference/rendered_images"
@@ -62,12 +64,14 @@ def to_dict(self) -> Dict[str, Any]:
             'image_resolution': self.image_resolution,
             'image_format': self.image_format,
             'image_quality': self.image_quality,
+            'composite_workers': self.composite_workers,
             'partpacker_output_dir': self.partpacker_output_dir,
             'partpacker_enable_3d': self.partpacker_enable_3d,
             'partpacker_enable_2d': self.partpacker_enable_2d,
             'renderer_style': self.renderer_style,
             'renderer_background': self.renderer_background,
             'renderer_line_width': self.renderer_line_width,
+            'render_workers': self.render_workers,
             'output_dir': self.output_dir,
             'composite_dir': self.composite_dir
         }
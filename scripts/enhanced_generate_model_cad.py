@@ -7,11 +7,14 @@
 import argparse
 from utils_generate_model import *
 import os
+import csv
 import pandas as pd
 from multiprocessing import Pool, cpu_count
 from tqdm import tqdm
-import time
-import re
+
+from cad_executor import CadExecutor
+from cad_cache import CadCache, execute_with_cache
+from generate_model_cad import RESULT_COLUMNS, build_job, estimate_cost, process_cad, progress_to_dataframe, read_progress
 
 # Import multi-view manager
 from multi_view_manager import MultiViewManager
@@ -19,80 +22,19 @@
 
 ROOT_CHECKPOINT_DIR = "./inference/inference_results"
 
-def wait_for_file(file_path, timeout=2, check_interval=0.1):
-    """Waits for a file to exist for a limited time."""
-    start_time = time.time()
-    while time.time() - start_time < timeout:
-        if os.path.isfile(file_path):
-            return True
-        time.sleep(check_interval)
-    return False
-
-def process_cad_with_images(args_tuple):
-    """Function to write and run a single Python script with optional image generation."""
-    code, id_, code_dir, stl_dir, step_dir, pc_dir_base, pc_reps, code_language, multi_view_config = args_tuple
-    
-    print(f"Processing {id_}...")
-    
-    if "```python" in code:
-        code = re.sub(r"```[a-zA-Z]*\n|```", "", code)
+IMAGE_RESULT_COLUMNS = RESULT_COLUMNS + ["model_valid_images"]
 
-    # Check if the code can be run
-    file_path = f"{code_dir}/{id_}.py"
-    write_python_file(code, file_path)
-    print(f"  Testing basic code execution for {id_}...")
-    valid_code = run_python_script(file_path)
-    print(f"  Basic code execution result for {id_}: {valid_code}")
-    
-    valid_stl = False
-    valid_pc = False
-    valid_images = False
-    
-    if valid_code:
-        print(f"  Adding export code for {id_}...")
-        
-        # Add export code based on language
-        if code_language == "pythonocc":
-            code += f"\nwrite_stl_file(body, \"{stl_dir}/{id_}.stl\")"
-            raise ValueError("Implement STEP generation")
-        elif code_language == "cadquery":
-            code += f"\nimport cadquery as cq\ncq.exporters.export(solid, \"{stl_dir}/{id_}.stl\")\n"
-            code += f"\nimport cadquery as cq\ncq.exporters.export(solid, \"{step_dir}/{id_}.step\")\n"
-        else:
-            raise TypeError("CAD code language not supported!")
-        
-        write_python_file(code, f"{code_dir}/{id_}.py")
-        print(f"  Testing STL generation for {id_}...")
-        valid_stl = run_python_script(f"{code_dir}/{id_}.py")
-        print(f"  STL generation result for {id_}: {valid_stl}")
-        
-        if not wait_for_file(f"{stl_dir}/{id_}.stl"):
-            valid_stl = False
-            print(f"  STL file not found for {id_}")
-        
-        # Generate point clouds if enabled
-        if valid_stl and pc_reps > 0:
-            print(f"  Generating point clouds for {id_}...")
-            for i in range(pc_reps):
-                try:
-                    out_pc = convert_stl_to_point_cloud(f"{stl_dir}/{id_}.stl", f"{pc_dir_base}_{i}/{id_}.ply", 2000, seed=42+i)
-                    if os.path.isfile(f"{pc_dir_base}_{i}/{id_}.ply"):
-                        valid_pc = True
-                except Exception as e:
-                    print(f"{id_} failed point cloud generation: {e}")
-        
-        # Generate images if multi-view is enabled
-        if valid_stl and multi_view_config and multi_view_config.enable_multi_view:
-            print(f"  Generating images for {id_}...")
-            try:
-                valid_images = generate_images_for_part(id_, step_dir, multi_view_config)
-                print(f"  Image generation result for {id_}: {valid_images}")
-            except Exception as e:
-                print(f"{id_} failed image generation: {e}")
-                valid_images = False
-
-    print(f"Completed processing {id_}: code={valid_code}, stl={valid_stl}, pc={valid_pc}, images={valid_images}")
-    return valid_code, valid_stl, valid_pc, valid_images, id_
+def generate_images_task(args_tuple):
+    """Generate the multi-view images of one exported part, runs in a worker process."""
+    id_, step_dir, multi_view_config = args_tuple
+    print(f"  Generating images for {id_}...")
+    try:
+        valid_images = generate_images_for_part(id_, step_dir, multi_view_config)
+        print(f"  Image generation result for {id_}: {valid_images}")
+    except Exception as e:
+        print(f"{id_} failed image generation: {e}")
+        valid_images = False
+    return id_, valid_images
 
 def generate_images_for_part(part_id, step_dir, config):
     """Generate images for a specific part using the multi-view manager."""
@@ -106,11 +48,11 @@ def generate_images_for_part(part_id, step_dir, config):
         # Initialize multi-view manager
         manager = MultiViewManager(config)
         
-        # Process the single STEP file
-        processed_files = manager.process_renderer_images(step_dir)
+        # Process only this part's STEP file, not the whole directory
+        processed_files = manager.process_renderer_images(step_dir, part_names=[str(part_id)])
         
         # Check if images were generated for this part
-        part_images = [f for f in processed_files if part_id in f]
+        part_images = [f for f in processed_files if os.path.basename(os.path.dirname(f)) == str(part_id)]
         
         return len(part_images) > 0
         
@@ -124,7 +66,15 @@ def main():
     parser.add_argument("--model_tested", type=str, required=True, help="Name of model.")
     parser.add_argument("--code_language", type=str, required=True, help="Name of code language, cadquery or pythonocc are currently supported")
     parser.add_argument("--pc_reps", type=int, required=True, help="Number of reps of point cloud generation.")
-    parser.add_argument("--parallel", action="store_true", help="Run in parallel using multiple CPUs.")
+    parser.add_argument("--parallel", action="store_true", help="Run in parallel using multiple CPUs, otherwise the scripts run one by one in this process.")
+    parser.add_argument("--num_workers", type=int, default=None, help="Number of worker processes with --parallel, defaults to the CPU count.")
+    parser.add_argument("--resume", action="store_true", help="Skip the scripts already processed by a previous (interrupted) run.")
+    parser.add_argument("--timeout", type=float, default=60, help="Timeout in seconds for executing and exporting a single script.")
+    parser.add_argument("--memory_mb", type=int, default=4096, help="Memory limit in MB of a single script.")
+    parser.add_argument("--cpu_seconds", type=float, default=None, help="CPU time limit in seconds of a single script with --parallel, defaults to --timeout.")
+    parser.add_argument("--cache_dir", type=str, default="./inference/cad_cache", help="Cache of executed scripts shared across models and runs.")
+    parser.add_argument("--cache_size_gb", type=float, default=20, help="Size bound of the cache, least recently used entries are evicted.")
+    parser.add_argument("--no_cache", action="store_true", help="Execute every script, without reading or writing the cache.")
     
     # Multi-view configuration options
     parser.add_argument("--multi-view-config", type=str, help="Path to multi-view configuration file")
@@ -197,34 +147,78 @@ def main():
     for i in range(args.pc_reps):
         os.makedirs(pc_dir_base + f"_{i}", exist_ok=True)
     
-    # Prepare input data
-    input_data = [
-        (model_code[i], ids[i], code_dir, stl_dir, step_dir, pc_dir_base, 
-         args.pc_reps, args.code_language, multi_view_config) 
-        for i in range(len(model_code))
-    ]
+    if args.code_language == "pythonocc":
+        raise ValueError("Implement STEP generation")
+    elif args.code_language != "cadquery":
+        raise TypeError("CAD code language not supported!")
+
+    # Results are streamed to the progress file as they complete, so an interrupted run can be resumed
+    # not the file of generate_model_cad.py, the image column is added
+    progress_path = ROOT_CHECKPOINT_DIR + f"/{model_name}/{args.dataset_name}/results_images.partial.csv"
+    done = read_progress(progress_path, IMAGE_RESULT_COLUMNS) if args.resume else {}
+    if done:
+        print(f"Resuming: {len(done)} scripts already processed")
+
+    # Every script is executed once, its `solid` is exported to STL / STEP and sampled from memory
+    jobs = [build_job(model_code[i], ids[i], code_dir, stl_dir, step_dir, pc_dir_base, args.pc_reps) for i in range(len(model_code)) if str(ids[i]) not in done]
+    # most expensive first, so a heavy script does not start last and hold up the end of the run
+    jobs.sort(key=lambda job: estimate_cost(job[1]), reverse=True)
+    codes = {job[0]: job[1] for job in jobs}
+    cache = None if args.no_cache else CadCache(args.cache_dir, args.cache_size_gb)
+    generate_images = multi_view_config is not None and multi_view_config.enable_multi_view
     
-    if args.parallel:
-        num_workers = min(8, cpu_count())
-        with Pool(num_workers) as pool:
-            cad_results = list(tqdm(
-                pool.imap_unordered(process_cad_with_images, input_data), 
-                total=len(input_data), 
-                desc="Processing CAD tasks with images"
-            ))
-        
-        valid_codes, valid_stls, valid_pcs, valid_images, ids_out = zip(*cad_results)
-    else:
-        raise ValueError("Only implemented with parallelization at this time")
+    num_workers = (args.num_workers or cpu_count()) if args.parallel else 0
+    # images are rendered as soon as a part is exported, in parallel with the next scripts.
+    # The renderers and the executor share the worker budget, so the CPU is not oversubscribed
+    num_image_workers = num_workers // 2 if generate_images else 0
+    image_pool = Pool(num_image_workers) if num_image_workers > 0 else None
+    num_cached = 0
+    with open(progress_path, "w", encoding="utf-8", newline="") as f, \
+         CadExecutor(num_workers - num_image_workers, timeout=args.timeout, cpu_seconds=args.cpu_seconds or args.timeout, memory_mb=args.memory_mb, handler=export_cad) as executor:
+        # rewrite the rows kept from the previous run, which also drops a line cut off by a crash
+        writer = csv.DictWriter(f, fieldnames=IMAGE_RESULT_COLUMNS)
+        writer.writeheader()
+        writer.writerows(done.values())
+        f.flush()
+
+        def write_row(row, image_result=None):
+            if image_result is not None:
+                row["model_valid_images"] = image_result.get()[1]
+            writer.writerow(row)
+            f.flush()
+
+        pending = [] # rows waiting for their images
+        for id_, result in tqdm(execute_with_cache(executor, jobs, cache), total=len(jobs), desc="Processing CAD tasks"):
+            valid_code, valid_stl, valid_pc, _ = process_cad(id_, codes[id_], result, args.code_language)
+            num_cached += result.get("cached", False)
+            row = {"q_ids": id_, "model_valid_code": valid_code, "model_valid_stl": valid_stl, "model_valid_point_clouds": valid_pc, "model_valid_images": False}
+            if generate_images and valid_stl and image_pool is not None:
+                pending.append((row, image_pool.apply_async(generate_images_task, ((id_, step_dir, multi_view_config),))))
+            elif generate_images and valid_stl:
+                row["model_valid_images"] = generate_images_task((id_, step_dir, multi_view_config))[1]
+                write_row(row)
+            else:
+                write_row(row)
+
+            still_pending = []
+            for row, image_result in pending:
+                if image_result.ready():
+                    write_row(row, image_result)
+                else:
+                    still_pending.append((row, image_result))
+            pending = still_pending
+
+        for row, image_result in tqdm(pending, desc="Generating images"):
+            write_row(row, image_result)
+    if image_pool is not None:
+        image_pool.close()
+        image_pool.join()
+    if cache is not None:
+        print(f"{num_cached} of {len(jobs)} scripts served from the cache")
+        cache.evict()
     
     # Store results
-    df = pd.DataFrame({
-        "q_ids": list(ids_out), 
-        "model_valid_code": list(valid_codes), 
-        "model_valid_stl": list(valid_stls), 
-        "model_valid_point_clouds": list(valid_pcs),
-        "model_valid_images": list(valid_images)
-    })
+    df = progress_to_dataframe(progress_path, ids, IMAGE_RESULT_COLUMNS)
     
     # Calculate statistics
     code_valid_rate = df["model_valid_code"].sum() / len(df)
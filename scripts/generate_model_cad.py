@@ -1,82 +1,76 @@
 import argparse
 from utils_generate_model import *
 import os
+import csv
 import pandas as pd
-from multiprocessing import Pool, cpu_count
+from multiprocessing import cpu_count
 from tqdm import tqdm
-import time
-import re
+
+from cad_executor import CadExecutor
+from cad_cache import CadCache, execute_with_cache
 
 ROOT_CHECKPOINT_DIR = "./inference/inference_results"
 
-def wait_for_file(file_path, timeout=2, check_interval=0.1):
-    """Waits for a file to exist for a limited time."""
-    start_time = time.time()
-    while time.time() - start_time < timeout:
-        if os.path.isfile(file_path):
-            return True
-        time.sleep(check_interval)  # Small delay before rechecking
-    return False  # Timed out waiting for file
-
-def process_cad(args_tuple):
-    """Function to write and run a single Python script."""
-    code, id_, code_dir, stl_dir, step_dir, pc_dir_base, pc_reps, code_language = args_tuple
-    
-    print(f"Processing {id_}...")
-    
-    if "```python" in code:
-        code = re.sub(r"```[a-zA-Z]*\n|```", "", code)
-
-    # Checks if the code can be run, without any modifications. Checking for syntax errors
-    file_path = f"{code_dir}/{id_}.py"
-    write_python_file(code, file_path)
-    print(f"  Testing basic code execution for {id_}...")
-    valid_code = run_python_script(file_path)
-    
+RESULT_COLUMNS = ["q_ids", "model_valid_code", "model_valid_stl", "model_valid_point_clouds"]
+
+def estimate_cost(code):
+    """Rough cost of a script: its number of sketches (workplanes), then its length."""
+    return code.count("Workplane("), len(code)
+
+def read_progress(progress_path, columns=RESULT_COLUMNS):
+    """
+    Rows streamed by a previous run, keyed by question id (as a string). A row cut off by a crash is dropped.
+
+    A file written with other columns (e.g. by another script) is ignored, its rows would be mis-keyed.
+    """
+    if not os.path.isfile(progress_path):
+        return {}
+    with open(progress_path, "r", encoding="utf-8", newline="") as f:
+        reader = csv.DictReader(f)
+        if reader.fieldnames != list(columns):
+            print(f"Ignoring {progress_path}: its columns {reader.fieldnames} are not {list(columns)}")
+            return {}
+        return {row["q_ids"]: row for row in reader if None not in row.values() and "" not in row.values()}
+
+def progress_to_dataframe(progress_path, ids, columns):
+    """Final results in the order of the merged answers, with the validity columns as booleans."""
+    rows = read_progress(progress_path, columns)
+    df = pd.DataFrame([rows[str(id_)] for id_ in ids if str(id_) in rows], columns=columns)
+    df["q_ids"] = [id_ for id_ in ids if str(id_) in rows]
+    for column in columns[1:]:
+        df[column] = df[column] == "True"
+    return df
+
+def build_job(code, id_, code_dir, stl_dir, step_dir, pc_dir_base, pc_reps):
+    """Write the model's script to code_dir and return the (key, code, export args) job for the CadExecutor."""
+    code = clean_model_code(code)
+    write_python_file(code, f"{code_dir}/{id_}.py")
+    pc_paths = [(f"{pc_dir_base}_{i}/{id_}.ply", 42+i) for i in range(pc_reps)]
+    return id_, code, (f"{stl_dir}/{id_}.stl", f"{step_dir}/{id_}.step", pc_paths)
+
+def process_cad(id_, code, result, code_language):
+    """Turn the executor result of a single script run (execution + export) into the validity flags."""
+    valid_code = result["status"] == "ok"
+    if not valid_code:
+        print(f"  Execution {result['status']} for {id_}: {result['error_type']}: {result['error']}")
+
     # If execution failed due to missing OCP module, try syntax validation instead
+    # (as before, any failed execution falls back, so the valid code rate stays comparable with earlier runs)
     if not valid_code and code_language == "cadquery":
         print(f"  Falling back to syntax validation for {id_}...")
-        valid_code = validate_cadquery_syntax(code)
+        valid_code = validate_cadquery_syntax(clean_model_code(code))
         if valid_code:
             print(f"  Syntax validation passed for {id_}")
         else:
             print(f"  Syntax validation failed for {id_}")
-    
-    print(f"  Basic code execution result for {id_}: {valid_code}")
-    
-    valid_stl = False
-    valid_pc = False
-    if valid_code: # only move to stl generation if there is valid code
-        print(f"  Adding export code for {id_}...")
-        # Adds code to generate stl, checks that STL is generated.
-        if code_language == "pythonocc":
-            code += f"\nwrite_stl_file(body, \"{stl_dir}/{id_}.stl\")"
-            raise ValueError("Implement STEP generation")
-        elif code_language == "cadquery":
-            code += f"\nimport cadquery as cq\ncq.exporters.export(solid, \"{stl_dir}/{id_}.stl\")\n"
-            code += f"\nimport cadquery as cq\ncq.exporters.export(solid, \"{step_dir}/{id_}.step\")\n"
-        else:
-            raise TypeError("CAD code language not supported!")
-        write_python_file(code, f"{code_dir}/{id_}.py")
-        print(f"  Testing STL generation for {id_}...")
-        valid_stl = run_python_script(f"{code_dir}/{id_}.py")
-        print(f"  STL generation result for {id_}: {valid_stl}")
-        if not wait_for_file(f"{stl_dir}/{id_}.stl"): # checks that the .stl was actually created, adds a little delay in case it's slow to save. #TODO implement this also for the python files generation?
-            valid_stl = False
-            print(f"  STL file not found for {id_}")
-            
-        # Generate point clouds
-        if valid_stl:
-            print(f"  Generating point clouds for {id_}...")
-            for i in range(pc_reps):
-                try:
-                    out_pc = convert_stl_to_point_cloud(f"{stl_dir}/{id_}.stl", f"{pc_dir_base}_{i}/{id_}.ply", 2000, seed=42+i)
-                    if os.path.isfile(f"{pc_dir_base}_{i}/{id_}.ply"):
-                        valid_pc = True # Only no errors and pc file exists should this be set to true
-                except Exception as e:
-                    print(f"{id_} failed point cloud generation: {e}")
-
-    print(f"Completed processing {id_}: code={valid_code}, stl={valid_stl}, pc={valid_pc}")
+
+    output = result["output"] or {}
+    valid_stl = output.get("valid_stl", False)
+    valid_pc = output.get("valid_pc", False)
+    if output.get("export_error"):
+        print(f"  Export failed for {id_}: {output['export_error']}")
+
+    print(f"Completed processing {id_}: code={valid_code}, stl={valid_stl}, pc={valid_pc} ({result['seconds']:.1f}s)")
     return valid_code, valid_stl, valid_pc, id_
 
 if __name__ == "__main__":
@@ -85,7 +79,15 @@ def process_cad(args_tuple):
     parser.add_argument("--model_tested", type=str, required=True, help="Name of model.")
     parser.add_argument("--code_language", type=str, required=True, help="Name of code language, cadquery or pythonocc are currently supported")
     parser.add_argument("--pc_reps", type=int, required=True, help="Number of reps of point cloud generation.")
-    parser.add_argument("--parallel", action="store_true", help="Run in parallel using multiple CPUs.")
+    parser.add_argument("--parallel", action="store_true", help="Run in parallel using multiple CPUs, otherwise the scripts run one by one in this process.")
+    parser.add_argument("--num_workers", type=int, default=None, help="Number of worker processes with --parallel, defaults to the CPU count.")
+    parser.add_argument("--resume", action="store_true", help="Skip the scripts already processed by a previous (interrupted) run.")
+    parser.add_argument("--timeout", type=float, default=60, help="Timeout in seconds for executing and exporting a single script.")
+    parser.add_argument("--memory_mb", type=int, default=4096, help="Memory limit in MB of a single script.")
+    parser.add_argument("--cpu_seconds", type=float, default=None, help="CPU time limit in seconds of a single script with --parallel, defaults to --timeout.")
+    parser.add_argument("--cache_dir", type=str, default="./inference/cad_cache", help="Cache of executed scripts shared across models and runs.")
+    parser.add_argument("--cache_size_gb", type=float, default=20, help="Size bound of the cache, least recently used entries are evicted.")
+    parser.add_argument("--no_cache", action="store_true", help="Execute every script, without reading or writing the cache.")
 
 
     args = parser.parse_args()
@@ -112,23 +114,44 @@ def process_cad(args_tuple):
     for i in range(args.pc_reps):
         os.makedirs(pc_dir_base + f"_{i}", exist_ok=True)
     
-    input_data = [(model_code[i], ids[i], code_dir, stl_dir, step_dir, pc_dir_base, args.pc_reps, args.code_language) for i in range(len(model_code))]
-    
-    if args.parallel:
-        num_workers = min(8, cpu_count())  # Use 8 CPUs or the max available
-        with Pool(num_workers) as pool:
-            cad_results = list(tqdm(pool.imap_unordered(process_cad, input_data), 
-                                total=len(input_data), 
-                                desc="Processing CAD tasks"))
-            
-        valid_codes, valid_stls, valid_pcs, ids_out = zip(*cad_results)  # Separates tuples into respective results
-            
-    else:
-        raise ValueError("Only implemented with parallelization at this time")
-        # TODO: implement without parallelization
+    if args.code_language == "pythonocc":
+        raise ValueError("Implement STEP generation")
+    elif args.code_language != "cadquery":
+        raise TypeError("CAD code language not supported!")
+
+    # Results are streamed to the progress file as they complete, so an interrupted run can be resumed
+    progress_path = ROOT_CHECKPOINT_DIR + f"/{model_name}/{args.dataset_name}/results.partial.csv"
+    done = read_progress(progress_path) if args.resume else {}
+    if done:
+        print(f"Resuming: {len(done)} scripts already processed")
+
+    # Every script is executed once, its `solid` is exported to STL / STEP and sampled from memory
+    jobs = [build_job(model_code[i], ids[i], code_dir, stl_dir, step_dir, pc_dir_base, args.pc_reps) for i in range(len(model_code)) if str(ids[i]) not in done]
+    # most expensive first, so a heavy script does not start last and hold up the end of the run
+    jobs.sort(key=lambda job: estimate_cost(job[1]), reverse=True)
+    codes = {job[0]: job[1] for job in jobs}
+    cache = None if args.no_cache else CadCache(args.cache_dir, args.cache_size_gb)
+    
+    num_workers = (args.num_workers or cpu_count()) if args.parallel else 0
+    num_cached = 0
+    with open(progress_path, "w", encoding="utf-8", newline="") as f, \
+         CadExecutor(num_workers, timeout=args.timeout, cpu_seconds=args.cpu_seconds or args.timeout, memory_mb=args.memory_mb, handler=export_cad) as executor:
+        # rewrite the rows kept from the previous run, which also drops a line cut off by a crash
+        writer = csv.DictWriter(f, fieldnames=RESULT_COLUMNS)
+        writer.writeheader()
+        writer.writerows(done.values())
+        f.flush()
+        for id_, result in tqdm(execute_with_cache(executor, jobs, cache), total=len(jobs), desc="Processing CAD tasks"):
+            valid_code, valid_stl, valid_pc, _ = process_cad(id_, codes[id_], result, args.code_language)
+            writer.writerow({"q_ids": id_, "model_valid_code": valid_code, "model_valid_stl": valid_stl, "model_valid_point_clouds": valid_pc})
+            f.flush()
+            num_cached += result.get("cached", False)
+    if cache is not None:
+        print(f"{num_cached} of {len(jobs)} scripts served from the cache")
+        cache.evict()
     
     # Store results
-    df = pd.DataFrame({"q_ids": list(ids_out), "model_valid_code": list(valid_codes), "model_valid_stl": list(valid_stls), "model_valid_point_clouds": list(valid_pcs)})
+    df = progress_to_dataframe(progress_path, ids, RESULT_COLUMNS)
     code_valid_rate = df["model_valid_code"].sum()/len(df)
     stl_valid_rate = df["model_valid_stl"].sum()/len(df)
     pc_valid_rate = df["model_valid_point_clouds"].sum()/len(df)
@@ -10,10 +10,153 @@
 from pathlib import Path
 from typing import List, Dict, Optional
 from PIL import Image
+import numpy as np
 import argparse
+import multiprocessing as mp
+from multiprocessing import cpu_count
+from concurrent.futures import ThreadPoolExecutor
 
+from tessellation_cache import DEFAULT_TOLERANCE, DEFAULT_ANGULAR_TOLERANCE
 from config import MultiViewConfig, load_config, save_config, get_preset_config, print_config_summary
 
+# Renderer of the current (worker) process, created once by _init_render_worker
+_renderer = None
+
+def _init_render_worker(config: MultiViewConfig):
+    """Create the renderer once per process instead of once per part."""
+    global _renderer
+    from enhanced_cad_renderer import CADDrawingRenderer
+    _renderer = CADDrawingRenderer(
+        background_color=config.renderer_background,
+        line_width=config.renderer_line_width,
+        resolution=config.image_resolution
+    )
+
+def render_part(task):
+    """Render all configured views (and the composite) of one STEP file.
+
+    The STEP file is loaded and meshed once, every view is rendered from the same shape so its
+    triangulation is reused. Parts whose images are newer than their STEP file are skipped.
+
+    Returns:
+        (step_file, processed files, skipped, error message or None)
+    """
+    step_file, config = task
+    try:
+        # Get part name
+        part_name = os.path.splitext(os.path.basename(step_file))[0]
+        
+        # Create output directory for this part
+        part_output_dir = os.path.join(config.output_dir, part_name)
+        os.makedirs(part_output_dir, exist_ok=True)
+        
+        view_paths = [os.path.join(part_output_dir, f"{part_name}_{view}.{config.image_format}") for view in config.views]
+        composite_path = os.path.join(part_output_dir, f"{part_name}_composite.{config.image_format}")
+        
+        # Skip parts rendered after their STEP file was last written
+        expected = [composite_path] if len(view_paths) > 1 and config.enable_multi_view else view_paths
+        step_mtime = os.path.getmtime(step_file)
+        if all(os.path.exists(p) and os.path.getmtime(p) >= step_mtime for p in expected):
+            return step_file, expected, True, None
+        
+        # Load STEP file
+        import cadquery as cq
+        solid = cq.importers.importStep(step_file)
+        # mesh once, the triangulation is stored on the shape and reused by every view
+        solid.val().mesh(DEFAULT_TOLERANCE, DEFAULT_ANGULAR_TOLERANCE)
+        
+        # Render all configured views
+        rendered_files = []
+        for view, output_path in zip(config.views, view_paths):
+            success = _renderer.render_cad_view(
+                solid, output_path, view_type=view, style_name=config.renderer_style
+            )
+            if success:
+                rendered_files.append(output_path)
+        
+        # Create composite if multiple views were rendered
+        if len(rendered_files) > 1 and config.enable_multi_view:
+            _renderer.create_composite_drawing(rendered_files, composite_path, layout=config.composite_layout)
+            return step_file, [composite_path], False, None
+        return step_file, rendered_files, False, None
+    except Exception as e:
+        return step_file, [], False, str(e)
+
+def _composite_slots(layout: str, num_images: int, base_size: tuple):
+    """Top-left corner of every image in the composite, and the composite size."""
+    w, h = base_size
+    if layout == 'grid':
+        # 2x2 grid, missing views stay white
+        return [(0, 0), (w, 0), (0, h), (w, h)][:num_images], (w * 2, h * 2)
+    if layout == 'horizontal':
+        return [(i * w, 0) for i in range(num_images)], (w * num_images, h)
+    if layout == 'vertical':
+        return [(0, i * h) for i in range(num_images)], (w, h * num_images)
+    raise ValueError(f"Unknown composite layout: {layout}")
+
+def _load_view_into(canvas: np.ndarray, image_path: str, corner: tuple, base_size: tuple):
+    """Decode one view, resize it to base_size and copy it into its slot of the canvas."""
+    with Image.open(image_path) as img:
+        # JPEG views larger than the slot are decoded at a reduced scale directly
+        img.draft('RGB', base_size)
+        img = img.convert('RGB')
+        if img.size != base_size:
+            img = img.resize(base_size, Image.Resampling.LANCZOS)
+        x, y = corner
+        canvas[y:y + base_size[1], x:x + base_size[0]] = np.asarray(img)
+
+def _composite_signature(image_paths: List[str], layout: str, image_format: str, quality: int) -> Dict:
+    """What a composite depends on: its views (path, size, mtime) and the layout and format settings."""
+    inputs = []
+    for path in image_paths:
+        stat = os.stat(path)
+        inputs.append([path, stat.st_size, stat.st_mtime_ns])
+    return {'inputs': inputs, 'layout': layout, 'format': image_format, 'quality': quality}
+
+def build_composite(image_paths: List[str], output_path: str, layout: str = 'grid', image_format: str = 'png',
+                    quality: int = 95, executor: Optional[ThreadPoolExecutor] = None) -> Optional[bool]:
+    """Assemble the views into one composite image.
+
+    The views are decoded straight into a preallocated canvas (resized in the executor threads when given),
+    and the composite is only rebuilt when its views or settings changed since the last build,
+    which is tracked in a `{output_path}.json` sidecar.
+
+    Returns:
+        True if the composite was written, None if it was up to date, False if there are fewer than 2 views.
+    """
+    image_paths = [p for p in image_paths if os.path.exists(p)]
+    if len(image_paths) < 2:
+        return False
+    
+    signature = _composite_signature(image_paths, layout, image_format, quality)
+    signature_path = f"{output_path}.json"
+    if os.path.exists(output_path):
+        try:
+            with open(signature_path, 'r') as f:
+                if json.load(f) == signature:
+                    return None
+        except (OSError, ValueError):
+            pass
+    
+    # every view is resized to the size of the first one, read from its header only
+    with Image.open(image_paths[0]) as first:
+        base_size = first.size
+    corners, canvas_size = _composite_slots(layout, len(image_paths), base_size)
+    canvas = np.full((canvas_size[1], canvas_size[0], 3), 255, dtype=np.uint8)
+    
+    tasks = [(canvas, path, corner, base_size) for path, corner in zip(image_paths, corners)]
+    if executor is not None:
+        list(executor.map(lambda task: _load_view_into(*task), tasks))
+    else:
+        for task in tasks:
+            _load_view_into(*task)
+    
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    Image.fromarray(canvas).save(output_path, format=image_format.upper(), quality=quality)
+    with open(signature_path, 'w') as f:
+        json.dump(signature, f)
+    return True
+
 class MultiViewManager:
     """Manages multi-view image generation for CAD-Coder."""
     
@@ -150,8 +293,13 @@ def _process_3d_image(self, image_path: str) -> Optional[str]:
         # For now, just return None as placeholder
         return None
     
-    def process_renderer_images(self, step_files_dir: str) -> List[str]:
-        """Process STEP files using the renderer."""
+    def process_renderer_images(self, step_files_dir: str, part_names: Optional[List[str]] = None) -> List[str]:
+        """Process STEP files using the renderer, one part per worker process.
+
+        Args:
+            step_files_dir: directory with the STEP files.
+            part_names: only render these parts (STEP file names without extension), defaults to all.
+        """
         if not self.config.enable_renderer:
             print("❌ Renderer integration is disabled")
             return []
@@ -162,8 +310,12 @@ def process_renderer_images(self, step_files_dir: str) -> List[str]:
         
         print(f"🔄 Processing STEP files from: {step_files_dir}")
         
-        # Find all STEP files
-        step_files = glob.glob(os.path.join(step_files_dir, "*.step"))
+        # Find all STEP files, each part is rendered once even if requested several times
+        if part_names is not None:
+            step_files = [os.path.join(step_files_dir, f"{name}.step") for name in dict.fromkeys(part_names)]
+            step_files = [f for f in step_files if os.path.exists(f)]
+        else:
+            step_files = sorted(glob.glob(os.path.join(step_files_dir, "*.step")))
         
         if not step_files:
             print("❌ No STEP files found")
@@ -171,55 +323,39 @@ def process_renderer_images(self, step_files_dir: str) -> List[str]:
         
         print(f"📐 Found {len(step_files)} STEP files")
         
-        # Import renderer if available
+        # Check the renderer is available before starting any worker
         try:
-            from enhanced_cad_renderer import CADDrawingRenderer
-            renderer = CADDrawingRenderer(
-                background_color=self.config.renderer_background,
-                line_width=self.config.renderer_line_width,
-                resolution=self.config.image_resolution
-            )
+            import enhanced_cad_renderer
         except ImportError:
             print("❌ Enhanced CAD renderer not available. Install required dependencies.")
             return []
         
-        processed_files = []
+        tasks = [(step_file, self.config) for step_file in step_files]
+        num_workers = min(self.config.render_workers or cpu_count(), len(tasks))
+        pool = None
+        if num_workers <= 1 or mp.current_process().daemon:
+            # a single part, or already inside a pool worker (which cannot have children)
+            _init_render_worker(self.config)
+            results = map(render_part, tasks)
+        else:
+            pool = mp.Pool(num_workers, initializer=_init_render_worker, initargs=(self.config,))
+            results = pool.imap_unordered(render_part, tasks)
         
-        for step_file in step_files:
-            try:
-                # Load STEP file
-                import cadquery as cq
-                solid = cq.importers.importStep(step_file)
-                
-                # Get part name
-                part_name = os.path.splitext(os.path.basename(step_file))[0]
-                
-                # Create output directory for this part
-                part_output_dir = os.path.join(self.config.output_dir, part_name)
-                os.makedirs(part_output_dir, exist_ok=True)
-                
-                # Render all configured views
-                rendered_files = []
-                for view in self.config.views:
-                    output_path = os.path.join(part_output_dir, f"{part_name}_{view}.{self.config.image_format}")
-                    success = renderer.render_cad_view(
-                        solid, output_path, view_type=view, style_name=self.config.renderer_style
-                    )
-                    if success:
-                        rendered_files.append(output_path)
-                
-                # Create composite if multiple views were rendered
-                if len(rendered_files) > 1 and self.config.enable_multi_view:
-                    composite_path = os.path.join(part_output_dir, f"{part_name}_composite.{self.config.image_format}")
-                    renderer.create_composite_drawing(rendered_files, composite_path, layout=self.config.composite_layout)
-                    processed_files.append(composite_path)
-                else:
-                    processed_files.extend(rendered_files)
-                
-            except Exception as e:
-                print(f"❌ Error processing STEP file {step_file}: {e}")
+        processed_files = []
+        num_skipped = 0
+        for step_file, part_files, skipped, error in results:
+            if error is not None:
+                print(f"❌ Error processing STEP file {step_file}: {error}")
                 continue
+            processed_files.extend(part_files)
+            num_skipped += skipped
+        
+        if pool is not None:
+            pool.close()
+            pool.join()
         
+        if num_skipped > 0:
+            print(f"⏭️ {num_skipped} parts already rendered and up to date")
         print(f"✅ Processed {len(processed_files)} renderer images")
         return processed_files
     
@@ -248,87 +384,38 @@ def create_composite_images(self, input_dir: str = None) -> List[str]:
             print("❌ No part directories found")
             return []
         
-        composite_files = []
-        
-        for part_dir in part_dirs:
-            part_path = os.path.join(input_dir, part_dir)
-            
-            # Find all images in the part directory
-            image_files = []
-            for ext in ['*.png', '*.jpg', '*.jpeg']:
-                image_files.extend(glob.glob(os.path.join(part_path, ext)))
-            
-            if len(image_files) >= 2:  # Need at least 2 images for composite
-                # Sort images to ensure consistent order
-                image_files.sort()
-                
-                # Create composite
-                composite_path = os.path.join(self.config.composite_dir, f"{part_dir}_composite.{self.config.image_format}")
-                success = self._create_composite_image(image_files, composite_path)
-                if success:
-                    composite_files.append(composite_path)
-        
-        print(f"✅ Created {len(composite_files)} composite images")
+        # part directories are assembled concurrently, each one decodes and resizes its views in view_pool
+        num_workers = min(self.config.composite_workers or cpu_count(), len(part_dirs))
+        with ThreadPoolExecutor(num_workers) as part_pool, ThreadPoolExecutor(num_workers) as view_pool:
+            results = list(part_pool.map(
+                lambda part_dir: self._create_part_composite(os.path.join(input_dir, part_dir), part_dir, view_pool), part_dirs
+            ))
+        
+        composite_files = [path for path, success in results if success is not False]
+        num_skipped = sum(success is None for _, success in results)
+        if num_skipped > 0:
+            print(f"⏭️ {num_skipped} composite images already up to date")
+        print(f"✅ Created {len(composite_files) - num_skipped} composite images")
         return composite_files
     
-    def _create_composite_image(self, image_paths: List[str], output_path: str) -> bool:
-        """Create a composite image from multiple view images."""
+    def _create_part_composite(self, part_path: str, part_dir: str, executor: Optional[ThreadPoolExecutor] = None):
+        """Create the composite of one part directory, returns (composite path, build_composite result)."""
+        # Find all images in the part directory, sorted to ensure consistent order
+        image_files = []
+        for ext in ['*.png', '*.jpg', '*.jpeg']:
+            image_files.extend(glob.glob(os.path.join(part_path, ext)))
+        image_files.sort()
+        
+        composite_path = os.path.join(self.config.composite_dir, f"{part_dir}_composite.{self.config.image_format}")
+        return composite_path, self._create_composite_image(image_files, composite_path, executor)
+    
+    def _create_composite_image(self, image_paths: List[str], output_path: str, executor: Optional[ThreadPoolExecutor] = None) -> Optional[bool]:
+        """Create a composite image from multiple view images (None if it was already up to date)."""
         try:
-            # Load all images
-            images = []
-            for img_path in image_paths:
-                if os.path.exists(img_path):
-                    img = Image.open(img_path).convert('RGB')
-                    images.append(img)
-            
-            if len(images) < 2:
-                return False
-            
-            # Resize all images to the same size
-            base_size = images[0].size
-            resized_images = []
-            for img in images:
-                resized_img = img.resize(base_size, Image.Resampling.LANCZOS)
-                resized_images.append(resized_img)
-            
-            # Create composite based on layout
-            if self.config.composite_layout == 'grid':
-                # 2x2 grid layout
-                if len(resized_images) >= 4:
-                    composite = Image.new('RGB', (base_size[0] * 2, base_size[1] * 2), 'white')
-                    composite.paste(resized_images[0], (0, 0))  # Top-left
-                    composite.paste(resized_images[1], (base_size[0], 0))  # Top-right
-                    composite.paste(resized_images[2], (0, base_size[1]))  # Bottom-left
-                    composite.paste(resized_images[3], (base_size[0], base_size[1]))  # Bottom-right
-                else:
-                    # Pad with white images
-                    while len(resized_images) < 4:
-                        white_img = Image.new('RGB', base_size, 'white')
-                        resized_images.append(white_img)
-                    composite = Image.new('RGB', (base_size[0] * 2, base_size[1] * 2), 'white')
-                    composite.paste(resized_images[0], (0, 0))
-                    composite.paste(resized_images[1], (base_size[0], 0))
-                    composite.paste(resized_images[2], (0, base_size[1]))
-                    composite.paste(resized_images[3], (base_size[0], base_size[1]))
-            
-            elif self.config.composite_layout == 'horizontal':
-                # Horizontal layout
-                composite = Image.new('RGB', (base_size[0] * len(resized_images), base_size[1]), 'white')
-                for i, img in enumerate(resized_images):
-                    composite.paste(img, (i * base_size[0], 0))
-            
-            elif self.config.composite_layout == 'vertical':
-                # Vertical layout
-                composite = Image.new('RGB', (base_size[0], base_size[1] * len(resized_images)), 'white')
-                for i, img in enumerate(resized_images):
-                    composite.paste(img, (0, i * base_size[1]))
-            
-            # Save composite
-            os.makedirs(os.path.dirname(output_path), exist_ok=True)
-            composite.save(output_path, format=self.config.image_format.upper(), quality=self.config.image_quality)
-            
-            return True
-            
+            return build_composite(
+                image_paths, output_path, layout=self.config.composite_layout, image_format=self.config.image_format,
+                quality=self.config.image_quality, executor=executor
+            )
         except Exception as e:
             print(f"❌ Error creating composite image: {e}")
             return False
@@ -16,10 +16,13 @@
 from llava.model.builder import load_pretrained_model
 from llava.utils import disable_torch_init
 from llava.mm_utils import tokenizer_image_token, process_images, get_model_name_from_path
+from torch.utils.data import Dataset, DataLoader
 
 from PIL import Image
 import math
 
+from llava.eval.jsonl_io import JsonlIndex
+
 
 def split_list(lst, n):
     """Split a list into n (roughly) equal-sized chunks"""
@@ -32,6 +35,67 @@ def get_chunk(lst, n, k):
     return chunks[k]
 
 
+# Multi-view dataset, images are loaded and preprocessed by the DataLoader workers
+class MultiViewDataset(Dataset):
+    def __init__(self, questions, positions, image_folder, tokenizer, image_processor, model_config, conv_mode):
+        self.questions = questions
+        self.positions = positions
+        self.image_folder = image_folder
+        self.tokenizer = tokenizer
+        self.image_processor = image_processor
+        self.model_config = model_config
+        self.conv_mode = conv_mode
+
+    def __getitem__(self, index):
+        line = self.questions[self.positions[index]]
+        qs = line["text"]
+
+        # Handle multi-view vs single view
+        image_files = line["images"] if "images" in line else [line["image"]]
+
+        # Build image tokens for all images
+        if self.model_config.mm_use_im_start_end:
+            image_tokens = (DEFAULT_IM_START_TOKEN + DEFAULT_IMAGE_TOKEN + DEFAULT_IM_END_TOKEN + '\n') * len(image_files)
+        else:
+            image_tokens = (DEFAULT_IMAGE_TOKEN + '\n') * len(image_files)
+
+        conv = conv_templates[self.conv_mode].copy()
+        conv.append_message(conv.roles[0], image_tokens + qs)
+        conv.append_message(conv.roles[1], None)
+        prompt = conv.get_prompt()
+
+        input_ids = tokenizer_image_token(prompt, self.tokenizer, IMAGE_TOKEN_INDEX, return_tensors='pt')
+
+        # Process all images, one tensor per view
+        image_tensors = []
+        image_sizes = []
+        for image_file in image_files:
+            image = Image.open(os.path.join(self.image_folder, image_file)).convert('RGB')
+            image_tensors.append(process_images([image], self.image_processor, self.model_config)[0])
+            image_sizes.append(image.size)
+
+        return input_ids, torch.stack(image_tensors, dim=0), image_sizes, line
+
+    def __len__(self):
+        return len(self.positions)
+
+
+def collate_fn(batch):
+    # one question per batch, the views of the question form the image batch
+    input_ids, image_tensor, image_sizes, line = batch[0]
+    return input_ids.unsqueeze(0), image_tensor, image_sizes, line
+
+
+# DataLoader, num_workers questions ahead of the generation are prepared in pinned memory
+def create_data_loader(questions, positions, image_folder, tokenizer, image_processor, model_config, conv_mode, num_workers=4, prefetch_factor=2):
+    dataset = MultiViewDataset(questions, positions, image_folder, tokenizer, image_processor, model_config, conv_mode)
+    data_loader = DataLoader(
+        dataset, batch_size=1, num_workers=num_workers, shuffle=False, collate_fn=collate_fn,
+        pin_memory=torch.cuda.is_available(), prefetch_factor=prefetch_factor if num_workers > 0 else None,
+    )
+    return data_loader
+
+
 def eval_model_multi_view(args):
     """Evaluate model with multi-view inputs."""
     # Model
@@ -40,69 +104,30 @@ def eval_model_multi_view(args):
     model_name = get_model_name_from_path(model_path)
     tokenizer, model, image_processor, context_len = load_pretrained_model(model_path, args.model_base, model_name)
 
-    questions = [json.loads(q) for q in open(os.path.expanduser(args.question_file), "r")]
-    questions = get_chunk(questions, args.num_chunks, args.chunk_idx)
+    # questions are read lazily through a byte offset index instead of being loaded as a list of dicts
+    questions = JsonlIndex(os.path.expanduser(args.question_file))
+    positions = get_chunk(list(range(len(questions))), args.num_chunks, args.chunk_idx)
     answers_file = os.path.expanduser(args.answers_file)
     os.makedirs(os.path.dirname(answers_file), exist_ok=True)
     ans_file = open(answers_file, "w")
-    
-    for line in tqdm(questions):
+
+    data_loader = create_data_loader(questions, positions, args.image_folder, tokenizer, image_processor, model.config, args.conv_mode,
+                                     num_workers=args.num_workers, prefetch_factor=args.prefetch_factor)
+
+    for input_ids, image_tensor, image_sizes, line in tqdm(data_loader, total=len(positions)):
         idx = line["question_id"]
-        qs = line["text"]
-        cur_prompt = qs
-        
-        # Handle multi-view vs single view
+        cur_prompt = line["text"]
         if "images" in line:
-            # Multi-view: multiple images
-            image_files = line["images"]
-            print(f"Processing multi-view: {idx} with {len(image_files)} images")
+            print(f"Processing multi-view: {idx} with {len(image_sizes)} images")
         else:
-            # Single view: one image
-            image_files = [line["image"]]
             print(f"Processing single view: {idx}")
-        
-        # Build image tokens for all images
-        image_tokens = ""
-        images = []
-        
-        for image_file in image_files:
-            if model.config.mm_use_im_start_end:
-                image_tokens += DEFAULT_IM_START_TOKEN + DEFAULT_IMAGE_TOKEN + DEFAULT_IM_END_TOKEN + '\n'
-            else:
-                image_tokens += DEFAULT_IMAGE_TOKEN + '\n'
-            
-            # Load image
-            image = Image.open(os.path.join(args.image_folder, image_file)).convert('RGB')
-            images.append(image)
-        
-        # Combine image tokens with question
-        qs = image_tokens + qs
-
-        conv = conv_templates[args.conv_mode].copy()
-        conv.append_message(conv.roles[0], qs)
-        conv.append_message(conv.roles[1], None)
-        prompt = conv.get_prompt()
-
-        input_ids = tokenizer_image_token(prompt, tokenizer, IMAGE_TOKEN_INDEX, return_tensors='pt').unsqueeze(0).cuda()
 
-        # Process all images
-        image_tensors = []
-        image_sizes = []
-        for image in images:
-            image_tensor = process_images([image], image_processor, model.config)[0]
-            image_tensors.append(image_tensor)
-            image_sizes.append(image.size)
-        
-        # Stack images if multiple
-        if len(image_tensors) > 1:
-            image_tensor = torch.stack(image_tensors, dim=0)
-        else:
-            image_tensor = image_tensors[0].unsqueeze(0)
+        input_ids = input_ids.to(device='cuda', non_blocking=True)
 
         with torch.inference_mode():
             output_ids = model.generate(
                 input_ids,
-                images=image_tensor.half().cuda(),
+                images=image_tensor.to(dtype=torch.float16, device='cuda', non_blocking=True),
                 image_sizes=image_sizes,
                 do_sample=True if args.temperature > 0 else False,
                 temperature=args.temperature,
@@ -138,6 +163,8 @@ def eval_model_multi_view(args):
     parser.add_argument("--top_p", type=float, default=None)
     parser.add_argument("--num_beams", type=int, default=1)
     parser.add_argument("--max_new_tokens", type=int, default=3450)
+    parser.add_argument("--num-workers", type=int, default=4)
+    parser.add_argument("--prefetch-factor", type=int, default=2)
     args = parser.parse_args()
 
     eval_model_multi_view(args)
@@ -0,0 +1,128 @@
+"""
+Tessellation cache: every solid is meshed once by OCC and the triangles are stored as a directory of plain .npy
+files (vertices.npy float32 [N, 3], faces.npy int32 [M, 3], info.json), which load_mesh memory-maps instead of reading.
+The STL export, the point cloud sampling and the metrics all read these arrays.
+"""
+
+import json
+import os
+import shutil
+import numpy as np
+
+# Same deflections as the STL export of cq.exporters.export
+DEFAULT_TOLERANCE = 0.1
+DEFAULT_ANGULAR_TOLERANCE = 0.1
+
+STL_RECORD_DTYPE = np.dtype([('normal', '<f4', (3,)), ('vertices', '<f4', (3, 3)), ('attribute', '<u2')])
+
+def mesh_path_for(stl_path):
+    """Path of the tessellation of a generated model, stored next to its STL."""
+    return os.path.splitext(stl_path)[0] + ".mesh"
+
+def to_shape(solid):
+    """cq.Shape of a solid left by a script, which may also be a Workplane."""
+    import cadquery as cq
+    if isinstance(solid, cq.Shape):
+        return solid
+    return cq.Compound.makeCompound([o for o in solid.vals() if isinstance(o, cq.Shape)])
+
+def shape_to_mesh(shape, tolerance=DEFAULT_TOLERANCE, angular_tolerance=DEFAULT_ANGULAR_TOLERANCE):
+    """Tessellate a cq.Shape once, return vertices [N, 3] float64 and faces [M, 3] int64."""
+    vertices, triangles = shape.tessellate(tolerance, angular_tolerance)
+    vertices = np.array([v.toTuple() for v in vertices], dtype=np.float64).reshape(-1, 3)
+    faces = np.array(triangles, dtype=np.int64).reshape(-1, 3)
+    return vertices, faces
+
+def _replace_dir(tmp_path, mesh_path):
+    # a directory cannot be renamed over a non-empty one, the previous mesh is moved out of the way first
+    old_path = f"{mesh_path}.{os.getpid()}.old"
+    try:
+        os.rename(mesh_path, old_path)
+    except FileNotFoundError:
+        old_path = None
+    try:
+        os.rename(tmp_path, mesh_path)
+    except OSError: # a concurrent writer put its mesh in place first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    if old_path is not None:
+        shutil.rmtree(old_path, ignore_errors=True)
+
+def save_mesh(mesh_path, vertices, faces, tolerance=DEFAULT_TOLERANCE, angular_tolerance=DEFAULT_ANGULAR_TOLERANCE, source_mtime=0.0):
+    """Write a mesh as a directory of .npy files (float32 vertices, int32 faces) and info.json, atomically."""
+    tmp_path = f"{mesh_path}.{os.getpid()}.tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    np.save(os.path.join(tmp_path, "vertices.npy"), vertices.astype(np.float32))
+    np.save(os.path.join(tmp_path, "faces.npy"), faces.astype(np.int32))
+    with open(os.path.join(tmp_path, "info.json"), "w", encoding="utf-8") as f:
+        json.dump({"tolerance": tolerance, "angular_tolerance": angular_tolerance, "source_mtime": source_mtime}, f)
+    _replace_dir(tmp_path, mesh_path)
+
+def copy_mesh(mesh_path, target_path):
+    """Copy a mesh written by save_mesh, atomically."""
+    tmp_path = f"{target_path}.{os.getpid()}.tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    shutil.copytree(mesh_path, tmp_path)
+    _replace_dir(tmp_path, target_path)
+
+def load_mesh(mesh_path, mmap=True):
+    """Read a mesh written by save_mesh, return vertices [N, 3] and faces [M, 3] (memory-mapped by default)."""
+    mmap_mode = "r" if mmap else None
+    return (np.load(os.path.join(mesh_path, "vertices.npy"), mmap_mode=mmap_mode),
+            np.load(os.path.join(mesh_path, "faces.npy"), mmap_mode=mmap_mode))
+
+def read_mesh_info(mesh_path):
+    """Tolerances and source mtime a mesh was made with."""
+    with open(os.path.join(mesh_path, "info.json"), "r", encoding="utf-8") as f:
+        info = json.load(f)
+    return float(info["tolerance"]), float(info["angular_tolerance"]), float(info["source_mtime"])
+
+def write_stl(stl_path, vertices, faces):
+    """Write a binary STL straight from the mesh arrays."""
+    triangles = np.asarray(vertices, dtype=np.float64)[faces] # [M, 3, 3]
+    normals = np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+    normals /= np.maximum(np.linalg.norm(normals, axis=1, keepdims=True), 1e-12)
+
+    records = np.zeros(len(faces), dtype=STL_RECORD_DTYPE)
+    records['normal'] = normals
+    records['vertices'] = triangles
+    with open(stl_path, 'wb') as f:
+        f.write(b'binary STL'.ljust(80, b' '))
+        f.write(np.uint32(len(faces)).tobytes())
+        f.write(records.tobytes())
+
+class TessellationCache:
+    """
+    Meshes of STEP files, tessellated once and stored as {root}/{name}.mesh.
+
+    An entry is reused as long as it was made at the same tolerances from the current version of the STEP file,
+    so the STL export, the point cloud sampling and the metrics all read the same triangles.
+
+    Example:
+        cache = TessellationCache("./inference/test100_gt_mesh")
+        vertices, faces = cache.get("./inference/test100_gt_steps/00002718.step")
+    """
+
+    def __init__(self, root, tolerance=DEFAULT_TOLERANCE, angular_tolerance=DEFAULT_ANGULAR_TOLERANCE):
+        self.root = root
+        self.tolerance = tolerance
+        self.angular_tolerance = angular_tolerance
+        os.makedirs(root, exist_ok=True)
+
+    def mesh_path(self, step_path):
+        return os.path.join(self.root, os.path.splitext(os.path.basename(step_path))[0] + ".mesh")
+
+    def get(self, step_path):
+        mesh_path = self.mesh_path(step_path)
+        source_mtime = os.path.getmtime(step_path)
+        if os.path.isdir(mesh_path):
+            try:
+                if read_mesh_info(mesh_path) == (self.tolerance, self.angular_tolerance, source_mtime):
+                    return load_mesh(mesh_path)
+            except (OSError, ValueError, KeyError):
+                pass
+
+        import cadquery as cq
+        vertices, faces = shape_to_mesh(to_shape(cq.importers.importStep(step_path)), self.tolerance, self.angular_tolerance)
+        save_mesh(mesh_path, vertices, faces, self.tolerance, self.angular_tolerance, source_mtime)
+        return vertices.astype(np.float32), faces.astype(np.int32)
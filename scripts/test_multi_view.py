@@ -25,7 +25,8 @@ def test_multi_view():
     print("\n✅ Multi-view test completed!")
     print("\n📋 Usage Instructions:")
     print("  • Single view: python scripts/auto_generate_custom_dataset.py")
-    print("  • Multi view:  python -c \"from scripts.auto_generate_custom_dataset import auto_generate_custom_dataset; auto_generate_custom_dataset(multi_view=True)\"")
+    print("  • Multi view:  python scripts/auto_generate_custom_dataset.py --multi_view")
+    print("  • Only append new or changed images: add --incremental")
 
 if __name__ == "__main__":
     test_multi_view()
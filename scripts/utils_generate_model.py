@@ -1,18 +1,23 @@
 import json
 import subprocess
 import trimesh
-from trimesh.sample import sample_surface
 import numpy as np
 from plyfile import PlyData, PlyElement
 import os
 import random
 from scipy.spatial import cKDTree as KDTree
 import ast
+import re
+
+from llava.eval.jsonl_io import read_columns
+from tessellation_cache import DEFAULT_TOLERANCE, DEFAULT_ANGULAR_TOLERANCE, mesh_path_for, to_shape, shape_to_mesh, save_mesh, write_stl
 
 def read_jsonl(file_path, *keys):
     """
     Reads a JSONL file and extracts specific keys from each dictionary.
 
+    The file is streamed and only the requested keys are kept, see llava/eval/jsonl_io.py.
+
     Args:
         file_path (str): Path to the JSONL file.
         *keys (str): One or more keys to extract from each JSON object.
@@ -20,15 +25,7 @@ def read_jsonl(file_path, *keys):
     Returns:
         tuple: A tuple of lists, each corresponding to the extracted values for a given key.
     """
-    results = {key: [] for key in keys}  # Create a dictionary to store lists for each key
-
-    with open(file_path, 'r', encoding='utf-8') as file:
-        for line in file:
-            data = json.loads(line)  # Parse each line as a JSON object
-            for key in keys:
-                results[key].append(data.get(key, None))  # Append value or None if key is missing
-
-    return tuple(results[key] for key in keys)  # Return lists as a tuple
+    return read_columns(file_path, *keys)
 
 
 def write_python_file(file_content, py_path):
@@ -66,23 +63,117 @@ def run_python_script(py_path):
         traceback.print_exc()
         return False
     
+PLY_VERTEX_DTYPE = np.dtype([('x', 'f4'), ('y', 'f4'), ('z', 'f4')])
+
 # Writing ply file, from GenCAD/Ferdous's repo
 def write_ply(points, filename, text=False):
     """ input: Nx3, write points to filename as PLY format. """
-    points = [(points[i,0], points[i,1], points[i,2]) for i in range(points.shape[0])]
-    vertex = np.array(points, dtype=[('x', 'f4'), ('y', 'f4'),('z', 'f4')])
+    # a contiguous float32 Nx3 array has the same memory layout as the structured vertex array
+    vertex = np.ascontiguousarray(points, dtype=np.float32).view(PLY_VERTEX_DTYPE).reshape(-1)
     el = PlyElement.describe(vertex, 'vertex', comments=['vertices'])
     with open(filename, mode='wb') as f:
         PlyData([el], text=text).write(f)
     return
 
+def read_ply(filename):
+    """ read the vertices of a PLY file written by write_ply as a Nx3 array. """
+    vertex = PlyData.read(filename)['vertex']
+    return np.stack([vertex['x'], vertex['y'], vertex['z']], axis=1).astype(np.float64)
+
+# bump when sample_surface_reps draws different points for the same mesh and seed, it keys the cached GT point clouds
+SAMPLER_VERSION = 1
+
+def sample_surface_reps(vertices, faces, n_points, seeds):
+    """
+    Sample n_points uniformly on a triangle mesh for every seed, with one vectorized pass over all reps.
+
+    The face area CDF is computed once, each rep draws from its own np.random.Generator so it is reproducible
+    independently of the other reps (and of the global NumPy RNG).
+
+    Returns:
+        np.ndarray: [len(seeds), n_points, 3]
+    """
+    vertices = np.asarray(vertices, dtype=np.float64)
+    faces = np.asarray(faces, dtype=np.int64)
+    a = vertices[faces[:, 0]]
+    e0 = vertices[faces[:, 1]] - a
+    e1 = vertices[faces[:, 2]] - a
+    cdf = np.cumsum(np.linalg.norm(np.cross(e0, e1), axis=1))
+    cdf /= cdf[-1]
+
+    # [R, n_points, 3] uniforms: one to pick the face, two barycentric coordinates
+    uniforms = np.stack([np.random.default_rng(seed).random((n_points, 3)) for seed in seeds], axis=0)
+    face_index = np.minimum(np.searchsorted(cdf, uniforms[..., 0], side='right'), len(faces) - 1)
+    u, v = uniforms[..., 1:2], uniforms[..., 2:3]
+    # fold the points of the unit square that fall outside the triangle back inside
+    outside = (u + v) > 1
+    u, v = np.where(outside, 1 - u, u), np.where(outside, 1 - v, v)
+    return a[face_index] + u * e0[face_index] + v * e1[face_index]
+
+def sample_point_clouds(vertices, faces, point_cloud_paths, n_points, seeds):
+    """Sample and write one point cloud per (path, seed), the mesh is only processed once."""
+    out_pcs = sample_surface_reps(vertices, faces, n_points, seeds)
+    for out_pc, point_cloud_path in zip(out_pcs, point_cloud_paths):
+        write_ply(out_pc, point_cloud_path)
+    return out_pcs
+
 # From DeepCAD
-def convert_stl_to_point_cloud(stl_path, point_cloud_path, n_points, seed=42):
-    np.random.seed(seed)
+def convert_stl_to_point_clouds(stl_path, point_cloud_paths, n_points, seeds):
+    """Load the STL once and write one point cloud per (path, seed)."""
     out_mesh = trimesh.load(stl_path) # load the stl as a mesh
-    out_pc, _ = sample_surface(out_mesh, n_points) # convert to a point cloud
-    write_ply(out_pc, point_cloud_path)
-    return out_pc
+    return sample_point_clouds(out_mesh.vertices, out_mesh.faces, point_cloud_paths, n_points, seeds)
+
+def convert_stl_to_point_cloud(stl_path, point_cloud_path, n_points, seed=42):
+    return convert_stl_to_point_clouds(stl_path, [point_cloud_path], n_points, [seed])[0]
+
+def clean_model_code(code):
+    """Strip the markdown code fences the model sometimes wraps its answer in."""
+    if "```python" in code:
+        code = re.sub(r"```[a-zA-Z]*\n|```", "", code)
+    return code
+
+def export_cad(namespace, stl_path, step_path, pc_paths, n_points=2000, tolerance=DEFAULT_TOLERANCE, angular_tolerance=DEFAULT_ANGULAR_TOLERANCE):
+    """
+    Export the `solid` left in the namespace of an executed CadQuery script, so the script only runs once.
+
+    The solid is tessellated once: the mesh is stored next to the STL as {name}.mesh (see tessellation_cache),
+    the STL is written from it and the point clouds are sampled from it. The STEP is written from the solid.
+    Meant to be used as the CadExecutor handler.
+
+    Args:
+        namespace (dict): globals of the executed script.
+        pc_paths (list): (point_cloud_path, seed) for every point cloud rep.
+
+    Returns:
+        dict: valid_stl, valid_pc, export_error and export_error_type (None if everything was exported).
+    """
+    import cadquery as cq
+    result = {"valid_stl": False, "valid_pc": False, "export_error": None, "export_error_type": None}
+
+    solid = namespace.get("solid")
+    if solid is None:
+        result["export_error"] = "the script does not define `solid`"
+        return result
+    try:
+        vertices, faces = shape_to_mesh(to_shape(solid), tolerance, angular_tolerance)
+        save_mesh(mesh_path_for(stl_path), vertices, faces, tolerance, angular_tolerance)
+        write_stl(stl_path, vertices, faces)
+        cq.exporters.export(solid, step_path)
+        result["valid_stl"] = os.path.isfile(stl_path)
+    except Exception as e:
+        result["export_error"] = f"{type(e).__name__}: {e}"
+        result["export_error_type"] = type(e).__name__
+        return result
+
+    if result["valid_stl"] and len(pc_paths) > 0:
+        try:
+            point_cloud_paths, seeds = zip(*pc_paths)
+            sample_point_clouds(vertices, faces, point_cloud_paths, n_points, seeds)
+            result["valid_pc"] = any(os.path.isfile(point_cloud_path) for point_cloud_path in point_cloud_paths)
+        except Exception as e:
+            result["export_error"] = f"point cloud generation failed, {type(e).__name__}: {e}"
+            result["export_error_type"] = type(e).__name__
+    return result
 
 def validate_cadquery_syntax(code):
     """Validate CadQuery code syntax without importing the actual modules"""
@@ -5,6 +5,16 @@ IFS=',' read -ra GPULIST <<< "$gpu_list"
 
 CHUNKS=${#GPULIST[@]}
 
+# Questions generated together on each GPU (length bucketed, answers keep the question order)
+BATCH_SIZE=${BATCH_SIZE:-8}
+
+# Speculative decoding: none, prompt_lookup, or draft_model with DRAFT_MODEL set to a small LM sharing the tokenizer
+SPECULATIVE=${SPECULATIVE:-none}
+DRAFT_MODEL=${DRAFT_MODEL:-}
+
+# GRAMMAR=cadquery restricts the answers to the GenCAD-Code CadQuery statements (not with SPECULATIVE)
+GRAMMAR=${GRAMMAR:-none}
+
 # CKPT="CADCODER/CAD-Coder"
 # SPLIT="cadquery_test_data_subset100"
 
@@ -16,28 +26,33 @@ SPLIT=$2
 
 CKPT="${MODEL##*/}"
 
+RESULT_DIR=./inference/inference_results/$CKPT/$SPLIT
+QUEUE_DIR=$RESULT_DIR/queue
+
+# Questions are handed out to the GPUs batch by batch from a shared queue, so no GPU idles while another
+# finishes a long chunk. Completed questions are checkpointed, running the script again resumes the evaluation
+# (delete $QUEUE_DIR and the worker files to start over).
+python -m llava.eval.eval_queue init $QUEUE_DIR ./inference/$SPLIT.jsonl
+
 for IDX in $(seq 0 $((CHUNKS-1))); do
     CUDA_VISIBLE_DEVICES=${GPULIST[$IDX]} python -m llava.eval.model_vqa_loader \
         --model-path $MODEL \
         --question-file ./inference/$SPLIT.jsonl \
         --image-folder ./inference/test100_images \
-        --answers-file ./inference/inference_results/$CKPT/$SPLIT/${CHUNKS}_${IDX}.jsonl \
-        --num-chunks $CHUNKS \
-        --chunk-idx $IDX \
+        --answers-file $RESULT_DIR/worker_${IDX}.jsonl \
+        --work-queue $QUEUE_DIR \
         --temperature 0 \
         --max_new_tokens 3450\
+        --batch-size $BATCH_SIZE \
+        --speculative $SPECULATIVE \
+        ${DRAFT_MODEL:+--draft-model-path $DRAFT_MODEL} \
+        --grammar $GRAMMAR \
         --conv-mode vicuna_v1 &
 done
 
 wait
 
-output_file=./inference/inference_results/$CKPT/$SPLIT/merge.jsonl
-
-# Clear out the output file if it exists.
-> "$output_file"
-
-# Loop through the indices and concatenate each file.
-for IDX in $(seq 0 $((CHUNKS-1))); do
-    cat ./inference/inference_results/$CKPT/$SPLIT/${CHUNKS}_${IDX}.jsonl >> "$output_file"
-done
+output_file=$RESULT_DIR/merge.jsonl
 
+# Merge the worker files in question file order (streamed, the output file is replaced atomically).
+python -m llava.eval.eval_queue merge $QUEUE_DIR "$output_file" $RESULT_DIR/worker_*.jsonl
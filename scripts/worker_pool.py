@@ -0,0 +1,147 @@
+import multiprocessing as mp
+import time
+from multiprocessing.connection import wait
+
+
+def _worker_loop(conn, func, initializer, initargs):
+    """Worker process: run func on each task received through conn until None is received."""
+    if initializer is not None:
+        initializer(*initargs)
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+        start = time.time()
+        try:
+            result = func(task)
+            status = "ok"
+        except Exception as e:
+            result = f"{type(e).__name__}: {e}"
+            status = "error"
+        conn.send((status, result, time.time() - start))
+    conn.close()
+
+
+class TimeoutPool:
+    """
+    Process pool with a per-task timeout.
+
+    Each worker talks to the parent through its own pipe, so a worker that exceeds the timeout
+    or crashes (e.g. a segfault in OCP) can be killed and respawned without affecting the others.
+
+    Example:
+        with TimeoutPool(evaluate_pair, num_workers=8, timeout=120) as pool:
+            for task, status, result, seconds in pool.imap_unordered(tasks):
+                ...
+
+    status is one of "ok" (result is the return value), "error" (result is the exception message),
+    "timeout" or "crash".
+    """
+
+    def __init__(self, func, num_workers, timeout=None, initializer=None, initargs=()):
+        self.func = func
+        self.num_workers = max(1, num_workers)
+        self.timeout = timeout
+        self.initializer = initializer
+        self.initargs = initargs
+        self.ctx = mp.get_context()
+        self.workers = []
+
+    def _spawn(self):
+        parent_conn, child_conn = self.ctx.Pipe()
+        process = self.ctx.Process(
+            target=_worker_loop, args=(child_conn, self.func, self.initializer, self.initargs), daemon=True
+        )
+        process.start()
+        child_conn.close()
+        return {"process": process, "conn": parent_conn, "task": None, "start": None}
+
+    def _kill(self, worker):
+        worker["conn"].close()
+        if worker["process"].is_alive():
+            worker["process"].kill()
+        worker["process"].join()
+
+    def _exit_message(self, worker):
+        worker["process"].join(timeout=1) # the pipe can close before the exit code is available
+        return f"worker exited with code {worker['process'].exitcode}"
+
+    def _assign(self, index, tasks):
+        """Send the next task to worker index, respawning it if its pipe is broken. Returns False when no task is left."""
+        try:
+            task = next(tasks)
+        except StopIteration:
+            return False
+        try:
+            self.workers[index]["conn"].send(task)
+        except (BrokenPipeError, OSError):
+            self._kill(self.workers[index])
+            self.workers[index] = self._spawn()
+            self.workers[index]["conn"].send(task)
+        self.workers[index]["task"] = task
+        self.workers[index]["start"] = time.time()
+        return True
+
+    def imap_unordered(self, tasks):
+        """Yield (task, status, result, seconds) for every task, in completion order."""
+        tasks = iter(tasks)
+        if len(self.workers) == 0:
+            self.workers = [self._spawn() for _ in range(self.num_workers)]
+
+        for i in range(len(self.workers)):
+            if not self._assign(i, tasks):
+                break
+
+        while True:
+            busy = [w for w in self.workers if w["task"] is not None]
+            if len(busy) == 0:
+                break
+            ready = wait([w["conn"] for w in busy] + [w["process"].sentinel for w in busy], timeout=0.1)
+            now = time.time()
+
+            for i, worker in enumerate(self.workers):
+                if worker["task"] is None:
+                    continue
+
+                outcome = None
+                if worker["conn"] in ready:
+                    try:
+                        outcome = worker["conn"].recv()
+                    except (EOFError, OSError):
+                        outcome = ("crash", self._exit_message(worker), now - worker["start"])
+                elif worker["process"].sentinel in ready:
+                    outcome = ("crash", self._exit_message(worker), now - worker["start"])
+                elif self.timeout is not None and now - worker["start"] > self.timeout:
+                    outcome = ("timeout", f"exceeded {self.timeout}s", now - worker["start"])
+
+                if outcome is None:
+                    continue
+
+                task = worker["task"]
+                worker["task"] = None
+                if outcome[0] in ("timeout", "crash"):
+                    self._kill(worker)
+                    self.workers[i] = self._spawn()
+
+                yield (task,) + tuple(outcome)
+                self._assign(i, tasks)
+
+    def close(self):
+        for worker in self.workers:
+            try:
+                worker["conn"].send(None)
+            except (BrokenPipeError, OSError):
+                pass
+        for worker in self.workers:
+            worker["process"].join(timeout=5)
+            self._kill(worker)
+        self.workers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
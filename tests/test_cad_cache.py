@@ -0,0 +1,148 @@
+import os
+
+import numpy as np
+import pytest
+
+from cad_cache import CadCache, code_hash, execute_with_cache
+from tessellation_cache import load_mesh, mesh_path_for, save_mesh
+
+
+def ok_result(valid_stl=True):
+    return {"status": "ok", "error_type": None, "error": None, "seconds": 1.0,
+            "output": {"valid_stl": valid_stl, "valid_pc": valid_stl, "export_error": None, "export_error_type": None}}
+
+
+def error_result(error_type, status="error"):
+    return {"status": status, "error_type": error_type, "error": "message", "output": None, "seconds": 1.0}
+
+
+def job_paths(root, name, reps=(42,)):
+    return f"{root}/{name}.stl", f"{root}/{name}.step", [(f"{root}/{name}_{seed}.ply", seed) for seed in reps]
+
+
+def export(paths, content):
+    stl_path, step_path, pc_paths = paths
+    for path in [stl_path, step_path] + [path for path, _ in pc_paths]:
+        with open(path, "w") as f:
+            f.write(content)
+    save_mesh(mesh_path_for(stl_path), np.eye(3), np.array([[0, 1, 2]]))
+
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+
+class FakeExecutor:
+    """Exports every job with its code as the file content, and records what ran."""
+
+    def __init__(self):
+        self.executed = []
+
+    def run(self, jobs):
+        for key, code, paths in jobs:
+            self.executed.append(code)
+            export(paths, code)
+            yield key, ok_result()
+
+
+def test_code_hash_ignores_formatting():
+    assert code_hash("x = 1  # one\ny = 'a'\n") == code_hash('x=1\n\ny = "a"')
+    assert code_hash("x = 1") != code_hash("x = 2")
+
+
+def test_restore_hit_and_miss(tmp_path):
+    cache = CadCache(str(tmp_path / "cache"))
+    key = code_hash("solid = 1")
+    assert cache.restore(key, *job_paths(tmp_path, "a")) is None
+
+    export(job_paths(tmp_path, "a"), "a")
+    cache.put(key, ok_result(), *job_paths(tmp_path, "a"))
+    result = cache.restore(key, *job_paths(tmp_path, "b"))
+    assert result["cached"] and result["output"]["valid_stl"]
+    assert read(tmp_path / "b.stl") == read(tmp_path / "b_42.ply") == "a"
+    assert load_mesh(mesh_path_for(str(tmp_path / "b.stl")))[1].tolist() == [[0, 1, 2]]
+    # a point cloud rep that was not stored is a miss, the script runs again to sample it
+    assert cache.restore(key, *job_paths(tmp_path, "c", reps=(42, 43))) is None
+
+
+@pytest.mark.parametrize("error_type", ["MemoryError", "CpuLimitExceeded", "ModuleNotFoundError"])
+def test_resource_errors_are_not_cached(tmp_path, error_type):
+    cache = CadCache(str(tmp_path / "cache"))
+    cache.put("k" * 64, error_result(error_type), *job_paths(tmp_path, "a"))
+    assert cache.restore("k" * 64, *job_paths(tmp_path, "a")) is None
+
+
+def test_export_memory_error_is_not_cached(tmp_path):
+    cache = CadCache(str(tmp_path / "cache"))
+    result = ok_result(valid_stl=False)
+    result["output"].update(export_error="MemoryError: ", export_error_type="MemoryError")
+    cache.put("k" * 64, result, *job_paths(tmp_path, "a"))
+    assert cache.restore("k" * 64, *job_paths(tmp_path, "a")) is None
+
+
+@pytest.mark.parametrize("status", ["timeout", "crash"])
+def test_timeouts_and_crashes_are_not_cached(tmp_path, status):
+    cache = CadCache(str(tmp_path / "cache"))
+    cache.put("k" * 64, error_result(status, status=status), *job_paths(tmp_path, "a"))
+    assert cache.restore("k" * 64, *job_paths(tmp_path, "a")) is None
+
+
+def test_script_errors_are_cached(tmp_path):
+    cache = CadCache(str(tmp_path / "cache"))
+    cache.put("k" * 64, error_result("ValueError"), *job_paths(tmp_path, "a"))
+    result = cache.restore("k" * 64, *job_paths(tmp_path, "b"))
+    assert result["status"] == "error" and result["error_type"] == "ValueError" and result["cached"]
+
+
+def test_evict_least_recently_used(tmp_path):
+    cache = CadCache(str(tmp_path / "cache"))
+    keys = [code_hash(f"solid = {i}") for i in range(3)]
+    for i, key in enumerate(keys):
+        export(job_paths(tmp_path, f"s{i}"), "x" * 1000)
+        cache.put(key, ok_result(), *job_paths(tmp_path, f"s{i}"))
+        os.utime(os.path.join(cache._entry_dir(key), "result.json"), (1000 + i, 1000 + i))
+    # the oldest entry is used again, so the second one is the least recently used
+    assert cache.restore(keys[0], *job_paths(tmp_path, "r")) is not None
+    cache.max_size = 2 * 5000
+    cache.evict()
+    assert [cache.restore(key, *job_paths(tmp_path, "r")) is not None for key in keys] == [True, False, True]
+
+
+def test_put_evicts_every_evict_every_writes(tmp_path):
+    cache = CadCache(str(tmp_path / "cache"), max_size_gb=0, evict_every=3)
+    for i in range(7):
+        cache.put(code_hash(f"x = {i}"), error_result("ValueError"), *job_paths(tmp_path, "a"))
+    # evicted after the 3rd and the 6th write, only the 7th is left
+    assert [cache.restore(code_hash(f"x = {i}"), *job_paths(tmp_path, "a")) is not None for i in range(7)] == [False] * 6 + [True]
+
+
+def test_execute_with_cache_runs_identical_programs_once(tmp_path):
+    cache = CadCache(str(tmp_path / "cache"))
+    jobs = [(i, code, job_paths(tmp_path, f"q{i}")) for i, code in enumerate(["a = 1", "a=1  # same", "b = 2"])]
+    executor = FakeExecutor()
+    results = dict(execute_with_cache(executor, jobs, cache))
+    assert sorted(executor.executed) == ["a = 1", "b = 2"]
+    assert all(results[i]["output"]["valid_stl"] for i in range(3))
+    # the duplicate got its own files
+    assert read(tmp_path / "q1.stl") == "a = 1"
+
+    # a second run is served from the cache
+    executor = FakeExecutor()
+    results = dict(execute_with_cache(executor, jobs, cache))
+    assert executor.executed == [] and all(results[i]["cached"] for i in range(3))
+
+
+def test_duplicates_get_their_files_when_the_result_is_not_cached(tmp_path):
+    cache = CadCache(str(tmp_path / "cache"))
+
+    class MemoryErrorExecutor(FakeExecutor):
+        def run(self, jobs):
+            for key, result in super().run(jobs):
+                result["output"].update(export_error_type="MemoryError")
+                yield key, result
+
+    jobs = [(i, "a = 1", job_paths(tmp_path, f"q{i}")) for i in range(2)]
+    results = dict(execute_with_cache(MemoryErrorExecutor(), jobs, cache))
+    assert results[1]["output"]["valid_stl"] and read(tmp_path / "q1.stl") == "a = 1"
+    assert cache.restore(code_hash("a = 1"), *job_paths(tmp_path, "r")) is None
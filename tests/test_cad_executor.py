@@ -0,0 +1,61 @@
+import pytest
+
+from cad_executor import CadExecutor
+
+
+def read_result(namespace, name):
+    # handlers run in the worker after the code, their return value is stored under "output"
+    return namespace[name]
+
+
+def run(code, **kwargs):
+    with CadExecutor(1, preload_modules=(), handler=read_result, **kwargs) as executor:
+        return executor.execute(code, "result")
+
+
+def test_handler_output_and_fresh_namespace():
+    with CadExecutor(1, preload_modules=(), handler=read_result) as executor:
+        results = dict(executor.run([(0, "result = 6 * 7", ["result"]), (1, "result = 'x' in globals()", ["result"])]))
+    assert results[0]["status"] == "ok" and results[0]["output"] == 42
+    assert results[1]["output"] is False
+
+
+def test_cpu_limit():
+    result = run("while True:\n    pass", cpu_seconds=1, timeout=30)
+    assert result["status"] == "error" and result["error_type"] == "CpuLimitExceeded"
+
+
+def test_cpu_limit_is_per_job():
+    # the limit is relative to the CPU time the worker already used
+    with CadExecutor(1, cpu_seconds=1, timeout=30, preload_modules=(), handler=read_result) as executor:
+        code = "import time\nstart = time.process_time()\nwhile time.process_time() - start < 0.6:\n    pass\nresult = 1"
+        results = [result for _, result in executor.run((i, code, ["result"]) for i in range(3))]
+    assert [result["status"] for result in results] == ["ok"] * 3
+
+
+def test_memory_limit():
+    result = run("result = bytearray(1 << 32)", memory_mb=512)
+    assert result["status"] == "error" and result["error_type"] == "MemoryError"
+
+
+def test_timeout():
+    result = run("import time\ntime.sleep(30)", timeout=1)
+    assert result["status"] == "timeout" and result["output"] is None
+
+
+def test_crash():
+    result = run("import os\nos._exit(1)")
+    assert result["status"] == "crash"
+
+
+def test_system_exit_is_an_error():
+    result = run("import sys\nsys.exit(2)")
+    assert result["status"] == "error" and result["error_type"] == "SystemExit"
+    with CadExecutor(0) as executor:
+        assert executor.execute("raise SystemExit(2)")["status"] == "error"
+
+
+def test_inline_keyboard_interrupt_propagates():
+    with CadExecutor(0) as executor:
+        with pytest.raises(KeyboardInterrupt):
+            executor.execute("raise KeyboardInterrupt")
@@ -0,0 +1,105 @@
+import json
+
+import pytest
+import torch
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+from transformers import PreTrainedTokenizerFast
+
+from llava.model.cadquery_grammar import CadQueryLogitsProcessor, load_cadquery_automaton
+
+GT_FILE = "inference/cadquery_test_data_subset100.jsonl"
+
+
+@pytest.fixture(scope="module")
+def ground_truth():
+    with open(GT_FILE, "r", encoding="utf-8") as f:
+        return [json.loads(line)["ground_truth"] for line in f]
+
+
+@pytest.fixture(scope="module")
+def tokenizer(ground_truth):
+    """Small Llama-like tokenizer (metaspace BPE with byte fallback) trained on the ground truth scripts."""
+    tokenizer = Tokenizer(models.BPE(unk_token="<unk>", byte_fallback=True))
+    tokenizer.pre_tokenizer = pre_tokenizers.Metaspace()
+    tokenizer.decoder = decoders.Sequence([decoders.ByteFallback(), decoders.Metaspace()])
+    special_tokens = ["<unk>", "<s>", "</s>"] + [f"<0x{i:02X}>" for i in range(256)]
+    tokenizer.train_from_iterator(ground_truth, trainers.BpeTrainer(vocab_size=1000, special_tokens=special_tokens))
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizer, unk_token="<unk>", bos_token="<s>", eos_token="</s>")
+
+
+@pytest.fixture(scope="module")
+def automaton(tokenizer, tmp_path_factory):
+    return load_cadquery_automaton(tokenizer, str(tmp_path_factory.mktemp("grammar")))
+
+
+def walk(automaton, token_ids, state=0):
+    for token_id in token_ids:
+        state = automaton.next_state(state, token_id)
+        if state is None or state < 0:
+            return state
+    return state
+
+
+def allowed(scores):
+    return set(torch.nonzero(torch.isfinite(scores)).flatten().tolist())
+
+
+def test_accepts_every_ground_truth_script(tokenizer, automaton, ground_truth):
+    for code in ground_truth:
+        token_ids = tokenizer(code, add_special_tokens=False)["input_ids"]
+        state = walk(automaton, token_ids)
+        assert state is not None and state >= 0, code[:80]
+        # EOS is allowed at the end of the script, and ends the automaton
+        assert automaton.next_state(state, tokenizer.eos_token_id) == -1
+
+
+def test_rejects_scripts_outside_the_grammar(tokenizer, automaton):
+    for code in ["import numpy as np\n", "import cadquery as cq\nsolid = open('/etc/passwd')\n"]:
+        assert walk(automaton, tokenizer(code, add_special_tokens=False)["input_ids"]) is None
+    # EOS is not allowed before a complete statement
+    assert automaton.next_state(0, tokenizer.eos_token_id) is None
+
+
+def test_processor_masks_the_tokens_the_state_does_not_allow(tokenizer, automaton, ground_truth):
+    vocab_size = len(tokenizer)
+    token_ids = tokenizer(ground_truth[0], add_special_tokens=False)["input_ids"][:20]
+    processor = CadQueryLogitsProcessor(automaton)
+    prompt = torch.tensor([[1, 5, 6]])
+    for step in range(len(token_ids)):
+        input_ids = torch.cat([prompt, torch.tensor([token_ids[:step]], dtype=torch.long)], dim=1)
+        scores = processor(input_ids, torch.zeros(1, vocab_size))
+        state = walk(automaton, token_ids[:step])
+        expected = {t for t in range(vocab_size) if automaton.next_state(state, t) is not None}
+        assert allowed(scores[0]) == expected
+        assert token_ids[step] in expected
+        assert 0 < len(expected) < vocab_size
+
+
+def test_processor_follows_reordered_beams(tokenizer, automaton, ground_truth):
+    vocab_size = len(tokenizer)
+    length = 40
+    scripts = [tokenizer(code, add_special_tokens=False)["input_ids"][:length] for code in ground_truth]
+    # two scripts that are in different states after length tokens
+    a = scripts[0]
+    b = next(ids for ids in scripts[1:] if walk(automaton, ids) != walk(automaton, a))
+    processor = CadQueryLogitsProcessor(automaton, num_beams=2)
+    for step in range(length):
+        processor(torch.tensor([a[:step], b[:step]], dtype=torch.long).reshape(2, step), torch.zeros(2, vocab_size))
+    # beam search swapped the rows
+    scores = processor(torch.tensor([b, a]), torch.zeros(2, vocab_size))
+    for row, ids in enumerate([b, a]):
+        state = walk(automaton, ids)
+        assert allowed(scores[row]) == {t for t in range(vocab_size) if automaton.next_state(state, t) is not None}
+
+
+def test_processor_stops_constraining_a_row_after_eos_and_resets_on_a_new_prompt(tokenizer, automaton, ground_truth):
+    vocab_size = len(tokenizer)
+    processor = CadQueryLogitsProcessor(automaton)
+    processor(torch.tensor([[1, 5]]), torch.zeros(1, vocab_size))
+    # a token forced past the processor (e.g. the pad token once a row is finished) leaves the row unconstrained
+    scores = processor(torch.tensor([[1, 5, tokenizer.eos_token_id]]), torch.zeros(1, vocab_size))
+    assert allowed(scores[0]) == set(range(vocab_size))
+    # a new generate call with the same processor starts from the initial state again
+    scores = processor(torch.tensor([[1, 5, 6, 7], [1, 8, 9, 10]]), torch.zeros(2, vocab_size))
+    expected = {t for t in range(vocab_size) if automaton.next_state(0, t) is not None}
+    assert allowed(scores[0]) == allowed(scores[1]) == expected
@@ -0,0 +1,79 @@
+import json
+
+from torch.utils.data import DataLoader
+
+from llava.eval.eval_queue import WorkQueue, QueueBatchSampler, merge_answers
+
+
+def write_questions(path, n):
+    with open(path, "w", encoding="utf-8") as f:
+        for i in range(n):
+            # prompt lengths are not monotonic in the position, so the queue order differs from the file order
+            f.write(json.dumps({"question_id": 100 + i, "text": "x" * ((i * 7) % 11)}) + "\n")
+    return [100 + i for i in range(n)]
+
+
+def answer(queue, positions, question_ids, answer_file):
+    with open(answer_file, "a", encoding="utf-8") as f:
+        for position in positions:
+            f.write(json.dumps({"question_id": question_ids[position], "text": f"answer {position}"}) + "\n")
+    queue.complete([question_ids[position] for position in positions])
+
+
+def read_answers(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_claim_longest_first_and_drain(tmp_path):
+    question_file = tmp_path / "questions.jsonl"
+    question_ids = write_questions(question_file, 10)
+    queue = WorkQueue.create(str(tmp_path / "queue"), str(question_file))
+
+    positions = queue.claim(4)
+    lengths = [(p * 7) % 11 for p in positions]
+    assert lengths == sorted(lengths, reverse=True)
+    assert queue.num_remaining() == 6
+    assert len(queue.claim(100)) == 6
+    assert queue.claim(4) == []
+
+    answer(queue, positions, question_ids, tmp_path / "answers.jsonl")
+    assert queue.completed() == {question_ids[p] for p in positions}
+
+
+def test_two_workers_resume_and_merge(tmp_path):
+    question_file = tmp_path / "questions.jsonl"
+    question_ids = write_questions(question_file, 13)
+    queue_dir = str(tmp_path / "queue")
+    worker_files = [tmp_path / "worker_0.jsonl", tmp_path / "worker_1.jsonl"]
+    WorkQueue.create(queue_dir, str(question_file))
+
+    # worker 0 answers one batch, then dies with a second batch claimed but not completed
+    worker_0 = WorkQueue(queue_dir)
+    answer(worker_0, worker_0.claim(3), question_ids, worker_files[0])
+    stranded = worker_0.claim(3)
+    # worker 1 drains the rest of the queue through the DataLoader, as model_vqa_loader does
+    worker_1 = WorkQueue(queue_dir)
+    sampler = QueueBatchSampler(worker_1, batch_size=4)
+    data_loader = DataLoader(list(range(len(question_ids))), batch_sampler=sampler, collate_fn=list)
+    for batch, positions in zip(data_loader, sampler.claimed_batches()):
+        assert batch == positions
+        answer(worker_1, positions, question_ids, worker_files[1])
+
+    assert merge_answers(str(question_file), [str(f) for f in worker_files], str(tmp_path / "merge.jsonl")) == len(stranded)
+
+    # the next init queues the stranded questions again, and only them
+    queue = WorkQueue.create(queue_dir, str(question_file))
+    assert sorted(queue.order) == sorted(stranded)
+    # a question answered twice (a worker restarted mid-batch), the answer read last wins
+    with open(worker_files[1], "a", encoding="utf-8") as f:
+        f.write(json.dumps({"question_id": question_ids[0], "text": "rewritten"}) + "\n")
+    answer(queue, queue.claim(10), question_ids, worker_files[0])
+    assert queue.claim(10) == []
+
+    merge_path = tmp_path / "merge.jsonl"
+    assert merge_answers(str(question_file), [str(f) for f in worker_files], str(merge_path)) == 0
+    merged = read_answers(merge_path)
+    assert [a["question_id"] for a in merged] == question_ids
+    assert merged[0]["text"] == "rewritten"
+    assert all(a["text"] == f"answer {i}" for i, a in enumerate(merged[1:], start=1))
@@ -0,0 +1,75 @@
+import json
+import os
+import pickle
+
+from llava.eval.jsonl_io import JsonlIndex, iter_jsonl, merge_jsonl, read_columns, resume_jsonl
+
+
+def write_jsonl(path, records, tail=""):
+    with open(path, "w") as f:
+        f.writelines(json.dumps(record) + "\n" for record in records)
+        f.write(tail)
+
+
+def records(ids):
+    return [{"question_id": i, "text": "x" * i, "answer": i * 2} for i in ids]
+
+
+def test_iter_jsonl_projects_keys_and_skips_blank_lines(tmp_path):
+    path = tmp_path / "a.jsonl"
+    write_jsonl(path, records([1, 2]), tail="\n")
+    assert list(iter_jsonl(path, ["question_id", "missing"])) == [{"question_id": 1, "missing": None}, {"question_id": 2, "missing": None}]
+    assert read_columns(path, "question_id", "answer") == ([1, 2], [2, 4])
+
+
+def test_index_by_position_and_key(tmp_path):
+    path = tmp_path / "a.jsonl"
+    write_jsonl(path, records([5, 3, 9]))
+    index = JsonlIndex(str(path))
+    assert len(index) == 3 and 3 in index and 4 not in index
+    assert index[2] == records([9])[0]
+    assert index.get(3) == records([3])[0] and index.get(4) is None
+    # the index survives pickling (dataloader workers) and reopens the file
+    assert pickle.loads(pickle.dumps(index)).get(5) == records([5])[0]
+
+
+def test_index_is_cached_and_rebuilt_when_the_file_changes(tmp_path):
+    path = tmp_path / "a.jsonl"
+    write_jsonl(path, records([1, 2]))
+    JsonlIndex(str(path))
+    assert os.path.exists(f"{path}.idx")
+
+    # a stale index with the right size and mtime is trusted, so tampering with it shows the cache is used
+    with open(f"{path}.idx") as f:
+        cached = json.load(f)
+    cached["keys"] = [10, 20]
+    with open(f"{path}.idx", "w") as f:
+        json.dump(cached, f)
+    assert JsonlIndex(str(path)).keys == [10, 20]
+
+    write_jsonl(path, records([1, 2, 3]))
+    assert JsonlIndex(str(path)).get(3) == records([3])[0]
+    # another key also rebuilds it
+    assert JsonlIndex(str(path), key="answer").get(6) == records([3])[0]
+
+
+def test_resume_truncates_a_partial_last_line(tmp_path):
+    path = tmp_path / "answers.jsonl"
+    assert resume_jsonl(str(path)) == set()
+    write_jsonl(path, records([1, 2]), tail='{"question_id": 3, "te')
+    assert resume_jsonl(str(path)) == {1, 2}
+    # appending after the resume gives a valid file
+    with open(path, "a") as f:
+        f.write(json.dumps(records([3])[0]) + "\n")
+    assert [record["question_id"] for record in iter_jsonl(path)] == [1, 2, 3]
+    assert resume_jsonl(str(path)) == {1, 2, 3}
+
+
+def test_merge_adds_missing_newlines(tmp_path):
+    write_jsonl(tmp_path / "0.jsonl", records([1]))
+    with open(tmp_path / "1.jsonl", "w") as f:
+        f.write(json.dumps(records([2])[0])) # no trailing newline
+    write_jsonl(tmp_path / "2.jsonl", [])
+    write_jsonl(tmp_path / "3.jsonl", records([3]))
+    merge_jsonl(str(tmp_path / "merge.jsonl"), [str(tmp_path / f"{i}.jsonl") for i in range(4)])
+    assert list(iter_jsonl(tmp_path / "merge.jsonl")) == records([1, 2, 3])
@@ -0,0 +1,61 @@
+import numpy as np
+
+from SolidAlign._batch import batch_alignment_transforms, candidate_rotations, voxelize_mesh
+
+
+def unit_cube():
+    vertices = np.array([[x, y, z] for x in (0, 1) for y in (0, 1) for z in (0, 1)], dtype=np.float64)
+    quads = [(0, 1, 3, 2), (4, 6, 7, 5), (0, 4, 5, 1), (2, 3, 7, 6), (0, 2, 6, 4), (1, 5, 7, 3)]
+    triangles = np.array([t for a, b, c, d in quads for t in ((a, b, c), (a, c, d))])
+    return vertices, triangles
+
+
+def random_rotations(n, seed=0):
+    q, _ = np.linalg.qr(np.random.default_rng(seed).normal(size=(n, 3, 3)))
+    return q * np.sign(np.linalg.det(q))[:, None, None] # proper rotations only
+
+
+def test_voxelize_cube():
+    vertices, triangles = unit_cube()
+    occupancy = voxelize_mesh(vertices, triangles, np.full(3, -0.5), np.full(3, 1.5), resolution=16, chunk_size=5)
+    # the cube covers the middle half of the grid along each axis
+    expected = np.zeros((16, 16, 16), dtype=bool)
+    expected[4:12, 4:12, 4:12] = True
+    assert (occupancy == expected).all()
+
+
+def test_voxelize_is_rotation_consistent():
+    vertices, triangles = unit_cube()
+    R = random_rotations(1)[0]
+    occupancy = voxelize_mesh((vertices - 0.5) @ R.T, triangles, np.full(3, -1.0), np.full(3, 1.0), resolution=32)
+    # a rotated unit cube still fills a volume of 1 out of 8
+    assert abs(occupancy.mean() - 1 / 8) < 0.01
+
+
+def test_candidate_rotations():
+    axes_source, axes_target = random_rotations(5, seed=1), random_rotations(5, seed=2)
+    rotations = candidate_rotations(axes_source, axes_target)
+    assert rotations.shape == (5, 4, 3, 3)
+    assert np.allclose(rotations @ rotations.swapaxes(-1, -2), np.eye(3))
+    assert np.allclose(np.linalg.det(rotations), 1)
+    # every candidate maps the source principal axes onto the target ones, up to sign
+    mapped = rotations @ axes_source[:, None]
+    assert np.allclose(np.abs(mapped), np.abs(axes_target[:, None]))
+    # the first candidate is the identity when the frames agree
+    assert np.allclose(candidate_rotations(axes_source, axes_source)[:, 0], np.eye(3))
+
+
+def test_batch_alignment_transforms():
+    # source i is the target box rotated by R[i], scaled by 2 and moved
+    R = random_rotations(3, seed=3)
+    inertia_target = np.diag([1.0, 2.0, 3.0])
+    inertias_source = 2 ** 5 * R @ inertia_target @ R.swapaxes(-1, -2) # the inertia scales with s^5, the volume with s^3
+    centers_source = np.arange(9, dtype=np.float64).reshape(3, 3)
+    transforms, rotations = batch_alignment_transforms(
+        np.full(3, 8.0), centers_source, inertias_source, np.array(1.0), np.zeros(3), inertia_target
+    )
+    assert transforms.shape == (3, 4, 4, 4) and rotations.shape == (3, 4, 3, 3)
+    # each source center goes to the target center, and one of the candidates undoes the rotation and the scale
+    assert np.allclose(np.einsum("nkij,nj->nki", transforms[..., :3, :3], centers_source) + transforms[..., :3, 3], 0)
+    errors = np.abs(transforms[..., :3, :3] - 0.5 * R.swapaxes(-1, -2)[:, None]).max(axis=(-1, -2))
+    assert (errors.min(axis=1) < 1e-8).all()
@@ -0,0 +1,75 @@
+import pytest
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM
+
+from llava.constants import IMAGE_TOKEN_INDEX
+from llava.model.language_model.llava_llama import LlavaConfig, LlavaLlamaForCausalLM
+from llava.model.speculative import DraftModelDrafter, PromptLookupDrafter, speculative_generate
+
+HIDDEN_SIZE = 32
+NUM_IMAGE_TOKENS = 4
+EOS_TOKEN_ID = 2
+
+
+class TinyTower(torch.nn.Module):
+    """Stands in for the CLIP tower: the first pixels of the image as NUM_IMAGE_TOKENS features."""
+
+    def forward(self, images):
+        return images.flatten(1)[:, :NUM_IMAGE_TOKENS * HIDDEN_SIZE].reshape(images.shape[0], NUM_IMAGE_TOKENS, HIDDEN_SIZE)
+
+
+def tiny_llava(prefix_cache):
+    torch.manual_seed(0)
+    config = LlavaConfig(vocab_size=48, hidden_size=HIDDEN_SIZE, intermediate_size=64, num_hidden_layers=2,
+                         num_attention_heads=4, num_key_value_heads=4, max_position_embeddings=256,
+                         bos_token_id=1, eos_token_id=EOS_TOKEN_ID, pad_token_id=0)
+    model = LlavaLlamaForCausalLM(config).eval()
+    model.model.vision_tower = TinyTower()
+    model.model.mm_projector = torch.nn.Identity()
+    if prefix_cache:
+        model.enable_prefix_cache(max_entries=4)
+    return model
+
+
+def tiny_draft_model(model):
+    """The language model of the target without the image, so its drafts are partly accepted and partly rejected."""
+    config = LlamaConfig(vocab_size=model.config.vocab_size, hidden_size=HIDDEN_SIZE, intermediate_size=64, num_hidden_layers=2,
+                         num_attention_heads=4, num_key_value_heads=4, max_position_embeddings=256)
+    draft_model = LlamaForCausalLM(config).eval()
+    draft_model.load_state_dict(model.state_dict(), strict=False)
+    return draft_model
+
+
+def prompt(seed):
+    generator = torch.Generator().manual_seed(seed)
+    # a repeated span, so prompt lookup has something to draft from
+    text = torch.randint(3, 48, (6,), generator=generator)
+    input_ids = torch.cat([torch.tensor([1, 5, 6, 7]), torch.tensor([IMAGE_TOKEN_INDEX]), text, text])[None]
+    images = torch.randn(1, 3, 8, 8, generator=generator)
+    return input_ids, images
+
+
+@pytest.mark.parametrize("prefix_cache", [False, True])
+@pytest.mark.parametrize("drafter_name", ["prompt_lookup", "draft_model"])
+def test_greedy_speculative_matches_generate(drafter_name, prefix_cache):
+    reference_model = tiny_llava(prefix_cache=False)
+    model = tiny_llava(prefix_cache=prefix_cache)
+    num_accepted = 0
+    for seed in range(3):
+        input_ids, images = prompt(seed)
+        image_sizes = [(8, 8)]
+        with torch.inference_mode():
+            expected = reference_model.generate(input_ids, images=images, image_sizes=image_sizes, do_sample=False,
+                                                max_new_tokens=40, eos_token_id=EOS_TOKEN_ID, pad_token_id=0)
+            # twice, so the second run reads the prompt prefix from the cache
+            for _ in range(2):
+                drafter = PromptLookupDrafter(num_draft_tokens=4, ngram_size=2) if drafter_name == "prompt_lookup" \
+                    else DraftModelDrafter(tiny_draft_model(model), num_draft_tokens=3)
+                output, stats = speculative_generate(model, input_ids, drafter, images=images, image_sizes=image_sizes,
+                                                     max_new_tokens=40, eos_token_id=EOS_TOKEN_ID)
+                assert output.tolist() == expected.tolist()
+                assert stats["num_new_tokens"] == output.shape[1]
+                num_accepted += stats["num_accepted"]
+    assert num_accepted > 0
+    if prefix_cache:
+        assert model.prefix_cache.stats()["hits"] > 0
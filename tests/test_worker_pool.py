@@ -0,0 +1,52 @@
+import os
+import time
+
+from worker_pool import TimeoutPool
+
+
+def run_task(task):
+    # tasks are (kind, value); the pool pickles the function, so it has to live at module level
+    kind, value = task
+    if kind == "sleep":
+        time.sleep(value)
+    elif kind == "crash":
+        os._exit(3)
+    elif kind == "raise":
+        raise ValueError(value)
+    return (kind, value, os.getpid())
+
+
+def run(tasks, num_workers=1, timeout=None):
+    with TimeoutPool(run_task, num_workers, timeout=timeout) as pool:
+        return {task: (status, result) for task, status, result, _ in pool.imap_unordered(tasks)}
+
+
+def test_ok_and_error():
+    results = run([("echo", 1), ("raise", "bad"), ("echo", 2)])
+    assert results[("echo", 1)][0] == results[("echo", 2)][0] == "ok"
+    assert results[("raise", "bad")] == ("error", "ValueError: bad")
+
+
+def test_timed_out_worker_is_respawned():
+    tasks = [("echo", 0), ("sleep", 30), ("echo", 1), ("echo", 2)]
+    start = time.time()
+    results = run(tasks, timeout=1)
+    assert time.time() - start < 10
+    assert results[("sleep", 30)][0] == "timeout"
+    # the single worker was killed and a new process ran the remaining tasks
+    assert results[("echo", 1)][0] == results[("echo", 2)][0] == "ok"
+    assert results[("echo", 0)][1][2] != results[("echo", 1)][1][2]
+
+
+def test_crashed_worker_is_respawned():
+    results = run([("crash", 0), ("echo", 1), ("crash", 1), ("echo", 2)])
+    assert results[("crash", 0)] == ("crash", "worker exited with code 3")
+    assert results[("crash", 1)][0] == "crash"
+    assert results[("echo", 1)][0] == results[("echo", 2)][0] == "ok"
+
+
+def test_slow_task_does_not_block_the_other_workers():
+    tasks = [("sleep", 30)] + [("echo", i) for i in range(20)]
+    results = run(tasks, num_workers=2, timeout=2)
+    assert len(results) == 21
+    assert all(results[("echo", i)][0] == "ok" for i in range(20))
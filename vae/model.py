@@ -263,8 +263,8 @@ def training_step(
     ) -> tuple[dict[str, torch.Tensor], torch.Tensor]:
         output = {}
 
-        # cut off fps point during training for progressive flow
-        if self.training:
+        # cut off fps point during training for progressive flow (unless data.dataset.CutoffCollate already did)
+        if self.training and "fps_cutoff_applied" not in data:
             # randomly choose from a set of cutoff candidates
             cutoff_index = np.random.choice(len(self.config.cutoff_fps_prob), p=self.config.cutoff_fps_prob)
             cutoff_fps_point = self.config.cutoff_fps_point[cutoff_index]
@@ -12,9 +12,12 @@
 
 import argparse
 import glob
+import hashlib
 import importlib
+import json
 import os
 from datetime import datetime
+from multiprocessing import Pool
 
 import fpsample
 import kiui
@@ -42,6 +45,9 @@
 parser.add_argument("--num_fps_salient_point", type=int, help="number of fps salient points", default=1024)
 parser.add_argument("--grid_res", type=int, help="grid resolution", default=512)
 parser.add_argument("--seed", type=int, help="seed", default=42)
+parser.add_argument("--cache_dir", type=str, help="cache directory for sampled inputs", default="output/.input_cache")
+parser.add_argument("--no_cache", action="store_true", help="do not read or write the input cache")
+parser.add_argument("--num_workers", type=int, help="number of workers to prefetch inputs, 0 to disable", default=4)
 args = parser.parse_args()
 
 
@@ -50,10 +56,26 @@
 kiui.seed_everything(args.seed)
 
 
-@sync_timer("prepare_input_from_mesh")
-def prepare_input_from_mesh(mesh_path, use_salient_point=True, num_fps_point=1024, num_fps_salient_point=1024):
+# bump when prepare_input_from_mesh samples differently for the same params (e.g. the hardcoded sample counts)
+INPUT_CACHE_VERSION = 1
+
+
+def hash_mesh_input(mesh_path, **params):
+    # cache key: mesh content + sampling params (including the seed) + sampler version
+    h = hashlib.sha256(f"v{INPUT_CACHE_VERSION}\n".encode())
+    with open(mesh_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    h.update(json.dumps(params, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+def prepare_input_from_mesh(mesh_path, use_salient_point=True, num_fps_point=1024, num_fps_salient_point=1024, seed=42):
     # load mesh, assume it's already processed to be watertight.
 
+    # reseed per mesh, so the samples do not depend on which prefetch worker ran it or in which order
+    kiui.seed_everything(seed)
+
     mesh_name = mesh_path.split("/")[-1].split(".")[0]
     vertices, faces = meshiki.load_mesh(mesh_path)
 
@@ -72,24 +94,77 @@ def prepare_input_from_mesh(mesh_path, use_salient_point=True, num_fps_point=102
 
     sample = {}
 
-    sample["pointcloud"] = torch.from_numpy(uniform_surface_points)
+    sample["pointcloud"] = uniform_surface_points
 
     # fps subsample
     fps_indices = fpsample.bucket_fps_kdline_sampling(uniform_surface_points, num_fps_point, h=5, start_idx=0)
-    sample["fps_indices"] = torch.from_numpy(fps_indices).long()  # [num_fps_point,]
+    sample["fps_indices"] = fps_indices.astype(np.int64)  # [num_fps_point,]
 
     if use_salient_point:
-        sample["pointcloud_dorases"] = torch.from_numpy(salient_surface_points)  # [N', 3]
+        sample["pointcloud_dorases"] = salient_surface_points  # [N', 3]
 
         # fps subsample
         fps_indices_dorases = fpsample.bucket_fps_kdline_sampling(
             salient_surface_points, num_fps_salient_point, h=5, start_idx=0
         )
-        sample["fps_indices_dorases"] = torch.from_numpy(fps_indices_dorases).long()  # [num_fps_point,]
+        sample["fps_indices_dorases"] = fps_indices_dorases.astype(np.int64)  # [num_fps_point,]
 
     return sample
 
 
+def load_or_prepare_input(mesh_path, cache_dir=None, **params):
+    # runs in the prefetch workers, only touches numpy (no cuda)
+    if cache_dir is None:
+        return prepare_input_from_mesh(mesh_path, **params)
+
+    cache_path = os.path.join(cache_dir, hash_mesh_input(mesh_path, **params) + ".npz")
+    if os.path.exists(cache_path):
+        try:
+            with np.load(cache_path) as data:
+                return {k: data[k] for k in data.files}
+        except Exception as e:
+            print(f"Failed to load cache {cache_path}: {e}, recomputing")
+
+    sample = prepare_input_from_mesh(mesh_path, **params)
+
+    # write to a temp file then rename, so concurrent runs never read a partial cache
+    tmp_path = cache_path[: -len(".npz")] + f".{os.getpid()}.tmp.npz"
+    np.savez(tmp_path, **sample)
+    os.replace(tmp_path, cache_path)
+    return sample
+
+
+def _load_or_prepare_input_worker(job):
+    mesh_path, cache_dir, params = job
+    return load_or_prepare_input(mesh_path, cache_dir, **params)
+
+
+@sync_timer("prepare_input_from_mesh")
+def next_input(inputs):
+    # time spent waiting for the (prefetched) inputs
+    sample = next(inputs)
+    return {k: torch.from_numpy(v) for k, v in sample.items()}
+
+
+# load dataset
+mesh_list = glob.glob(os.path.join(args.input, "*"))
+mesh_list = mesh_list[: args.limit] if args.limit > 0 else mesh_list
+
+cache_dir = None if args.no_cache else args.cache_dir
+if cache_dir is not None:
+    os.makedirs(cache_dir, exist_ok=True)
+
+params = dict(num_fps_point=args.num_fps_point, num_fps_salient_point=args.num_fps_salient_point, seed=args.seed)
+jobs = [(mesh_path, cache_dir, params) for mesh_path in mesh_list]
+
+# start the prefetch workers before touching cuda, they keep sampling the next meshes while the vae runs
+if args.num_workers > 0:
+    pool = Pool(args.num_workers)
+    inputs = pool.imap(_load_or_prepare_input_worker, jobs)
+else:
+    pool = None
+    inputs = map(_load_or_prepare_input_worker, jobs)
+
 print(f"Loading checkpoint from {args.ckpt_path}")
 ckpt_dict = torch.load(args.ckpt_path, weights_only=True)
 
@@ -114,18 +189,12 @@ def prepare_input_from_mesh(mesh_path, use_salient_point=True, num_fps_point=102
     os.system(f"rm {workspace}/*")
 print(f"Output directory: {workspace}")
 
-# load dataset
-mesh_list = glob.glob(os.path.join(args.input, "*"))
-mesh_list = mesh_list[: args.limit] if args.limit > 0 else mesh_list
-
 for i, mesh_path in enumerate(mesh_list):
     print(f"Processing {i}/{len(mesh_list)}: {mesh_path}")
 
     mesh_name = mesh_path.split("/")[-1].split(".")[0]
 
-    sample = prepare_input_from_mesh(
-        mesh_path, num_fps_point=args.num_fps_point, num_fps_salient_point=args.num_fps_salient_point
-    )
+    sample = next_input(inputs)
     for k in sample:
         sample[k] = sample[k].unsqueeze(0).cuda()
 
@@ -140,3 +209,7 @@ def prepare_input_from_mesh(mesh_path, use_salient_point=True, num_fps_point=102
     mesh = postprocess_mesh(mesh, 5e5)
 
     mesh.export(f"{workspace}/{mesh_name}.glb")
+
+if pool is not None:
+    pool.close()
+    pool.join()